@@ -7,83 +7,463 @@
 # Last Modified Date:  24.11.2021
 # Last Modified By:    valery brinnel <firstname.lastname@gmail.com>
 
-from typing import Literal, Any
+import multiprocessing, time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Literal, Any, ClassVar
+from collections.abc import Callable, Iterator
 from ampel.types import Tag
 from ampel.ztf.util.ZTFIdMapper import to_ampel_id
 from ampel.view.ReadOnlyDict import ReadOnlyDict
 from ampel.alert.BaseAlertSupplier import BaseAlertSupplier
 from ampel.alert.AmpelAlert import AmpelAlert
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+from ampel.ztf.util.CandidWindow import CandidWindow
+from ampel.ztf.t0.load.AlertLatency import AlertLatency
+from ampel.ztf.t0.load.PushWatermark import PushWatermark
+from ampel.ztf.t0.load.avroutils import AlertDecoder, CUTOUT_FIELDS, decode_in_worker, init_decode_worker
+from ampel.ztf.alert.ZiLazyDatapoints import ZiLazyDatapoints
+
+stat_duplicates = AmpelMetricsRegistry.counter(
+	"alerts_duplicate",
+	"Number of alerts whose candid was supplied before",
+	subsystem="alertprocessor",
+)
 
 
 class ZiAlertSupplier(BaseAlertSupplier):
 	"""
-	Returns an AmpelAlert instance for each alert payload provided by the underlying alert_loader
+	Returns an AmpelAlert instance for each alert payload provided by the underlying alert_loader.
+	Use deserialize=None with loaders that already yield alert dicts,
+	e.g. UWAlertLoader with deserialize="avro".
 	"""
 
 	# Override default
 	deserialize: None | Literal["avro", "json"] = "avro"
 
+	#: Avro decoding strategy, used if deserialize is "avro".
+	#: "schemaless" parses each distinct writer schema only once, see :class:`AlertDecoder`
+	decoder: Literal["reader", "schemaless"] = "reader"
+
+	#: Treatment of image stamps (requires decoder="schemaless" if the supplier decodes).
+	#: "skip" avoids reading them at all. "lazy" keeps memoryviews into the
+	#: original payload and exposes them as extra['cutouts'], so that
+	#: e.g. PhotoAlertPlotter can materialize them on demand.
+	cutouts: Literal["decode", "skip", "lazy"] = "decode"
+
+	#: Fields of candidate to build (requires decoder="schemaless" if the supplier decodes).
+	#: None decodes all fields. Note that datapoint bodies stored by the shaper
+	#: only contain the projected fields. See :meth:`get_projection`.
+	candidate_fields: None | list[str] = None
+
+	#: Fields of prv_candidates entries to build, see candidate_fields
+	prv_candidate_fields: None | list[str] = None
+
+	#: Decode candid, objectId and candidate first, and prv_candidates only when
+	#: datapoints beyond the triggering candidate are accessed (see :class:`ZiLazyDatapoints`).
+	#: Alerts rejected by candidate-only cuts then never decode their history.
+	#: Requires decoder="schemaless", and is incompatible with cutouts="lazy"
+	#: since the stamps follow the history in the payload.
+	defer_history: bool = False
+
+	#: Number of workers decoding avro payloads in parallel, 0 decodes in the calling thread.
+	#: Decoded alerts are shaped in the original order. Alerts in flight have already
+	#: been requested from the loader, so this is incompatible with loaders that
+	#: commit_after_push.
+	decode_workers: int = 0
+
+	#: "process" sidesteps the GIL, which fastavro holds while decoding.
+	#: "thread" avoids pickling payloads and alerts, but only overlaps I/O and decompression.
+	decode_pool: Literal["thread", "process"] = "process"
+
+	#: Maximum number of payloads submitted to the pool but not yet consumed.
+	#: 0 means 4 * decode_workers.
+	decode_inflight: int = 0
+
+	#: Read up to this many alerts ahead, and supply them grouped by object
+	#: (in order of first appearance) and sorted by candidate jd within each group,
+	#: so that alerts of the same object are processed back to back, e.g. with
+	#: ZiMongoMuxer(reuse_stock_state=True). 0 disables grouping.
+	#: The alerts of a micro-batch have already been requested from the loader,
+	#: so this is incompatible with loaders that commit_after_push.
+	coalesce: int = 0
+
+	#: Hold alerts for up to this many seconds, and release alerts of the same
+	#: object in jd order, so that points arriving out of order through different
+	#: partitions are not first inserted and then marked superseded by ZiMongoMuxer.
+	#: When the oldest held alert is due, it is released together with all held
+	#: alerts of the same object with smaller jd. 0 disables reordering.
+	#: Held alerts have already been requested from the loader, so this is
+	#: incompatible with loaders that commit_after_push.
+	reorder_window: float = 0
+
+	#: Maximum number of alerts to hold for reordering. When exceeded, the oldest is released early.
+	reorder_size: int = 10_000
+
+	#: Treatment of alerts whose candid is among the last duplicates_window
+	#: alerts supplied, e.g. redelivered after a rebalance or a crash:
+	#: "drop" skips them, "tag" tags them with DUPLICATE before they are filtered.
+	#: A candid counts as seen once the next alert is requested, i.e. after
+	#: the previous one was processed.
+	duplicates: None | Literal["drop", "tag"] = None
+
+	#: Number of candids to remember
+	duplicates_window: int = 100_000
+
+	#: File to persist the remembered candids in, so that duplicates are
+	#: also recognized after a restart. With a loader that commits after push,
+	#: only candids of alerts that were written to the database are persisted.
+	#: ZTFAlertStreamController gives each replica its own file.
+	duplicates_file: None | str = None
+
+	#: Fields always decoded when a projection is used, needed to shape alerts and datapoints
+	required_fields: ClassVar[tuple[str, ...]] = (
+		'candid', 'jd', 'fid', 'pid', 'rcid', 'programid', 'programpi',
+		'diffmaglim', 'pdiffimfilename'
+	)
+
+
+	def __init__(self, **kwargs) -> None:
+		super().__init__(**kwargs)
+		projection = {
+			k: [*self.required_fields, *fields]
+			for k, fields in (('candidate', self.candidate_fields), ('prv_candidates', self.prv_candidate_fields))
+			if fields is not None
+		}
+		self._projection = projection
+		self._decoded: None | Iterator[dict[str, Any]] = None
+		# persist seen candids only once their alerts were pushed
+		self._defer_seen = getattr(self.alert_loader, "commit_after_push", False)
+		self._seen = None if self.duplicates is None else CandidWindow(
+			self.duplicates_window, self.duplicates_file, deferred=self._defer_seen
+		)
+		if self._seen is not None and self._defer_seen:
+			PushWatermark.register(self._seen)
+		# the muxer installs the push hook after the supplier is created
+		self._check_hook = self._seen is not None and self._defer_seen
+		self._last: None | int = None
+		self._stream: None | Iterator[AmpelAlert] = None
+		if self.deserialize == "avro" and self.decoder == "schemaless":
+			self._deserialize = AlertDecoder(self.cutouts, projection)
+		elif self.deserialize == "avro" and (self.cutouts != "decode" or projection or self.defer_history):
+			raise ValueError("cutouts, field projections and defer_history require decoder='schemaless'")
+		if self.defer_history and (self.deserialize != "avro" or self.cutouts == "lazy"):
+			raise ValueError("defer_history requires deserialize='avro' and is incompatible with cutouts='lazy'")
+		if self.decode_workers > 0 and (self.deserialize != "avro" or self.defer_history):
+			raise ValueError("decode_workers requires deserialize='avro' and is incompatible with defer_history")
+		if self.decode_workers > 0 and self.decode_pool == "process" and self.cutouts == "lazy":
+			# memoryviews cannot be sent back from worker processes
+			raise ValueError("decode_pool='process' is incompatible with cutouts='lazy'")
+		if self.decode_workers > 0 and getattr(self.alert_loader, "commit_after_push", False):
+			# the loader would mark alerts in the pool as processed
+			raise ValueError("decode_workers is incompatible with a loader that commits after push")
+		if self.reorder_window > 0 and getattr(self.alert_loader, "commit_after_push", False):
+			# the loader would mark held alerts as processed
+			raise ValueError("reorder_window is incompatible with a loader that commits after push")
+		if self.coalesce > 0 and getattr(self.alert_loader, "commit_after_push", False):
+			raise ValueError("coalesce is incompatible with a loader that commits after push")
+
+
+	@classmethod
+	def get_projection(cls, *units: Any) -> dict[str, None | list[str]]:
+		"""
+		Compute the union of the alert fields used by the given units (classes or instances),
+		suitable to update the supplier config. Units declare the fields they access via
+		the class variables candidate_keys and prv_candidate_keys. A muxer-style
+		'projection' dict contributes its 'body.*' keys to both.
+		If any unit does not declare its fields, the corresponding entry is None (no projection).
+		Example::
+
+			ZiAlertSupplier.get_projection(DecentFilter, ZiDataPointShaper, ZiMongoMuxer)
+		"""
+		ret: dict[str, None | set[str]] = {'candidate_fields': set(), 'prv_candidate_fields': set()}
+		for unit in units:
+			if isinstance(projection := getattr(unit, 'projection', None), dict):
+				body = {k[5:] for k in projection if k.startswith('body.')}
+				for v in ret.values():
+					if v is not None:
+						v.update(body)
+				continue
+			for k, attr in (('candidate_fields', 'candidate_keys'), ('prv_candidate_fields', 'prv_candidate_keys')):
+				if (keys := getattr(unit, attr, None)) is None:
+					ret[k] = None
+				elif (v := ret[k]) is not None:
+					v.update(keys)
+		return {k: None if v is None else sorted(v) for k, v in ret.items()}
+
 
 	def __next__(self) -> AmpelAlert:
 		"""
 		:raises StopIteration: when alert_loader dries out.
 		:raises AttributeError: if alert_loader was not set properly before this method is called
 		"""
-		d = self._deserialize(
-			next(self.alert_loader) # type: ignore
-		)
+		if not AlertLatency.enabled:
+			return self._next_unseen()
 
-		return self.shape_alert_dict(d)
+		latency = AlertLatency.instance()
+		latency.on_request()
+		alert = self._next_unseen()
+		latency.on_supply()
+		return alert
 
 
-	@staticmethod
-	def shape_alert_dict(
-		d: dict[str, Any],
-		tag: None | Tag | list[Tag] = None
-	) -> AmpelAlert:
+	def _next_unseen(self) -> AmpelAlert:
+
+		if self._seen is None:
+			return self._supply()
+
+		if self._check_hook:
+			self._check_hook = False
+			if not PushWatermark.hooked(type(self).__name__):
+				# nothing would ever commit the window
+				self._defer_seen = self._seen.deferred = False
+
+		if self._last is not None:
+			self._seen.add(self._last)
+			self._last = None
+
+		while True:
+			try:
+				alert = self._supply()
+			except StopIteration:
+				if not self._defer_seen:
+					self._seen.save()
+				raise
+			if alert.id not in self._seen:
+				self._last = alert.id
+				return alert
+			stat_duplicates.inc()
+			if self.duplicates == "tag":
+				tag = [] if alert.tag is None else alert.tag if isinstance(alert.tag, list) else [alert.tag]
+				return AmpelAlert(
+					id = alert.id,
+					stock = alert.stock,
+					datapoints = alert.datapoints,
+					extra = alert.extra,
+					tag = [*tag, "DUPLICATE"]
+				)
+
+
+	def _supply(self) -> AmpelAlert:
+		if not (self.reorder_window > 0 or self.coalesce > 0):
+			return self._next_alert()
+		if self._stream is None:
+			self._stream = self._alerts()
+			if self.reorder_window > 0:
+				self._stream = self._reorder(self._stream)
+			if self.coalesce > 0:
+				self._stream = self._coalesce(self._stream)
+		return next(self._stream)
+
+
+	def _alerts(self) -> Iterator[AmpelAlert]:
+		while True:
+			try:
+				yield self._next_alert()
+			except StopIteration:
+				return
+
+
+	def _reorder(self, alerts: Iterator[AmpelAlert]) -> Iterator[AmpelAlert]:
+		"""
+		Delay alerts by up to reorder_window seconds, releasing alerts of the same stock in jd order
+		"""
+		# arrival time, jd, stock and sequence number of held alerts, oldest first
+		arrivals: deque[tuple[float, float, Any, int]] = deque()
+		# stock -> jd, sequence number, alert
+		held: dict[Any, list[tuple[float, int, AmpelAlert]]] = {}
+		released: set[int] = set()
+		seq = 0
+		exhausted = False
 
-		if d['prv_candidates']:
+		while arrivals or not exhausted:
+			# fill up until the oldest alert is due
+			while not exhausted and (
+				not arrivals or (
+					len(arrivals) < self.reorder_size and
+					time.monotonic() - arrivals[0][0] < self.reorder_window
+				)
+			):
+				if (alert := next(alerts, None)) is None:
+					exhausted = True
+					break
+				jd = alert.datapoints[0]['jd']
+				arrivals.append((time.monotonic(), jd, alert.stock, seq))
+				held.setdefault(alert.stock, []).append((jd, seq, alert))
+				seq += 1
 
-			dps: list[ReadOnlyDict] = [ReadOnlyDict(d['candidate'])]
+			if not arrivals:
+				break
+			_, jd, stock, n = arrivals.popleft()
+			if n in released:
+				released.discard(n)
+				continue
+			group = held.pop(stock)
+			group.sort(key=lambda item: item[:2])
+			for i, (jd_held, n_held, alert) in enumerate(group):
+				if jd_held > jd or (jd_held == jd and n_held > n):
+					held[stock] = group[i:]
+					break
+				if n_held != n:
+					released.add(n_held)
+				yield alert
 
-			for el in d['prv_candidates']:
 
-				# Upperlimit
-				if el.get('candid') is None:
+	def _coalesce(self, alerts: Iterator[AmpelAlert]) -> Iterator[AmpelAlert]:
+		"""
+		Yield micro-batches of alerts grouped by stock and ordered by jd
+		"""
+		exhausted = False
+		while not exhausted:
+			groups: dict[Any, list[AmpelAlert]] = {}
+			for _ in range(self.coalesce):
+				if (alert := next(alerts, None)) is None:
+					exhausted = True
+					break
+				groups.setdefault(alert.stock, []).append(alert)
+			for group in groups.values():
+				group.sort(key=lambda a: a.datapoints[0]['jd'])
+				yield from group
 
-					# rarely, meaningless upper limits with negativ
-					# diffmaglim are provided by IPAC
-					if el['diffmaglim'] < 0:
-						continue
 
-					ul = ReadOnlyDict(
-						jd = el['jd'],
-						fid = el['fid'],
-						pid = el['pid'],
-						diffmaglim = el['diffmaglim'],
-						programid = el['programid'],
-						pdiffimfilename = el.get('pdiffimfilename')
-					)
+	def _next_alert(self) -> AmpelAlert:
 
-					dps.append(ul)
+		if self.defer_history:
+			payload = next(self.alert_loader) # type: ignore
+			start = time.perf_counter()
+			d, rest = self._deserialize.decode_deferred(payload) # type: ignore[attr-defined]
+			if AlertLatency.enabled:
+				AlertLatency.instance().observe("decode", time.perf_counter() - start)
+			if rest is not None:
+				return self.shape_deferred_alert_dict(d, rest)
+			return self.shape_alert_dict(d)
 
-				# PhotoPoint
-				else:
-					dps.append(ReadOnlyDict(el))
+		if self.decode_workers > 0:
+			if self._decoded is None:
+				self._decoded = self._decode_parallel()
+			d = next(self._decoded)
+		else:
+			payload = next(self.alert_loader) # type: ignore
+			start = time.perf_counter()
+			d = self._deserialize(payload)
+			if AlertLatency.enabled and self.deserialize:
+				AlertLatency.instance().observe("decode", time.perf_counter() - start)
 
-			return AmpelAlert(
-				id = d['candid'], # alert id
-				stock = to_ampel_id(d['objectId']), # internal ampel id
-				datapoints = tuple(dps),
-				extra = ReadOnlyDict({'name': d['objectId']}), # ZTF name
-				tag = tag
+		if self.cutouts == "lazy":
+			return self.shape_alert_dict(
+				d, extra={
+					'cutouts': {k: d[k]['stampData'] for k in CUTOUT_FIELDS if d.get(k)}
+				}
 			)
 
-		# No "previous candidate"
+		return self.shape_alert_dict(d)
+
+
+	def _decode_parallel(self) -> Iterator[dict[str, Any]]:
+		"""
+		Submit payloads from the loader to a pool, and yield decoded alerts in submission order
+		"""
+		pool: Executor
+		if self.decode_pool == "process":
+			pool = ProcessPoolExecutor(
+				self.decode_workers,
+				# the loader may run threads (e.g. Kafka prefetching), which must not be forked
+				mp_context = multiprocessing.get_context("forkserver"),
+				initializer = init_decode_worker,
+				initargs = (self.decoder, self.cutouts, self._projection)
+			)
+			decode: Callable[[Any], dict[str, Any]] = decode_in_worker
+		else:
+			pool = ThreadPoolExecutor(self.decode_workers)
+			decode = self._deserialize
+
+		inflight: deque[Future[dict[str, Any]]] = deque()
+		limit = self.decode_inflight or 4 * self.decode_workers
+		with pool:
+			for payload in self.alert_loader:
+				if self.decode_pool == "process" and not isinstance(payload, (bytes, bytearray)):
+					payload = payload.read() # type: ignore[union-attr]
+				inflight.append(pool.submit(decode, payload))
+				if len(inflight) >= limit:
+					yield inflight.popleft().result()
+			while inflight:
+				yield inflight.popleft().result()
+
+
+	@classmethod
+	def shape_alert_dict(cls,
+		d: dict[str, Any],
+		tag: None | Tag | list[Tag] = None,
+		extra: None | dict[str, Any] = None
+	) -> AmpelAlert:
+
+		return AmpelAlert(
+			id = d['candid'], # alert id
+			stock = to_ampel_id(d['objectId']), # internal ampel id
+			datapoints = cls.shape_datapoints(ReadOnlyDict(d['candidate']), d['prv_candidates']),
+			extra = ReadOnlyDict({'name': d['objectId'], **(extra or {})}), # ZTF name
+			tag = tag
+		)
+
+
+	@classmethod
+	def shape_deferred_alert_dict(cls,
+		d: dict[str, Any],
+		rest: Callable[[], dict[str, Any]],
+		tag: None | Tag | list[Tag] = None,
+		extra: None | dict[str, Any] = None
+	) -> AmpelAlert:
+		"""
+		:param d: alert dict without prv_candidates, see :meth:`AlertDecoder.decode_deferred`
+		:param rest: returns the remaining fields of the alert
+		"""
+		first = ReadOnlyDict(d['candidate'])
 		return AmpelAlert(
 			id = d['candid'], # alert id
 			stock = to_ampel_id(d['objectId']), # internal ampel id
-			datapoints = (ReadOnlyDict(d['candidate']), ),
-			extra = ReadOnlyDict({'name': d['objectId']}), # ZTF name
+			datapoints = ZiLazyDatapoints(
+				first, lambda: cls.shape_datapoints(first, rest()['prv_candidates'])
+			),
+			extra = ReadOnlyDict({'name': d['objectId'], **(extra or {})}), # ZTF name
 			tag = tag
 		)
+
+
+	@staticmethod
+	def shape_datapoints(
+		candidate: ReadOnlyDict,
+		prv_candidates: None | list[dict[str, Any]]
+	) -> tuple[ReadOnlyDict, ...]:
+
+		# No "previous candidate"
+		if not prv_candidates:
+			return (candidate, )
+
+		dps: list[ReadOnlyDict] = [candidate]
+
+		for el in prv_candidates:
+
+			# Upperlimit
+			if el.get('candid') is None:
+
+				# rarely, meaningless upper limits with negativ
+				# diffmaglim are provided by IPAC
+				if el['diffmaglim'] < 0:
+					continue
+
+				ul = ReadOnlyDict(
+					jd = el['jd'],
+					fid = el['fid'],
+					pid = el['pid'],
+					diffmaglim = el['diffmaglim'],
+					programid = el['programid'],
+					pdiffimfilename = el.get('pdiffimfilename')
+				)
+
+				dps.append(ul)
+
+			# PhotoPoint
+			else:
+				dps.append(ReadOnlyDict(el))
+
+		return tuple(dps)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/alert/ZiLazyDatapoints.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+from typing import Any, overload
+from collections.abc import Callable, Iterator, Sequence
+from ampel.view.ReadOnlyDict import ReadOnlyDict
+
+
+class ZiLazyDatapoints(Sequence[ReadOnlyDict]):
+	"""
+	Datapoints of an alert whose history is only shaped (and decoded) on first use.
+	The triggering candidate, datapoints[0], is available right away,
+	so that filters can reject alerts on candidate-only cuts without paying
+	for prv_candidates. Any other access (len, iteration, slicing, index > 0)
+	loads the full sequence.
+	"""
+
+	__slots__ = '_first', '_load', '_dps'
+
+	def __init__(self, first: ReadOnlyDict, load: Callable[[], Sequence[ReadOnlyDict]]) -> None:
+		"""
+		:param load: returns all datapoints, starting with first
+		"""
+		self._first = first
+		self._load: None | Callable[[], Sequence[ReadOnlyDict]] = load
+		self._dps: None | Sequence[ReadOnlyDict] = None
+
+
+	@property
+	def loaded(self) -> bool:
+		return self._dps is not None
+
+
+	def _all(self) -> Sequence[ReadOnlyDict]:
+		if self._dps is None:
+			self._dps = self._load() # type: ignore[misc]
+			self._load = None
+		return self._dps
+
+
+	@overload
+	def __getitem__(self, index: int) -> ReadOnlyDict:
+		...
+
+	@overload
+	def __getitem__(self, index: slice) -> Sequence[ReadOnlyDict]:
+		...
+
+	def __getitem__(self, index: Any) -> Any:
+		if index == 0:
+			return self._first
+		return self._all()[index]
+
+
+	def __len__(self) -> int:
+		return len(self._all())
+
+
+	def __iter__(self) -> Iterator[ReadOnlyDict]:
+		return iter(self._all())
+
+
+	def __eq__(self, other: object) -> bool:
+		if isinstance(other, ZiLazyDatapoints):
+			other = other._all()
+		if not isinstance(other, Sequence):
+			return NotImplemented
+		return tuple(self._all()) == tuple(other)
+
+
+	def __reduce__(self):
+		return (tuple, (tuple(self._all()), ))
+
+
+	def __repr__(self) -> str:
+		if self._dps is None:
+			return f"<{type(self).__name__} {self._first!r}, ...>"
+		return f"<{type(self).__name__} {self._dps!r}>"
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/base/CandidateCutFilter.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+from typing import Any
+
+from ampel.abstract.AbsAlertFilter import AbsAlertFilter
+from ampel.base.decorator import abstractmethod
+from ampel.protocol.AmpelAlertProtocol import AmpelAlertProtocol
+
+
+class CandidateCutFilter(AbsAlertFilter, abstract=True):
+    """
+    Alert filter with a pre-cut that only looks at the triggering candidate
+    (alert.datapoints[0]). The pre-cut runs before anything else, so that
+    with ZiAlertSupplier(defer_history=True) rejected alerts never decode
+    their prv_candidates.
+    """
+
+    @abstractmethod
+    def accept_candidate(self, candidate: dict[str, Any]) -> bool:
+        """
+        :return: False to reject the alert based on its latest candidate alone
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def process_alert(self, alert: AmpelAlertProtocol) -> None | bool | int:
+        """
+        Filter an alert whose candidate passed the pre-cut. See AbsAlertFilter.process
+        """
+        raise NotImplementedError
+
+    def process(self, alert: AmpelAlertProtocol) -> None | bool | int:
+        if not self.accept_candidate(alert.datapoints[0]):
+            return None
+        return self.process_alert(alert)
@@ -8,9 +8,10 @@
 # Last Modified By:    valery brinnel <firstname.lastname@gmail.com>
 
 
-import logging, time, sys, fastavro, tarfile # type: ignore[import]
+import logging, time, sys, tarfile # type: ignore[import]
 from typing import Any
 from ampel.alert.AmpelAlert import AmpelAlert
+from ampel.ztf.t0.load.avroutils import AlertDecoder
 
 
 class DevAlertConsumer:
@@ -35,7 +36,9 @@ class DevAlertConsumer:
 				* 'objectId_candid': tuple ('candid', 'objectId') will be kept
 
 		include_cutouts:
-			If True, AmpelAlert will contain cutouts images as attribute 'cutouts'
+			If True, AmpelAlert will contain cutouts images as attribute 'cutouts'.
+			Stamps are kept as memoryviews into the alert payload; they are not
+			read at all otherwise.
 		"""
 		logging.basicConfig( # Setup logger
 			format = '%(asctime)s %(levelname)s %(message)s',
@@ -50,6 +53,7 @@ class DevAlertConsumer:
 		self._rejected_alerts = []
 		self.save = save
 		self.include_cutouts = include_cutouts
+		self._decoder = AlertDecoder("lazy" if include_cutouts else "skip")
 
 
 	def get_accepted_alerts(self):
@@ -166,8 +170,7 @@ class DevAlertConsumer:
 
 
 	def _deserialize(self, f):
-		reader = fastavro.reader(f)
-		return next(reader, None)
+		return self._decoder(f)
 
 
 	def _shape(self, alert_content: dict[str, Any]) -> list[dict[str,Any]]:
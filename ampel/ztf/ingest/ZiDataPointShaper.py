@@ -7,7 +7,7 @@
 # Last Modified Date:  10.05.2021
 # Last Modified By:    valery brinnel <firstname.lastname@gmail.com>
 
-from typing import Any
+from typing import Any, ClassVar
 from collections.abc import Iterable
 from ampel.base.AmpelUnit import AmpelUnit
 from ampel.types import StockId
@@ -25,6 +25,13 @@ class ZiDataPointShaperBase(AmpelUnit):
 	# JD2017 is used to define upper limits primary IDs
 	JD2017: float = 2457754.5
 
+	# Alert fields required to shape datapoints, see ZiAlertSupplier.get_projection.
+	# Photopoint bodies contain whatever other fields were decoded.
+	candidate_keys: ClassVar[tuple[str, ...]] = (
+		'candid', 'jd', 'fid', 'pid', 'rcid', 'programid', 'programpi', 'diffmaglim', 'pdiffimfilename'
+	)
+	prv_candidate_keys: ClassVar[tuple[str, ...]] = candidate_keys
+
 	# Mandatory implementation
 	def process(self, arg: Iterable[dict[str, Any]], stock: StockId) -> list[DataPoint]: # type: ignore[override]
 		"""
@@ -9,12 +9,28 @@
 
 from typing import Any, Tuple
 from bisect import bisect_right
+from time import perf_counter
 from pymongo import UpdateOne
 from ampel.types import DataPointId, StockId
 from ampel.content.DataPoint import DataPoint
 from ampel.content.MetaRecord import MetaRecord
 from ampel.util.mappings import unflatten_dict
 from ampel.abstract.AbsT0Muxer import AbsT0Muxer
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+from ampel.ztf.t0.load.AlertLatency import AlertLatency
+from ampel.ztf.t0.load.PushWatermark import PushWatermark
+
+stat_conflicts = AmpelMetricsRegistry.counter(
+	"muxer_conflicts",
+	"Ingestion attempts repeated because the t0 collection was updated concurrently",
+	subsystem="ztf",
+)
+stat_conflict_time = AmpelMetricsRegistry.counter(
+	"muxer_conflict_time",
+	"Time spent in ingestion attempts that were repeated",
+	unit="seconds",
+	subsystem="ztf",
+)
 
 class ConcurrentUpdateError(Exception):
 	"""
@@ -45,6 +61,13 @@ class ZiMongoMuxer(AbsT0Muxer):
 	# False: Only the alert dps will be combined into state
 	db_complete: bool = True
 
+	#: Reuse the datapoints of the previous call instead of querying the t0
+	#: collection again if it was for the same stock and the updates buffer was
+	#: not pushed in between, as happens for alerts grouped by object
+	#: (see ZiAlertSupplier.coalesce). Requires check_reprocessing, whose
+	#: consistency check detects changes made by other processes in between.
+	reuse_stock_state: bool = False
+
 	# Standard projection used when checking DB for existing PPS/ULS
 	projection = {
 		'_id': 0, 'id': 1, 'tag': 1, 'channel': 1, 'excl': 1, 'stock': 1, 'body.jd': 1,
@@ -62,6 +85,14 @@ class ZiMongoMuxer(AbsT0Muxer):
 
 		self._run_id = self.updates_buffer.run_id[0] if isinstance(self.updates_buffer.run_id, list) else self.updates_buffer.run_id
 
+		if self.reuse_stock_state and not self.check_reprocessing:
+			raise ValueError("reuse_stock_state requires check_reprocessing")
+		# stock id, datapoints from the db and pending updates of the previous call
+		self._recent: None | tuple[None | StockId, list[DataPoint], Any] = None
+
+		# store Kafka offsets of loaders using commit_after_push once their alerts are in the DB
+		PushWatermark.install(self.updates_buffer)
+
 
 	def process(self,
 		dps: list[DataPoint],
@@ -76,10 +107,19 @@ class ZiMongoMuxer(AbsT0Muxer):
 		# IPAC occasionally issues multiple subtraction candidates for the same
 		# exposure and source, and these may be received in parallel by two
 		# AlertConsumers.
+		start = perf_counter()
 		for _ in range(10):
+			attempt = perf_counter()
 			try:
-				return self._process(dps, stock_id)
+				ret = self._process(dps, stock_id)
+				if AlertLatency.enabled:
+					AlertLatency.instance().observe("mux", perf_counter() - start)
+				return ret
 			except ConcurrentUpdateError:
+				# each retry repeats both queries and the bulk write
+				stat_conflicts.inc()
+				stat_conflict_time.inc(perf_counter() - attempt)
+				self._recent = None
 				continue
 		else:
 			raise ConcurrentUpdateError(f"More than 10 iterations ingesting alert {dps[0]['id']}")
@@ -104,7 +144,10 @@ class ZiMongoMuxer(AbsT0Muxer):
 		#######################################
 
 		# New pps/uls lists for db loaded datapoints
-		dps_db = self._get_dps(stock_id)
+		if self._recent and self._recent[0] == stock_id and self._recent[2] is self.updates_buffer.db_ops:
+			dps_db = self._recent[1]
+		else:
+			dps_db = self._get_dps(stock_id)
 
 		ops = []
 		if self.check_reprocessing:
@@ -290,6 +333,12 @@ class ZiMongoMuxer(AbsT0Muxer):
 		else:
 			dps_combine = dps
 
+		if self.reuse_stock_state:
+			# The queried docs, updated in place above, are what the next query would
+			# return as long as the datapoints of this alert remain in the updates buffer.
+			# push_updates() swaps in a fresh db_ops dict.
+			self._recent = (stock_id, dps_db, self.updates_buffer.db_ops)
+
 		return [dp for dp in dps if dp['id'] in ids_dps_to_insert], dps_combine
 
 
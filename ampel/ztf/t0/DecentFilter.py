@@ -8,16 +8,16 @@
 # Last Modified By:    Jakob van Santen <jakob.van.santen@desy.de>
 
 import numpy as np
-from typing import Any
+from typing import Any, ClassVar
 from astropy.table import Table
 from astropy.coordinates import SkyCoord
 
-from ampel.abstract.AbsAlertFilter import AbsAlertFilter
+from ampel.ztf.base.CandidateCutFilter import CandidateCutFilter
 from ampel.ztf.base.CatalogMatchUnit import CatalogMatchUnit
 from ampel.protocol.AmpelAlertProtocol import AmpelAlertProtocol
 
 
-class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
+class DecentFilter(CatalogMatchUnit, CandidateCutFilter):
     """
     General-purpose filter with ~ 0.6% acceptance. It selects alerts based on:
     * numper of previous detections
@@ -30,6 +30,13 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
 
     The filter has a very weak dependence on the real-bogus score and it is independent
     on the provided PS1 star-galaxy classification.
+
+    Image quality, real-bogus, archive length and SS object cuts only depend on
+    the latest candidate and are applied first, see CandidateCutFilter. The
+    history cuts (nDet, tSpan) follow. The accepted alerts are the same as
+    with the history cuts first, but an alert failing both is logged and
+    counted under the candidate cut that rejected it rather than under nDet
+    or tSpan.
     """
 
     # History
@@ -65,6 +72,14 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
     gaia_veto_gmag_max: float  # max gmag for normalized distance cut of GAIA counterparts [mag]
     gaia_excessnoise_sig_max: float  # maximum allowed noise (expressed as significance) for Gaia match to be trusted.
 
+    # Alert fields accessed by process(), see ZiAlertSupplier.get_projection
+    candidate_keys: ClassVar[tuple[str, ...]] = (
+        "candid", "jd", "fwhm", "elong", "magdiff", "nbad", "distpsnr1", "sgscore1",
+        "distpsnr2", "sgscore2", "distpsnr3", "sgscore3", "isdiffpos", "ra", "dec",
+        "rb", "drb", "ssdistnr", "jdstarthist", "jdendhist",
+    )
+    prv_candidate_keys: ClassVar[tuple[str, ...]] = ("candid", "jd")
+
     def post_init(self):
 
         # feedback
@@ -236,87 +251,98 @@ class DecentFilter(CatalogMatchUnit, AbsAlertFilter):
         return False
 
     # Override
-    def process(self, alert: AmpelAlertProtocol) -> None | bool | int:
+    def accept_candidate(self, latest: dict[str, Any]) -> bool:
         """
-        Mandatory implementation.
-        To exclude the alert, return *None*
-        To accept it, either return
-        * self.on_match_t2_units
-        * or a custom combination of T2 unit names
+        Cuts on the latest candidate that do not need the history or external catalogs
         """
 
-        # CUT ON THE HISTORY OF THE ALERT
-        #################################
-
-        pps = [el for el in alert.datapoints if el.get("candid") is not None]
-        if len(pps) < self.min_ndet:
-            # self.logger.debug("rejected: %d photopoints in alert (minimum required %d)"% (npp, self.min_ndet))
-            self.logger.info(None, extra={"nDet": len(pps)})
-            return None
-
-        # cut on length of detection history
-        detections_jds = [el['jd'] for el in pps]
-        det_tspan = max(detections_jds) - min(detections_jds)
-        if not (self.min_tspan <= det_tspan <= self.max_tspan):
-            # self.logger.debug("rejected: detection history is %.3f d long, \
-            # requested between %.3f and %.3f d"% (det_tspan, self.min_tspan, self.max_tspan))
-            self.logger.info(None, extra={"tSpan": det_tspan})
-            return None
-
         # IMAGE QUALITY CUTS
         ####################
 
-        latest = alert.datapoints[0]
         if not self._alert_has_keys(latest):
-            return None
+            return False
 
         if latest["isdiffpos"] == "f" or latest["isdiffpos"] == "0":
             # self.logger.debug("rejected: 'isdiffpos' is %s", latest['isdiffpos'])
             self.logger.info(None, extra={"isdiffpos": latest["isdiffpos"]})
-            return None
+            return False
 
         if latest["rb"] < self.min_rb:
             # self.logger.debug("rejected: RB score %.2f below threshod (%.2f)"% (latest['rb'], self.min_rb))
             self.logger.info(None, extra={"rb": latest["rb"]})
-            return None
+            return False
 
         if self.min_drb > 0.0 and latest["drb"] < self.min_drb:
             # self.logger.debug("rejected: RB score %.2f below threshod (%.2f)"% (latest['rb'], self.min_rb))
             self.logger.info(None, extra={"drb": latest["drb"]})
-            return None
+            return False
 
         if latest["fwhm"] > self.max_fwhm:
             # self.logger.debug("rejected: fwhm %.2f above threshod (%.2f)"% (latest['fwhm'], self.max_fwhm))
             self.logger.info(None, extra={"fwhm": latest["fwhm"]})
-            return None
+            return False
 
         if latest["elong"] > self.max_elong:
             # self.logger.debug("rejected: elongation %.2f above threshod (%.2f)"% (latest['elong'], self.max_elong))
             self.logger.info(None, extra={"elong": latest["elong"]})
-            return None
+            return False
 
         if abs(latest["magdiff"]) > self.max_magdiff:
             # self.logger.debug("rejected: magdiff (AP-PSF) %.2f above threshod (%.2f)"% (latest['magdiff'], self.max_magdiff))
             self.logger.info(None, extra={"magdiff": latest["magdiff"]})
-            return None
+            return False
 
         # cut on archive length
         if 'jdendhist' in latest.keys() and 'jdstarthist' in latest.keys():
             archive_tspan = latest['jdendhist'] - latest['jdstarthist']
             if not (self.min_archive_tspan < archive_tspan < self.max_archive_tspan):
                 self.logger.info(None, extra={'archive_tspan': archive_tspan})
-                return None
-
+                return False
 
-        # ASTRONOMY
-        ###########
+        # SOLAR SYSTEM
+        ##############
 
         # check for closeby ss objects
         if 0 <= latest["ssdistnr"] < self.min_sso_dist:
             # self.logger.debug("rejected: solar-system object close to transient (max allowed: %d)."% (self.min_sso_dist))
             self.logger.info(None, extra={"ssdistnr": latest["ssdistnr"]})
+            return False
+
+        return True
+
+    # Override
+    def process_alert(self, alert: AmpelAlertProtocol) -> None | bool | int:
+        """
+        Mandatory implementation.
+        To exclude the alert, return *None*
+        To accept it, either return
+        * self.on_match_t2_units
+        * or a custom combination of T2 unit names
+        """
+
+        # CUT ON THE HISTORY OF THE ALERT
+        #################################
+
+        pps = [el for el in alert.datapoints if el.get("candid") is not None]
+        if len(pps) < self.min_ndet:
+            # self.logger.debug("rejected: %d photopoints in alert (minimum required %d)"% (npp, self.min_ndet))
+            self.logger.info(None, extra={"nDet": len(pps)})
             return None
 
+        # cut on length of detection history
+        detections_jds = [el['jd'] for el in pps]
+        det_tspan = max(detections_jds) - min(detections_jds)
+        if not (self.min_tspan <= det_tspan <= self.max_tspan):
+            # self.logger.debug("rejected: detection history is %.3f d long, \
+            # requested between %.3f and %.3f d"% (det_tspan, self.min_tspan, self.max_tspan))
+            self.logger.info(None, extra={"tSpan": det_tspan})
+            return None
+
+        latest = alert.datapoints[0]
+
+        # ASTRONOMY
+        ###########
+
         # cut on galactic latitude
         b = self.get_galactic_latitude(latest)
         if abs(b) < self.min_gal_lat:
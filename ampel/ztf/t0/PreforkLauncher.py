@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/t0/PreforkLauncher.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+import asyncio, importlib, logging, multiprocessing, os, signal, socket, struct, sys, traceback
+from collections.abc import Callable, Sequence
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from typing import Any
+
+from ampel.metrics.prometheus import prometheus_cleanup_worker, prometheus_setup_worker
+from ampel.util.concurrent import RemoteException
+
+log = logging.getLogger(__name__)
+
+
+class PreforkLauncher:
+    """
+    Start workers by forking a template process that has already imported
+    the modules they need, instead of starting a fresh interpreter for each
+    one as :func:`ampel.util.concurrent.process` does.
+
+    The template is spawned on the first launch. It imports `preload`, then
+    calls `setup(*setup_args)` once and passes the result as the first
+    argument to every function it runs. It must not open connections or
+    start threads, since those do not survive fork.
+
+    Like :func:`ampel.util.concurrent.process`, :meth:`launch` returns an
+    asyncio.Task that completes with the return value of the function, or
+    raises its exception, and terminates the worker when cancelled. A
+    template that died is replaced on the next launch.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        preload: Sequence[str] = (),
+        setup: None | Callable[..., Any] = None,
+        setup_args: Sequence[Any] = (),
+        timeout: float = 3.0,
+    ) -> None:
+        """
+        :param name: process name, used as the implicit metrics label
+        :param setup: picklable function that returns the state shared by all workers
+        :param timeout: seconds to wait for a cancelled worker to exit before killing it
+        """
+        self._name = name
+        self._preload = list(preload)
+        self._setup = setup
+        self._setup_args = tuple(setup_args)
+        self._timeout = timeout
+        self._template: None | multiprocessing.process.BaseProcess = None
+        self._conn: None | Connection = None
+
+    def start(self) -> None:
+        if self._template is not None and self._template.is_alive():
+            return
+        self.close()
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe()
+        self._template = ctx.Process(
+            target=_serve,
+            args=(child_conn, self._name, self._preload, self._setup, self._setup_args),
+            name=f"{self._name}-template",
+            daemon=True,
+        )
+        self._template.start()
+        child_conn.close()
+
+    def close(self) -> None:
+        """
+        Stop the template. Running workers are not affected.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._template is not None:
+            self._template.join(self._timeout)
+            if self._template.is_alive():
+                self._template.kill()
+                self._template.join()
+            self._template = None
+
+    def launch(self, function: Callable[..., Any], *args: Any) -> asyncio.Task:
+        """
+        Run `function(state, *args)` in a new worker. The function and
+        arguments must be picklable.
+        """
+        self.start()
+        assert self._conn is not None and self._template is not None
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            self._conn.send_bytes(reduction.ForkingPickler.dumps((function, args)))
+            reduction.send_handle(self._conn, child_sock.fileno(), self._template.pid)
+        except BaseException:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        return asyncio.create_task(self._wait(parent_sock))
+
+    async def _wait(self, sock: socket.socket) -> Any:
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+        pid = None
+        try:
+            try:
+                pid = struct.unpack("!i", await reader.readexactly(4))[0]
+                payload = await reader.read()
+            except asyncio.CancelledError:
+                try:
+                    if pid is None:
+                        pid = struct.unpack(
+                            "!i", await asyncio.wait_for(reader.readexactly(4), self._timeout)
+                        )[0]
+                    os.kill(pid, signal.SIGTERM)
+                    await asyncio.wait_for(reader.read(), self._timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ProcessLookupError):
+                    if pid is not None:
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            ...
+                raise
+            except asyncio.IncompleteReadError:
+                raise RuntimeError(f"Template for {self._name} died before starting a worker")
+        finally:
+            writer.close()
+            if pid is not None and "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+                prometheus_cleanup_worker(pid)
+
+        if not payload:
+            raise RuntimeError(f"Process {self._name} (pid {pid}) died without returning a result")
+        ret = reduction.pickle.loads(payload)  # type: ignore[attr-defined]
+        if isinstance(ret, BaseException):
+            raise ret
+        return ret
+
+
+def _serve(
+    conn: Connection,
+    name: str,
+    preload: list[str],
+    setup: None | Callable[..., Any],
+    setup_args: tuple[Any, ...],
+) -> None:
+    """
+    Template process: fork a worker for each request
+    """
+    try:
+        import setproctitle # type: ignore
+        setproctitle.setproctitle(f"ampel.template.{name}")
+    except Exception:
+        ...
+
+    # must happen before any metrics are instantiated
+    prometheus_setup_worker({"process": name})
+    for module in preload:
+        importlib.import_module(module)
+    state = setup(*setup_args) if setup else None
+
+    # workers are reaped automatically; the launcher learns of their exit from the socket
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            request = conn.recv_bytes()
+            # typeshed declares recv_handle as returning None; it returns the fd
+            fd: int = reduction.recv_handle(conn)  # type: ignore[func-returns-value]
+        except (EOFError, OSError):
+            return
+        if os.fork() == 0:
+            conn.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            _work(fd, request, state)
+        os.close(fd)
+
+
+def _work(fd: int, request: bytes, state: Any) -> None:
+    exitcode = 1
+    try:
+        with socket.socket(fileno=fd) as sock:
+            sock.sendall(struct.pack("!i", os.getpid()))
+            try:
+                function, args = reduction.pickle.loads(request)  # type: ignore[attr-defined]
+                ret = function(state, *args)
+                exitcode = 0
+            except Exception as error:
+                ret = RemoteException(error, traceback.format_exc())
+            sock.sendall(reduction.pickle.dumps(ret))  # type: ignore[attr-defined]
+    except BaseException:
+        print(f"Process {os.getpid()}:", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        exitcode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # never return to the template loop
+        os._exit(exitcode)
@@ -7,39 +7,169 @@
 # Last Modified Date:  07.08.2020
 # Last Modified By:    Jakob van Santen <jakob.van.santen@desy.de>
 
-import asyncio, copy, logging
+import asyncio, copy, logging, math, os, re, socket, time
 from collections import Counter
-from typing import Any
-from collections.abc import Sequence
+from typing import Any, cast
+from collections.abc import Iterator, Sequence
 
 from ampel.abstract.AbsProcessController import AbsProcessController
+from ampel.base.AmpelBaseModel import AmpelBaseModel
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
 from ampel.secret.AmpelVault import AmpelVault
 from ampel.config.AmpelConfig import AmpelConfig
 from ampel.core.AmpelContext import AmpelContext
 from ampel.model.ProcessModel import ProcessModel
 from ampel.model.UnitModel import UnitModel
 from ampel.util import concurrent
+from ampel.ztf.t0.PreforkLauncher import PreforkLauncher
 
 
 log = logging.getLogger(__name__)
 
+stat_startup = AmpelMetricsRegistry.histogram(
+    "replica_startup",
+    "Time from launching a replica until it supplies its first alert",
+    unit="seconds",
+    subsystem="ztf",
+    labelnames=("mode",),
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, float("inf")),
+)
+
+
+class _StartupTimer:
+    """
+    Alert supplier wrapper that observes ampel_ztf_replica_startup_seconds
+    once the first alert is supplied, i.e. after the consumer has joined its
+    group and received messages
+    """
+
+    def __init__(self, supplier: Any, launched: float, mode: str) -> None:
+        self._supplier = supplier
+        self._launched = launched
+        self._mode = mode
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._supplier, name)
+
+    def __iter__(self) -> Iterator[Any]:
+        alerts = iter(self._supplier)
+        for alert in alerts:
+            stat_startup.labels(self._mode).observe(time.time() - self._launched)
+            yield alert
+            break
+        yield from alerts
+
+
+class AutoscalePolicy(AmpelBaseModel):
+    """
+    Choose the number of replicas from the total consumer lag and the
+    current processing rate
+    """
+
+    #: Bounds for the multiplier
+    min_multiplier: int = 1
+    max_multiplier: int = 8
+    #: Add replicas when the lag would take longer than this many seconds
+    #: to work off at the current rate. Jumps straight to the estimated
+    #: number of replicas needed.
+    target_drain_time: float = 600
+    #: Remove one replica when the remaining ones could work off the lag in
+    #: this fraction of target_drain_time. The gap to 1 is the hysteresis.
+    scale_down_margin: float = 0.5
+    #: Seconds between evaluations
+    interval: float = 60
+    #: Minimum seconds between two changes
+    cooldown: float = 300
+
+    def desired(self, current: int, lag: float, rate: float) -> int:
+        """
+        :param lag: messages not yet consumed, summed over partitions
+        :param rate: alerts processed per second by all replicas
+        """
+        if rate <= 0:
+            # nothing processed yet: grow while there is a backlog, shrink when idle
+            n = current + 1 if lag > 0 else current - 1
+        else:
+            per_replica = rate / current
+            if (needed := math.ceil(lag / (per_replica * self.target_drain_time))) > current:
+                n = needed
+            elif current > 1 and lag / (per_replica * (current - 1)) < self.scale_down_margin * self.target_drain_time:
+                n = current - 1
+            else:
+                n = current
+        return max(1, self.min_multiplier, min(self.max_multiplier, n))
+
 
 class ZTFAlertStreamController(AbsProcessController):
 
     priority: str = "default"
     multiplier: int = 1
+    #: Give each replica a stable Kafka group.instance.id (static membership),
+    #: derived from host, process name and replica slot. A replica restarted
+    #: after an exception then rejoins without rebalancing the group. Replicas
+    #: removed by scale() keep their partitions until session.timeout.ms expires.
+    static_membership: bool = False
+    #: Run a single reader process that consumes from Kafka and hands the
+    #: payloads to the replicas through shared memory (see :class:`AlertRingWriter`),
+    #: instead of a Kafka consumer per replica. The number of replicas is
+    #: then not limited by the number of partitions. Requires a UWAlertLoader.
+    fanout: bool = False
+    #: Number of payloads held in shared memory at once
+    fanout_slots: int = 256
+    #: Size of a shared memory slot in bytes. Larger payloads are sent over the control socket.
+    fanout_slot_size: int = 1 << 20
+    #: With fanout, hand all alerts of an object to the same replica, so that
+    #: replicas do not ingest datapoints of the same stock concurrently. Such
+    #: conflicts make ZiMongoMuxer repeat the ingestion of an alert
+    #: (counted in ampel_ztf_muxer_conflicts_total).
+    affinity: bool = False
+    #: Scale the number of replicas with the consumer lag (reported by the
+    #: replicas as ampel_kafka_consumer_lag) and the processing rate
+    #: (ampel_alertprocessor_alerts_processed). None leaves scaling to scale().
+    autoscale: None | AutoscalePolicy = None
+    #: Seconds to wait before replacing a replica (or the reader) that raised an exception
+    restart_delay: float = 10
+    #: Fork replicas from a template process that has already imported
+    #: `preload` and parsed the config, instead of starting each one in a
+    #: fresh interpreter. The time from launch until a replica supplies its
+    #: first alert is exported as ampel_ztf_replica_startup_seconds, labeled
+    #: by mode (warm or cold).
+    warm_start: bool = False
+    #: Modules imported by the template process
+    preload: list[str] = [
+        "ampel.alert.AlertConsumer",
+        "ampel.ztf.alert.ZiAlertSupplier",
+        "ampel.ztf.ingest.ZiMongoMuxer",
+        "ampel.ztf.t0.load.UWAlertLoader",
+        "ampel.ztf.t0.load.SharedRingAlertLoader",
+        "ampel.ztf.t0.DecentFilter",
+        "astropy.coordinates",
+        "confluent_kafka",
+        "fastavro",
+        "pymongo",
+    ]
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
 
         self._scale_event: None | asyncio.Event = None
+        self._prefork: None | PreforkLauncher = None
         self.update(self.config, self.vault, self.processes)
+        self._ring = re.sub(r"\W", "_", f"{self._process.name}-{os.getpid()}")
+        if self.fanout and self._loader(self._process.dict()).get("unit") != "UWAlertLoader":
+            raise ValueError("fanout requires a UWAlertLoader")
+        if self.affinity and not self.fanout:
+            raise ValueError("affinity requires fanout")
 
     def update(self,
         config: AmpelConfig,
         secrets: None | AmpelVault,
         processes: Sequence[ProcessModel],
     ) -> None:
+        if self._prefork and config is not self.config:
+            # fork subsequent replicas from a template with the new config
+            self._prefork.close()
+            self._prefork = None
         self.config = config
         self.processes = processes
         self.secrets = secrets
@@ -102,23 +232,65 @@ class ZTFAlertStreamController(AbsProcessController):
         """
         assert self._scale_event is None, "run() is not reentrant"
         self._scale_event = asyncio.Event()
+        autoscaler = asyncio.create_task(self._autoscale()) if self.autoscale else None
+
+        # replica slot of each running task, reused on restart
+        slots: dict[asyncio.Task, int] = {}
 
         def launch() -> asyncio.Task:
             counter = AbsProcessController.process_count.labels(self._process.tier, self._process.name)
-            t = self.run_mp_process(
+            slot = min(set(range(len(slots) + 1)) - set(slots.values()))
+            if self.warm_start:
+                if self._prefork is None:
+                    self._prefork = PreforkLauncher(
+                        self._process.name,
+                        preload=self.preload,
+                        setup=self.setup_warm_process,
+                        setup_args=(self.config.get(),),
+                        timeout=60,
+                    )
+                t = self._prefork.launch(
+                    self.run_warm_process,
+                    self.secrets,
+                    self.get_process(slot),
+                    time.time(),
+                )
+            else:
+                t = self.run_mp_process(
+                    self.config.get(),
+                    self.secrets,
+                    self.get_process(slot),
+                    launched=time.time(),
+                )
+            counter.inc()
+            slots[t] = slot
+            t.add_done_callback(lambda t: counter.dec())
+            t.add_done_callback(lambda t: slots.pop(t, None))
+            return t
+
+        def launch_reader() -> asyncio.Task:
+            t = self.run_ring_reader(
                 self.config.get(),
                 self.secrets,
-                self._process.dict(),
+                self._loader(self._process.dict()).get("config") or {},
+                self._ring,
+                self.fanout_slots,
+                self.fanout_slot_size,
+                self.affinity,
             )
-            counter.inc()
-            t.add_done_callback(lambda t: counter.dec())
+            t.set_name("reader")
             return t
+
+        # scale wait task, and the reader if any
+        aux = 2 if self.fanout else 1
         assert self._process.active
         pending = {launch() for _ in range(self.multiplier)}
+        if self.fanout:
+            pending.add(launch_reader())
         pending.add(asyncio.create_task(self._scale_event.wait(), name="scale"))
         done: set[asyncio.Task] = set()
         try:
-            while self._process.active and len(pending) > 1:
+            while self._process.active and len(pending) > aux:
                 try:
                     done, pending = await asyncio.wait( # type: ignore[assignment]
                         pending, return_when="FIRST_COMPLETED"
@@ -127,58 +299,204 @@ class ZTFAlertStreamController(AbsProcessController):
                         if task.get_name() == "scale":
                             if self._scale_event.is_set():
                                 log.info(f"scale {len(pending)} -> {self.multiplier}")
-                                # scale down
-                                to_kill = {pending.pop() for _ in range(len(pending) - self.multiplier)}
+                                # scale down, keeping the lowest slots
+                                to_kill = set(
+                                    sorted((t for t in pending if t in slots), key=lambda t: slots[t])[self.multiplier:]
+                                )
+                                pending -= to_kill
                                 for t in to_kill:
                                     t.cancel()
                                 await asyncio.gather(*to_kill, return_exceptions=True)
                                 done.update(to_kill)
                                 # scale up
-                                for _ in range(self.multiplier - len(pending)):
+                                for _ in range(self.multiplier - len(pending) + aux - 1):
                                     pending.add(launch())
                                 self._scale_event.clear()
                             pending.add(asyncio.create_task(self._scale_event.wait(), name="scale"))
+                        elif task.get_name() == "reader":
+                            if (exc := task.exception()):
+                                AbsProcessController.process_exceptions.labels(self._process.tier, self._process.name).inc()
+                                log.warn("Ring reader failed", exc_info=exc)
+                                await asyncio.sleep(self.restart_delay)
+                            # the replicas wait for a new reader
+                            pending.add(launch_reader())
                         else:
                             if (exc := task.exception()):
                                 AbsProcessController.process_exceptions.labels(self._process.tier, self._process.name).inc()
                                 log.warn("AlertConsumer failed", exc_info=exc)
-                                await asyncio.sleep(10)
+                                await asyncio.sleep(self.restart_delay)
                             # start a fresh replica for each processor that
-                            # returned True. NB: +1 for scale wait task
-                            if (task.exception() or task.result()) and len(pending) < self.multiplier + 1:
+                            # returned True. NB: +aux for scale wait task and reader
+                            if (task.exception() or task.result()) and len(pending) < self.multiplier + aux:
                                 pending.add(launch())
                 except Exception:
                     for t in pending:
                         t.cancel()
                     break
         finally:
+            if autoscaler:
+                autoscaler.cancel()
             # force scale future to come due
             self._scale_event.set()
+            for t in pending:
+                if t.get_name() == "reader":
+                    t.cancel()
             tasks = list(done.union(pending))
             results = await asyncio.gather(*tasks, return_exceptions=True)
-            return [r for t, r in zip(tasks, results) if t.get_name() != "scale"]
+            if self._prefork:
+                self._prefork.close()
+                self._prefork = None
+            return [r for t, r in zip(tasks, results) if t.get_name() not in ("scale", "reader")]
+
+    async def _autoscale(self) -> None:
+        assert self.autoscale
+        policy = self.autoscale
+        last_change = -math.inf
+        processed, since = self.read_lag_and_processed()[1], time.monotonic()
+        while True:
+            await asyncio.sleep(policy.interval)
+            lag, count = self.read_lag_and_processed()
+            now = time.monotonic()
+            rate = max(0.0, count - processed) / (now - since)
+            processed, since = count, now
+            if not self._process.active or now - last_change < policy.cooldown:
+                continue
+            if (n := policy.desired(self.multiplier, lag, rate)) != self.multiplier:
+                log.info(f"autoscale {self.multiplier} -> {n} (lag {lag:.0f}, rate {rate:.1f}/s)")
+                last_change = now
+                self.scale(multiplier=n)
+
+    @staticmethod
+    def read_lag_and_processed() -> tuple[float, float]:
+        """
+        :returns: total consumer lag over assigned partitions, and the number of alerts processed
+        """
+        lag = processed = 0.0
+        for metric in AmpelMetricsRegistry.collect():
+            for sample in metric.samples:
+                if sample.name == "ampel_kafka_consumer_lag" and sample.value > 0:
+                    lag += sample.value
+                elif sample.name == "ampel_alertprocessor_alerts_processed_total":
+                    processed += sample.value
+        return lag, processed
+
+    def get_process(self, slot: int) -> dict[str, Any]:
+        """
+        Process model for the replica in the given slot
+        """
+        p = self._process.dict()
+        loader = self._loader(p)
+        supplier = p["processor"]["config"].get("supplier", {}).get("config", {})
+        if supplier.get("duplicates_file"):
+            # replicas must not overwrite each other's candids
+            supplier["duplicates_file"] = f"{supplier['duplicates_file']}.{slot}"
+        if self.fanout:
+            loader.clear()
+            loader.update(unit="SharedRingAlertLoader", config={"ring": self._ring})
+        elif self.static_membership:
+            if loader.get("unit") == "UWAlertLoader":
+                loader.setdefault("config", {})["group_instance_id"] = (
+                    f"{socket.gethostname()}-{self._process.name}-{slot}"
+                )
+        return p
+
+    @staticmethod
+    def _loader(p: dict[str, Any]) -> dict[str, Any]:
+        """
+        Loader model in the given process dict
+        """
+        return p["processor"]["config"].get("supplier", {}).get("config", {}).get("loader", {})
 
     @staticmethod
     @concurrent.process(timeout=60)
-    def run_mp_process(
+    def run_ring_reader(
         config: dict[str, Any],
         secrets: None | AmpelVault,
-        p: dict[str, Any],
+        loader: dict[str, Any],
+        ring: str,
+        slots: int,
+        slot_size: int,
+        affinity: bool = False,
     ) -> bool:
 
         try:
             import setproctitle # type: ignore
-            setproctitle.setproctitle(f"ampel.t{p['tier']}.{p['name']}")
+            setproctitle.setproctitle(f"ampel.reader.{ring}")
         except Exception:
             ...
 
-        from ampel.alert.AlertConsumer import AlertConsumer
+        from ampel.ztf.t0.load.UWAlertLoader import UWAlertLoader
+
+        # resolve resource references in the loader config
+        context = AmpelContext.load(config=config, vault=secrets, freeze_config=True)
+        cast(
+            UWAlertLoader,
+            context.loader.new(
+                UnitModel(unit="UWAlertLoader", config=loader | {"commit_after_push": True, "prefetch": 0})
+            ),
+        ).serve(ring, slots=slots, slot_size=slot_size, affinity=affinity)
+
+        return True
+
+    @staticmethod
+    @concurrent.process(timeout=60)
+    def run_mp_process(
+        config: dict[str, Any],
+        secrets: None | AmpelVault,
+        p: dict[str, Any],
+        launched: None | float = None,
+    ) -> bool:
 
         # Create new context with frozen config
         context = AmpelContext.load(
             config=config, vault=secrets, freeze_config=True,
         )
 
+        return ZTFAlertStreamController._run_processor(context, p, launched, "cold")
+
+    @staticmethod
+    def setup_warm_process(config: dict[str, Any]) -> AmpelConfig:
+        """
+        Runs once in the template process of warm_start
+        """
+        return AmpelConfig(config, freeze=True)
+
+    @staticmethod
+    def run_warm_process(
+        config: AmpelConfig,
+        secrets: None | AmpelVault,
+        p: dict[str, Any],
+        launched: None | float = None,
+    ) -> bool:
+
+        from ampel.core.AmpelDB import AmpelDB
+        from ampel.core.UnitLoader import UnitLoader
+
+        # DB clients are created after fork, as in AmpelContext.load
+        vault = secrets or AmpelVault([])
+        db = AmpelDB.new(config, vault)
+        context = AmpelContext(
+            config=config, db=db, loader=UnitLoader(config=config, db=db, vault=vault)
+        )
+
+        return ZTFAlertStreamController._run_processor(context, p, launched, "warm")
+
+    @staticmethod
+    def _run_processor(
+        context: AmpelContext,
+        p: dict[str, Any],
+        launched: None | float,
+        mode: str,
+    ) -> bool:
+
+        try:
+            import setproctitle # type: ignore
+            setproctitle.setproctitle(f"ampel.t{p['tier']}.{p['name']}")
+        except Exception:
+            ...
+
+        from ampel.alert.AlertConsumer import AlertConsumer
+
         processor = context.loader.new_context_unit(
             model=UnitModel(**p["processor"]),
             context=context,
@@ -186,6 +504,12 @@ class ZTFAlertStreamController(AbsProcessController):
             process_name = p["name"],
         )
 
+        if launched is not None:
+            # only iterated, and passed through otherwise
+            processor.alert_supplier = _StartupTimer(  # type: ignore[assignment]
+                processor.alert_supplier, launched, mode
+            )
+
         processor.run()
 
         return True
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/t0/load/AlertLatency.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+import threading
+import time
+from typing import ClassVar
+
+import confluent_kafka
+
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+from ampel.ztf.t0.load.PushWatermark import PushWatermark
+
+
+class AlertLatency:
+    """
+    Per-stage latency of alerts, from creation of the Kafka message to the
+    DB push that contains the result of processing it. Exported as the
+    histogram ampel_ztf_alert_latency_seconds with label stage:
+
+    - queue: message creation until the loader hands it out
+    - decode: avro decoding
+    - process: supplier hands out the alert until the next one is requested (filter and ingest)
+    - mux: ZiMongoMuxer.process
+    - flush: DBUpdatesBuffer.push_updates
+    - total: message creation until the end of the push following its processing
+
+    A message counts as processed once the loader is asked for the next one,
+    the same point at which its Kafka offset is marked. Tracking is enabled
+    per process by UWAlertLoader(track_latency=True); the total stage requires
+    a muxer that installs the push hook (ZiMongoMuxer). Until the hook is
+    installed, processed messages are not kept for it.
+    """
+
+    enabled: ClassVar[bool] = False
+    _instance: ClassVar["None | AlertLatency"] = None
+
+    @classmethod
+    def instance(cls) -> "AlertLatency":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def enable(cls) -> "AlertLatency":
+        instance = cls.instance()
+        if not cls.enabled:
+            cls.enabled = True
+            PushWatermark.register(instance)
+        return instance
+
+    def __init__(self) -> None:
+        self._histogram = AmpelMetricsRegistry.histogram(
+            "alert_latency",
+            "Time spent by alerts in each processing stage",
+            unit="seconds",
+            subsystem="ztf",
+            labelnames=("stage",),
+            buckets=(
+                0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60,
+                300, 600, 1800, 3600, 7200, 21600, 86400, float("inf"),
+            ),
+        )
+        self._lock = threading.Lock()
+        # creation times of messages handed out but not yet processed, and of processed ones
+        self._current: None | float = None
+        self._done: list[float] = []
+        self._supplied: None | float = None
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self._histogram.labels(stage).observe(seconds)
+
+    def on_consume(self, message: None | confluent_kafka.Message) -> None:
+        """
+        Loader hands out a message, or None at the end of the stream.
+        The previous message is done.
+        """
+        created = None
+        if message is not None:
+            kind, ts = message.timestamp()
+            if kind == confluent_kafka.TIMESTAMP_CREATE_TIME:
+                created = ts / 1000
+                self.observe("queue", time.time() - created)
+        with self._lock:
+            # without the push hook, nothing would ever consume _done
+            if self._current is not None and PushWatermark.installed():
+                self._done.append(self._current)
+            self._current = created
+
+    def on_request(self) -> None:
+        """
+        Supplier is asked for the next alert
+        """
+        if self._supplied is not None:
+            self.observe("process", time.perf_counter() - self._supplied)
+            self._supplied = None
+
+    def on_supply(self) -> None:
+        """
+        Supplier hands out an alert
+        """
+        self._supplied = time.perf_counter()
+
+    def pending(self) -> tuple[int, float]:
+        """
+        Snapshot before a push (see :class:`PushWatermark`)
+        """
+        with self._lock:
+            return len(self._done), time.perf_counter()
+
+    def commit(self, snapshot: tuple[int, float]) -> None:
+        """
+        The push started at snapshot succeeded
+        """
+        count, start = snapshot
+        self.observe("flush", time.perf_counter() - start)
+        with self._lock:
+            done, self._done = self._done[:count], self._done[count:]
+        now = time.time()
+        histogram = self._histogram.labels("total")
+        for created in done:
+            histogram.observe(now - created)
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/t0/load/AlertRing.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+import logging
+import os
+import queue
+import tempfile
+import threading
+from collections import deque
+from collections.abc import Callable, Iterator
+from multiprocessing import resource_tracker  # type: ignore[attr-defined]
+from multiprocessing.connection import Client, Connection, Listener, wait
+from multiprocessing.shared_memory import SharedMemory
+
+import confluent_kafka
+
+from ampel.ztf.t0.load.AllConsumingConsumer import AllConsumingConsumer
+
+log = logging.getLogger(__name__)
+
+#: slot index, payload length (or the payload itself for slot -1), topic, partition, offset, affinity key
+Item = tuple[int, int | bytes, str, int, int, None | int]
+
+# shared memory blocks created by writers in this process
+_created: set[str] = set()
+
+
+def ring_address(name: str) -> tuple[str, str]:
+    """
+    :returns: name of the shared memory block and path of the control socket of a ring
+    """
+    return f"ampel-ring-{name}", os.path.join(tempfile.gettempdir(), f"ampel-ring-{name}.sock")
+
+
+class AlertRingWriter:
+    """
+    Distribute Kafka messages from a single consumer to any number of
+    worker processes (see :class:`SharedRingAlertLoader`).
+
+    Payloads are copied into fixed-size slots of a shared memory block; only
+    slot indices travel over the control socket. Payloads larger than a slot
+    are sent over the socket instead. A worker requests the next alert once
+    it has processed the previous one, which frees the slot. It acknowledges
+    alerts separately, either with the request or once they were written to
+    the database (see :class:`SharedRingAlertLoader`). Offsets are stored up
+    to the first unacknowledged message of each partition, so that the
+    stored offsets never pass an alert that is still being processed.
+    Unacknowledged alerts of a worker that disconnects are handed to the
+    next worker. Once the consumer is exhausted, idle workers are told to
+    stop, and the writer returns when all alerts were acknowledged.
+
+    With an affinity function, all alerts with the same key (e.g. the stock
+    id) go to the same worker: a key is assigned to worker key % n, where n
+    is the number of connected workers, and stays there as long as the
+    worker holds alerts of that key, also when workers come or go. Alerts
+    without a key go to any worker. A worker that falls behind holds on to
+    its slots, so it eventually stalls the others.
+    """
+
+    def __init__(
+        self,
+        consumer: AllConsumingConsumer,
+        name: str,
+        slots: int = 256,
+        slot_size: int = 1 << 20,
+        batch_size: int = 100,
+        affinity: None | Callable[[bytes], None | int] = None,
+    ) -> None:
+        """
+        :param consumer: consumer with auto_commit=False
+        :param name: name of the ring, shared with the workers
+        :param affinity: function that returns the routing key of a payload
+        """
+        self._consumer = consumer
+        self._affinity = affinity
+        self._slot_size = slot_size
+        self._batch_size = batch_size
+        shm_name, self._address = ring_address(name)
+        try:
+            self._shm = SharedMemory(shm_name, create=True, size=slots * slot_size)
+        except FileExistsError:
+            # left behind by a reader that crashed
+            stale = SharedMemory(shm_name)
+            stale.close()
+            stale.unlink()
+            self._shm = SharedMemory(shm_name, create=True, size=slots * slot_size)
+        _created.add(shm_name)
+        if os.path.exists(self._address):
+            os.unlink(self._address)
+        self._listener = Listener(self._address, family="AF_UNIX")
+        os.chmod(self._address, 0o600)
+
+        self._free: queue.Queue[int] = queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._ready: queue.Queue[None | Item] = queue.Queue()
+        self._stop = threading.Event()
+        self._new: list[Connection] = []
+        self._lock = threading.Lock()
+        # delivered but not yet acknowledged offsets, by partition, in delivery order
+        self._inflight: dict[tuple[str, int], deque[int]] = {}
+        self._acked: set[tuple[str, int, int]] = set()
+        # payloads of unacknowledged messages, to deliver again after their slot was freed
+        self._payloads: dict[tuple[str, int, int], bytes] = {}
+
+    def run(self) -> None:
+        """
+        Serve workers until the consumer times out and all alerts were acknowledged
+        """
+        threads = [
+            threading.Thread(target=self._fill, name="ring-fill", daemon=True),
+            threading.Thread(target=self._accept, name="ring-accept", daemon=True),
+        ]
+        for t in threads:
+            t.start()
+        try:
+            self._serve()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._listener.close()
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            ...
+        _created.discard(self._shm.name)
+
+    def _serve(self) -> None:
+        conns: list[Connection] = []
+        current: dict[Connection, None | Item] = {}
+        # processed by each worker but not yet acknowledged, in delivery order,
+        # and the number of alerts each worker acknowledged so far
+        delivered: dict[Connection, deque[Item]] = {}
+        acked: dict[Connection, int] = {}
+        # workers that were told to stop
+        finished: set[Connection] = set()
+        waiting: deque[Connection] = deque()
+        retry: deque[Item] = deque()
+        # with affinity: alerts assigned to each worker, and the worker each
+        # key is assigned to along with the number of its alerts held there
+        assigned: dict[Connection, deque[Item]] = {}
+        pinned: dict[int, tuple[Connection, int]] = {}
+        exhausted = False
+
+        while True:
+            with self._lock:
+                for conn in self._new:
+                    conns.append(conn)
+                    current[conn] = None
+                    assigned[conn] = deque()
+                    delivered[conn] = deque()
+                    acked[conn] = 0
+                self._new.clear()
+
+            for conn in wait(conns, timeout=0.1):  # type: ignore[assignment]
+                try:
+                    # number of alerts acknowledged, and whether the next one is requested
+                    count, request = conn.recv()
+                except (EOFError, OSError):
+                    # worker is gone; hand its unacknowledged alerts to someone else
+                    conns.remove(conn)
+                    finished.discard(conn)
+                    if conn in waiting:
+                        waiting.remove(conn)
+                    lost = assigned.pop(conn)
+                    if (item := current.pop(conn)) is not None:
+                        lost.appendleft(item)
+                    for item in lost:
+                        self._unpin(pinned, item)
+                    # processed, but maybe not written to the database
+                    retry.extend(self._inline(item) for item in delivered.pop(conn))
+                    retry.extend(lost)
+                    del acked[conn]
+                    continue
+                if request and (item := current[conn]) is not None:
+                    self._release(item)
+                    self._unpin(pinned, item)
+                    delivered[conn].append(item)
+                    current[conn] = None
+                for _ in range(count - acked[conn]):
+                    self._ack(delivered[conn].popleft())
+                acked[conn] = count
+                if request:
+                    waiting.append(conn)
+
+            if self._affinity is not None and conns:
+                # assign alerts as soon as they are ready, so that later
+                # alerts of a key queue up behind earlier ones
+                routable, retry = retry, deque()
+                while not exhausted:
+                    try:
+                        if (next_item := self._ready.get_nowait()) is None:
+                            exhausted = True
+                        else:
+                            routable.append(next_item)
+                    except queue.Empty:
+                        break
+                for item in routable:
+                    if (key := item[5]) is None:
+                        retry.append(item)
+                        continue
+                    conn, count = pinned.get(key) or (conns[key % len(conns)], 0)
+                    pinned[key] = (conn, count + 1)
+                    assigned[conn].append(item)
+
+            for conn in list(waiting):
+                if assigned[conn]:
+                    item = assigned[conn].popleft()
+                elif retry:
+                    item = retry.popleft()
+                elif exhausted:
+                    # nothing left for this worker. Keep the connection for
+                    # its acknowledgements, which may follow later.
+                    waiting.remove(conn)
+                    finished.add(conn)
+                    conn.send(None)
+                    continue
+                elif self._affinity is not None:
+                    continue
+                else:
+                    try:
+                        if (next_item := self._ready.get_nowait()) is None:
+                            exhausted = True
+                            continue
+                        item = next_item
+                    except queue.Empty:
+                        break
+                waiting.remove(conn)
+                # byte offset and length, or -1 and the payload itself
+                conn.send((item[0] * self._slot_size if item[0] >= 0 else -1, item[1]))
+                current[conn] = item
+
+            if (
+                exhausted
+                and not any(current.values())
+                and not any(assigned.values())
+                and not any(delivered.values())
+                # alerts of a worker that died late can only go to workers that have not stopped
+                and (not retry or finished.issuperset(conns))
+            ):
+                if retry:
+                    log.warning(f"{len(retry)} alerts were not acknowledged; their offsets are not stored")
+                for conn in conns:
+                    conn.close()
+                return
+
+    @staticmethod
+    def _unpin(pinned: dict[int, tuple[Connection, int]], item: Item) -> None:
+        if (key := item[5]) is not None and key in pinned:
+            conn, count = pinned[key]
+            if count > 1:
+                pinned[key] = (conn, count - 1)
+            else:
+                del pinned[key]
+
+    def _release(self, item: Item) -> None:
+        """
+        Free the slot of a processed alert
+        """
+        if item[0] >= 0:
+            self._free.put(item[0])
+
+    def _inline(self, item: Item) -> Item:
+        """
+        Alert to deliver again after its slot was freed, with the payload sent over the socket
+        """
+        _, _, topic, partition, offset, key = item
+        return -1, self._payloads[(topic, partition, offset)], topic, partition, offset, key
+
+    def _ack(self, item: Item) -> None:
+        _, _, topic, partition, offset, _ = item
+        del self._payloads[(topic, partition, offset)]
+        key = (topic, partition)
+        inflight = self._inflight[key]
+        self._acked.add((topic, partition, offset))
+        done = None
+        while inflight and (topic, partition, inflight[0]) in self._acked:
+            done = inflight.popleft()
+            self._acked.discard((topic, partition, done))
+        if done is not None:
+            try:
+                self._consumer.commit({key: done})
+            except confluent_kafka.KafkaException as exc:
+                # partition was revoked in the meantime
+                log.warning(f"Failed to store offset {done} for {key}: {exc}")
+
+    def _accept(self) -> None:
+        while not self._stop.is_set():
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._new.append(conn)
+
+    def _fill(self) -> None:
+        try:
+            while not self._stop.is_set():
+                if not (
+                    messages := self._consumer.fetch_batch(
+                        self._batch_size, interrupted=self._stop.is_set
+                    )
+                ):
+                    break
+                for message in messages:
+                    self._ready.put(self._write(message))
+        finally:
+            self._ready.put(None)
+
+    def _write(self, message: confluent_kafka.Message) -> Item:
+        payload = message.value()
+        key = (message.topic(), message.partition())
+        self._inflight.setdefault(key, deque()).append(message.offset())
+        self._payloads[(*key, message.offset())] = payload
+        affinity = self._affinity(payload) if self._affinity else None
+        if len(payload) > self._slot_size:
+            return -1, payload, *key, message.offset(), affinity
+        while True:
+            try:
+                slot = self._free.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self._stop.is_set():
+                    raise
+        start = slot * self._slot_size
+        self._shm.buf[start:start + len(payload)] = payload
+        return slot, len(payload), *key, message.offset(), affinity
+
+
+class AlertRingReader:
+    """
+    Worker side of :class:`AlertRingWriter`
+
+    :param deferred_ack: acknowledge payloads only through ack() rather than
+      when the next one is requested. The connection then stays open after
+      the last payload, for the final acknowledgement.
+    """
+
+    def __init__(self, name: str, deferred_ack: bool = False) -> None:
+        shm_name, address = ring_address(name)
+        self._conn = Client(address, family="AF_UNIX")
+        self._shm = SharedMemory(shm_name)
+        if shm_name not in _created:
+            # the block belongs to the writer. Python < 3.13 would unlink it when this process exits.
+            resource_tracker.unregister(self._shm._name, "shared_memory")  # type: ignore[attr-defined]
+        self._deferred = deferred_ack
+        # ack() may be called from a different thread
+        self._lock = threading.Lock()
+        self._received = 0
+        self._acked = 0
+        #: number of payloads processed, i.e. followed by a request for the next one
+        self.done = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        """
+        Request the next payload, acknowledging the previous one unless
+        acknowledgements are deferred
+        """
+        self.done = self._received
+        try:
+            with self._lock:
+                if not self._deferred:
+                    self._acked = self.done
+                self._conn.send((self._acked, True))
+            reply = self._conn.recv()
+        except (EOFError, OSError):
+            reply = None
+        if reply is None:
+            if not self._deferred:
+                self.close()
+            raise StopIteration
+        self._received += 1
+        start, size = reply
+        if start < 0:
+            return size
+        return bytes(self._shm.buf[start:start + size])
+
+    def ack(self, done: int) -> None:
+        """
+        Acknowledge the first `done` payloads
+        """
+        with self._lock:
+            if done <= self._acked:
+                return
+            self._acked = done
+            try:
+                self._conn.send((done, False))
+            except OSError:
+                # the writer is gone, and the payloads will be delivered again
+                ...
+
+    def close(self) -> None:
+        self._conn.close()
+        self._shm.close()
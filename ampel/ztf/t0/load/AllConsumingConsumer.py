@@ -7,20 +7,48 @@
 # Last Modified Date:  14.11.2018
 # Last Modified By:    valery brinnel <firstname.lastname@gmail.com>
 
+import datetime
 import enum
 import json
+import logging
+import re
 import sys
+import threading
 import time
 import uuid
+import weakref
+from collections.abc import Callable, Iterator
+from typing import TYPE_CHECKING, Any
 
 import confluent_kafka
 
 from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
 
+if TYPE_CHECKING:
+    from ampel.ztf.t0.load.ReplayConsumer import ReplayConsumer
+
+log = logging.getLogger(__name__)
+
 
 class KafkaMetrics:
+    """
+    Consumer metrics, partly derived from librdkafka statistics
+    (see https://github.com/edenhill/librdkafka/blob/master/STATISTICS.md).
+
+    Partition statistics are summed per topic over the partitions assigned
+    to this process, and the gauges are created in livesum mode, so that
+    e.g. sum(ampel_kafka_consumer_lag) without (topic) is the total lag of
+    all consumers. Topics that are no longer assigned report 0.
+    """
+
     _instance = None
 
+    #: summed over the assigned partitions of a topic
+    TOPIC_STATS = ("fetchq_cnt", "fetchq_size", "consumer_lag", "msgs_inflight")
+    #: upper bound on the fraction of time spent handling statistics. If
+    #: parsing takes longer, statistics are skipped until enough time has passed.
+    max_overhead = 0.01
+
     @classmethod
     def instance(cls):
         if cls._instance is None:
@@ -29,30 +57,52 @@ class KafkaMetrics:
 
     def __init__(self):
         self._metrics = {
-            # metrics relevant for read performance
-            # see: https://github.com/edenhill/librdkafka/blob/master/STATISTICS.md
-            # the most important of these is consumer_lag. to get an accurate count
-            # from N balanced consumers running in separate processes, we have to:
-            # - label by topic and partition (toppar)
-            # - set gauge to -1 if this client is not assigned to the toppar
-            # - create gauge in max mode (taking aggregated value for each toppar from the assigned process only)
-            # - query sum(ampel_kafka_consumer_lag != -1) without (partition,topic)
             k: AmpelMetricsRegistry.gauge(
                 k,
                 "",
                 subsystem="kafka",
-                labelnames=("topic", "partition"),
-                multiprocess_mode="max",
-            )
-            for k in (
-                "fetchq_cnt",
-                "fetchq_size",
-                "consumer_lag",
-                "rxmsgs",
-                "rxbytes",
-                "msgs_inflight",
+                labelnames=("topic",),
+                multiprocess_mode="livesum",
             )
+            for k in self.TOPIC_STATS
         }
+        for k, what in ("messages", "messages"), ("bytes", "bytes"):
+            self._metrics[f"received_{k}"] = AmpelMetricsRegistry.gauge(
+                f"received_{k}",
+                f"Rate of {what} fetched from the broker",
+                unit="per_second",
+                subsystem="kafka",
+                labelnames=("topic",),
+                multiprocess_mode="livesum",
+            )
+        self._metrics["broker_rtt"] = AmpelMetricsRegistry.gauge(
+            "broker_rtt",
+            "Round-trip time of requests to the broker. Fetch requests include the time the broker waits for data.",
+            unit="seconds",
+            subsystem="kafka",
+            labelnames=("broker", "quantile"),
+            multiprocess_mode="max",
+        )
+        self._metrics["broker_throttle"] = AmpelMetricsRegistry.gauge(
+            "broker_throttle",
+            "Average time requests were throttled by the broker",
+            unit="seconds",
+            subsystem="kafka",
+            labelnames=("broker",),
+            multiprocess_mode="max",
+        )
+        self._metrics["fetch_wait"] = AmpelMetricsRegistry.counter(
+            "fetch_wait",
+            "Time spent waiting for messages in poll or consume",
+            unit="seconds",
+            subsystem="kafka",
+        )
+        self._metrics["statistics_time"] = AmpelMetricsRegistry.counter(
+            "statistics_time",
+            "Time spent handling librdkafka statistics",
+            unit="seconds",
+            subsystem="kafka",
+        )
         for action in "created", "consumed":
             self._metrics[f"last_message_{action}"] = AmpelMetricsRegistry.gauge(
                 f"last_message_{action}",
@@ -61,16 +111,84 @@ class KafkaMetrics:
                 subsystem="kafka",
                 multiprocess_mode="max",
             )
+        self._metrics["prefetch_queue_depth"] = AmpelMetricsRegistry.gauge(
+            "prefetch_queue_depth",
+            "Number of messages fetched ahead of the consumer",
+            subsystem="kafka",
+            multiprocess_mode="livesum",
+        )
+        # monotonic time before which statistics are skipped
+        self._next_stats = 0.0
+        # per client: timestamp and rx counters of each partition at the
+        # last statistics, and the values last reported for each topic
+        self._received: dict[str, tuple[int, dict[tuple[str, int], tuple[int, int]]]] = {}
+        self._topics: dict[str, dict[str, dict[str, float]]] = {}
 
-    def on_stats_callback(self, payload):
-        for topic in json.loads(payload)["topics"].values():
-            for partition in topic["partitions"].values():
-                for k, v in partition.items():
-                    if metric := self._metrics.get(k):
-                        # only record value for assigned partitions (i.e. where desired is True)
-                        metric.labels(topic["topic"], partition["partition"]).set(
-                            v if partition["desired"] else -1
-                        )
+    def on_stats_callback(self, payload, assigned=None):
+        """
+        :param assigned: (topic, partition) pairs assigned to the consumer.
+          If None, use the partitions librdkafka reports as desired.
+        """
+        start = time.monotonic()
+        if start < self._next_stats:
+            return
+        stats = json.loads(payload)
+        client = stats.get("name", "")
+        topics = stats.get("topics", {})
+        if assigned is None:
+            assigned = [
+                (topic["topic"], partition["partition"])
+                for topic in topics.values()
+                for partition in topic["partitions"].values()
+                if partition["desired"] and partition["partition"] >= 0
+            ]
+
+        ts, previous = self._received.get(client, (None, {}))
+        dt = (stats["ts"] - ts) / 1e6 if ts is not None and stats.get("ts", 0) > ts else None
+        received = {}
+        values: dict[str, dict[str, float]] = {}
+        for key in assigned:
+            if (partition := topics.get(key[0], {}).get("partitions", {}).get(str(key[1]))) is None:
+                continue
+            if (topic := values.get(key[0])) is None:
+                topic = values[key[0]] = dict.fromkeys(
+                    self.TOPIC_STATS + (("received_messages", "received_bytes") if dt else ()), 0.
+                )
+            for k in self.TOPIC_STATS:
+                # librdkafka reports -1 if unknown
+                topic[k] += max(partition.get(k, 0), 0)
+            received[key] = (partition.get("rxmsgs", 0), partition.get("rxbytes", 0))
+            # partitions assigned since the last statistics have no baseline
+            if dt and (last := previous.get(key)) and received[key][0] >= last[0]:
+                topic["received_messages"] += (received[key][0] - last[0]) / dt
+                topic["received_bytes"] += (received[key][1] - last[1]) / dt
+        if "ts" in stats:
+            self._received[client] = (stats["ts"], received)
+
+        reported = self._topics.get(client, {})
+        self._topics[client] = values
+        for name in reported.keys() | values.keys():
+            for k in reported.get(name, {}).keys() | values.get(name, {}).keys():
+                self._metrics[k].labels(name).set(
+                    sum(v[name].get(k, 0) for v in self._topics.values() if name in v)
+                )
+
+        for broker in stats.get("brokers", {}).values():
+            if broker.get("nodeid", -1) < 0:
+                # bootstrap servers and coordinator placeholders
+                continue
+            if (rtt := broker.get("rtt", {})).get("cnt"):
+                for q, k in ("0.5", "p50"), ("0.99", "p99"):
+                    self._metrics["broker_rtt"].labels(broker["nodename"], q).set(rtt[k] / 1e6)
+            if (throttle := broker.get("throttle", {})).get("cnt"):
+                self._metrics["broker_throttle"].labels(broker["nodename"]).set(throttle["avg"] / 1e6)
+
+        elapsed = time.monotonic() - start
+        self._metrics["statistics_time"].inc(elapsed)
+        self._next_stats = start + elapsed / self.max_overhead
+
+    def on_fetch_wait(self, seconds):
+        self._metrics["fetch_wait"].inc(seconds)
 
     def on_consume(self, message):
         kind, ts = message.timestamp()
@@ -78,6 +196,21 @@ class KafkaMetrics:
             self._metrics["last_message_created"].set(ts / 1000)
         self._metrics["last_message_consumed"].set(time.time())
 
+    def on_consume_batch(self, messages):
+        # messages arrive in partition order, so the newest creation time
+        # may be anywhere in the batch
+        created = [
+            ts
+            for kind, ts in (message.timestamp() for message in messages)
+            if kind == confluent_kafka.TIMESTAMP_CREATE_TIME
+        ]
+        if created:
+            self._metrics["last_message_created"].set(max(created) / 1000)
+        self._metrics["last_message_consumed"].set(time.time())
+
+    def on_prefetch(self, depth):
+        self._metrics["prefetch_queue_depth"].set(depth)
+
 
 KafkaErrorCode = enum.IntEnum(  # type: ignore[misc]
     "KafkaErrorCode",
@@ -100,6 +233,7 @@ class KafkaError(RuntimeError):
 class AllConsumingConsumer:
     """
     Consume messages on all topics beginning with 'ztf_'.
+    A file:// broker URL replays alerts from disk, see :class:`ReplayConsumer`.
     """
 
     def __init__(
@@ -108,9 +242,33 @@ class AllConsumingConsumer:
         timeout=None,
         topics=["^ztf_.*"],
         auto_commit=True,
-        **consumer_config,
+        start_time: None | float = None,
+        end_time: None | float = None,
+        retire_topics_after: None | float = None,
+        **consumer_config: Any,
     ):
-        """ """
+        """
+        :param start_time: unix timestamp. Partitions without a committed offset
+          start at the first message created at or after this time. Requires
+          a Kafka broker.
+        :param end_time: unix timestamp. Partitions are paused at the first message
+          created after this time, and consumption ends once all assigned
+          partitions have passed it. Requires a Kafka broker.
+        :param retire_topics_after: age in days of nightly topics (ztf_YYYYMMDD_*)
+          after which they are dropped from the subscription once drained. The
+          topic patterns are then resolved to an explicit topic list, refreshed
+          on a background thread every second while tonight's topic has not
+          appeared yet, and every minute otherwise. Requires a Kafka broker.
+        """
+        if broker.startswith("file://"):
+            # ReplayConsumer has no partition assignment to seek or retire
+            for name, value in (
+                ("start_time", start_time),
+                ("end_time", end_time),
+                ("retire_topics_after", retire_topics_after),
+            ):
+                if value is not None:
+                    raise ValueError(f"{name} requires a Kafka broker")
 
         self._metrics = KafkaMetrics.instance()
         config = {
@@ -124,13 +282,55 @@ class AllConsumingConsumer:
             "enable.partition.eof": False,  # don't emit messages on EOF
             "topic.metadata.refresh.interval.ms": 1000,  # fetch new metadata every second to pick up topics quickly
             # "debug": "all",
-            "stats_cb": self._metrics.on_stats_callback,
+            "stats_cb": lambda payload: self._metrics.on_stats_callback(payload, self._assigned),
             "statistics.interval.ms": 10000,
         }
+        if end_time is not None or retire_topics_after is not None:
+            # needed to tell quiet partitions from slow ones
+            config["enable.partition.eof"] = True
+        if retire_topics_after is not None:
+            # topics are discovered by _refresh_topics()
+            config["topic.metadata.refresh.interval.ms"] = 60000
         config.update(**consumer_config)
-        self._consumer = confluent_kafka.Consumer(**config)
+        self._consumer: confluent_kafka.Consumer | ReplayConsumer
+        if broker.startswith("file://"):
+            # replay alerts from disk, see ReplayConsumer
+            from ampel.ztf.t0.load.ReplayConsumer import ReplayConsumer
+
+            self._consumer = ReplayConsumer.from_url(broker, **config)
+        else:
+            self._consumer = confluent_kafka.Consumer(**config)
+
+        self._start_time = start_time
+        # partitions are added to (not replacing) the assignment in on_assign
+        self._cooperative = "cooperative" in str(config.get("partition.assignment.strategy", ""))
+        self._end_time = None if end_time is None else int(end_time * 1000)
+        self._assigned: set[tuple[str, int]] = set()
+        self._finished: set[tuple[str, int]] = set()
+        self._eof: set[tuple[str, int]] = set()
+        self._track_eof = config["enable.partition.eof"]
 
-        self._consumer.subscribe(topics)
+        self._retire_after = retire_topics_after
+        self._patterns = [
+            re.compile(t) if t.startswith("^") else re.compile(re.escape(t) + "$")
+            for t in topics
+        ]
+        self._subscription: list[str] = []
+        # topics to subscribe to, updated by _refresh_topics()
+        self._wanted: list[str] = topics
+        self._retired: set[str] = set()
+        self._next_retirement = 0.0
+        self._stop_refresh = threading.Event()
+        if retire_topics_after is not None:
+            # resolve the patterns once, then keep the list current in the background
+            threading.Thread(
+                target=self._watch_topics,
+                args=(weakref.ref(self), self._stop_refresh, self._refresh_topics()),
+                name="kafka-topics",
+                daemon=True,
+            ).start()
+        self._subscribe(self._wanted)
+        self._poll_interval: float
         if timeout is None:
             self._poll_interval = 1
             self._poll_attempts = sys.maxsize
@@ -139,9 +339,204 @@ class AllConsumingConsumer:
             self._poll_attempts = max((1, int(timeout / self._poll_interval)))
         self._timeout = timeout
 
-        self._offsets = {}
+        self._offsets: dict[tuple[str, int], int] = {}
+        # raised by the next fetch_batch()
+        self._error: None | KafkaError = None
+        self._lock = threading.Lock()
         self._auto_commit = auto_commit
 
+    def _subscribe(self, topics):
+        self._subscription = topics
+        if not topics:
+            # librdkafka rejects an empty subscription
+            self._consumer.unsubscribe()
+            return
+        self._consumer.subscribe(
+            topics, on_assign=self._on_assign, on_revoke=self._on_revoke, on_lost=self._on_revoke
+        )
+
+    @staticmethod
+    def _watch_topics(
+        ref: "weakref.ref[AllConsumingConsumer]", stop: threading.Event, delay: float
+    ) -> None:
+        """
+        Refresh the topic list until stopped or the consumer is gone, keeping
+        the broker round trips out of the consuming thread
+        """
+        while not stop.wait(delay):
+            if (consumer := ref()) is None:
+                return
+            try:
+                delay = consumer._refresh_topics()
+            except confluent_kafka.KafkaException as exc:
+                log.warning(f"Failed to refresh topics: {exc}")
+            del consumer
+
+    def _apply_topics(self) -> None:
+        """
+        Subscribe to the topics found by the last refresh, if they changed
+        """
+        if (topics := self._wanted) is not self._subscription:
+            self._subscribe(topics)
+
+    def _refresh_topics(self) -> float:
+        """
+        Resolve topic patterns to an explicit list, without retired topics.
+        The consuming thread subscribes to it in _apply_topics().
+
+        :returns: seconds until the next refresh
+        """
+        # not a ReplayConsumer, see __init__
+        kafka: confluent_kafka.Consumer = self._consumer
+        now = datetime.datetime.now(datetime.timezone.utc)
+        metadata = {
+            name: topic for name, topic in kafka.list_topics(timeout=10).topics.items()
+            if any(p.match(name) for p in self._patterns)
+        }
+        if time.monotonic() >= self._next_retirement:
+            self._next_retirement = time.monotonic() + 60
+            for name in metadata.keys() - self._retired:
+                if (
+                    (m := re.match(r"ztf_(\d{8})_", name))
+                    and now - datetime.datetime.strptime(m.group(1), "%Y%m%d").replace(tzinfo=datetime.timezone.utc)
+                    > datetime.timedelta(days=self._retire_after)  # type: ignore[arg-type]
+                    and self._drained(name, list(metadata[name].partitions))
+                ):
+                    self._retired.add(name)
+        if (topics := sorted(metadata.keys() - self._retired)) != self._wanted:
+            self._wanted = topics
+        # poll quickly for tonight's topic
+        tonight = now.strftime("ztf_%Y%m%d_")
+        return 60 if any(t.startswith(tonight) for t in topics) else 1
+
+    def _drained(self, topic: str, partitions: list[int]) -> bool:
+        """
+        True if all partitions of the topic were consumed to the end, either
+        by this consumer (EOF seen) or by the group (committed offset)
+        """
+        # updated concurrently by the consuming thread
+        eof = set(self._eof)
+        if not (
+            unknown := [
+                confluent_kafka.TopicPartition(topic, p)
+                for p in partitions if (topic, p) not in eof
+            ]
+        ):
+            return True
+        kafka: confluent_kafka.Consumer = self._consumer
+        for tp in kafka.committed(unknown, timeout=10):
+            low, high = kafka.get_watermark_offsets(tp, timeout=10)
+            if high > low and tp.offset < high:
+                return False
+        return True
+
+    @property
+    def retired_topics(self) -> set[str]:
+        return self._retired
+
+    def _on_assign(self, consumer, partitions):
+        """
+        Seek newly assigned partitions to start_time. Offsets set on the
+        partition list only take effect through an explicit assign(), so the
+        callback assigns the partitions itself in that case; otherwise the
+        client assigns them at their committed offsets once it returns.
+        """
+        self._assigned.update((tp.topic, tp.partition) for tp in partitions)
+        if self._start_time is None or not partitions:
+            return
+        committed = {
+            (tp.topic, tp.partition): tp.offset
+            for tp in consumer.committed(partitions, timeout=30)
+        }
+        if not (
+            fresh := [
+                tp for tp in partitions
+                if committed.get((tp.topic, tp.partition), -1) < 0
+            ]
+        ):
+            return
+        offsets = {
+            (tp.topic, tp.partition): tp.offset
+            for tp in consumer.offsets_for_times(
+                [
+                    confluent_kafka.TopicPartition(tp.topic, tp.partition, int(self._start_time * 1000))
+                    for tp in fresh
+                ],
+                timeout=30,
+            )
+        }
+        for tp in fresh:
+            # no message after start_time: start at the end
+            tp.offset = offsets.get((tp.topic, tp.partition), confluent_kafka.OFFSET_END)
+        if self._cooperative:
+            consumer.incremental_assign(partitions)
+        else:
+            consumer.assign(partitions)
+
+    @property
+    def exhausted(self) -> bool:
+        """
+        True if all assigned partitions have passed end_time
+        """
+        return bool(self._assigned) and self._assigned <= self._finished
+
+    def _finish_partition(self, message) -> None:
+        key = (message.topic(), message.partition())
+        if key not in self._finished:
+            self._finished.add(key)
+            self._consumer.pause([confluent_kafka.TopicPartition(*key)])
+
+    def _skip(self, message) -> bool:
+        """
+        Track partition EOF events and check a message against end_time,
+        retiring its partition if it is past.
+
+        :returns: True if the message should not be emitted
+        """
+        if not self._track_eof:
+            return False
+        key = (message.topic(), message.partition())
+        if err := message.error():
+            if err.code() != confluent_kafka.KafkaError._PARTITION_EOF:
+                return False
+            self._eof.add(key)
+            # quiet partitions are done once end_time has passed
+            if self._end_time is not None and time.time() * 1000 > self._end_time:
+                self._finish_partition(message)
+            return True
+        self._eof.discard(key)
+        if self._end_time is None:
+            return False
+        if key in self._finished:
+            return True
+        kind, ts = message.timestamp()
+        if kind != confluent_kafka.TIMESTAMP_NOT_AVAILABLE and ts > self._end_time:
+            self._finish_partition(message)
+            return True
+        return False
+
+    def _on_revoke(self, consumer, partitions):
+        """
+        Commit stored offsets before partitions move to another group member,
+        so that it does not re-read them. With the cooperative-sticky assignor
+        only the partitions that actually move are revoked, and consumption of
+        the others continues during the rebalance.
+        """
+        revoked = {(tp.topic, tp.partition) for tp in partitions}
+        self._assigned -= revoked
+        self._finished -= revoked
+        self._eof -= revoked
+        with self._lock:
+            # marks for revoked partitions can no longer be stored
+            for k in revoked.intersection(self._offsets):
+                del self._offsets[k]
+        try:
+            consumer.commit(asynchronous=False)
+        except confluent_kafka.KafkaException as exc:
+            # nothing stored since the last commit
+            if exc.args[0].code() != confluent_kafka.KafkaError._NO_OFFSET:
+                raise
+
     def __next__(self):
         message = self.consume()
         if message is None:
@@ -152,14 +547,41 @@ class AllConsumingConsumer:
     def __iter__(self):
         return self
 
-    def commit(self):
-        if self._offsets:
-            offsets = [
-                confluent_kafka.TopicPartition(topic, partition, offset + 1)
-                for (topic, partition), offset in self._offsets.items()
-            ]
-            self._consumer.store_offsets(offsets=offsets)
-            self._offsets.clear()
+    def batches(self, max_messages: int = 500) -> Iterator[list[confluent_kafka.Message]]:
+        """
+        Yield lists of up to `max_messages` messages until timeout is reached.
+        """
+        while messages := self.consume_batch(max_messages):
+            yield messages
+
+    def pending(self) -> dict[tuple[str, int], int]:
+        """
+        Offsets marked for committal but not yet stored
+        """
+        with self._lock:
+            return dict(self._offsets)
+
+    def commit(self, offsets: None | dict[tuple[str, int], int] = None) -> None:
+        """
+        Store offsets marked for committal.
+
+        :param offsets: store only these offsets (as returned by pending()),
+          keeping later marks. May be called from a different thread.
+        """
+        with self._lock:
+            if offsets is None:
+                offsets, self._offsets = self._offsets, {}
+            else:
+                for k, v in offsets.items():
+                    if self._offsets.get(k) == v:
+                        del self._offsets[k]
+        if offsets:
+            self._consumer.store_offsets(
+                offsets=[
+                    confluent_kafka.TopicPartition(topic, partition, offset + 1)
+                    for (topic, partition), offset in offsets.items()
+                ]
+            )
 
     def consume(self) -> None | confluent_kafka.Message:
         """
@@ -174,9 +596,17 @@ class AllConsumingConsumer:
 
         message = None
         for _ in range(self._poll_attempts):
+            if self.exhausted:
+                return None
+            self._apply_topics()
             # wake up occasionally to catch SIGINT
+            wait = time.monotonic()
             message = self._consumer.poll(self._poll_interval)
+            self._metrics.on_fetch_wait(time.monotonic() - wait)
             if message is not None:
+                if self._skip(message):
+                    message = None
+                    continue
                 if err := message.error():
                     if err.code() == confluent_kafka.KafkaError.UNKNOWN_TOPIC_OR_PART:
                         # ignore unknown topic messages
@@ -194,6 +624,105 @@ class AllConsumingConsumer:
         elif message.error():
             raise KafkaError(message.error())
         else:
-            self._offsets[(message.topic(), message.partition())] = message.offset()
+            with self._lock:
+                self._offsets[(message.topic(), message.partition())] = message.offset()
             self._metrics.on_consume(message)
             return message
+
+    def consume_batch(
+        self, max_messages: int = 500, timeout: None | float = None
+    ) -> list[confluent_kafka.Message]:
+        """
+        Block until at least one message has arrived, and return up to
+        `max_messages` messages.
+
+        :param timeout: time to wait for messages, in seconds. If None, wait
+          as long as consume() would.
+
+        As with consume(), messages returned to the caller are marked for
+        committal upon the _next_ call to consume_batch().
+        An empty list is returned on timeout.
+        """
+        if self._auto_commit:
+            self.commit()
+        messages = self.fetch_batch(max_messages, timeout)
+        self.mark(messages)
+        return messages
+
+    def fetch_batch(
+        self,
+        max_messages: int = 500,
+        timeout: None | float = None,
+        interrupted: None | Callable[[], bool] = None,
+    ) -> list[confluent_kafka.Message]:
+        """
+        Like consume_batch(), but neither commit previous messages nor mark
+        the returned ones for committal. This method may be called from a
+        different thread than mark() and commit().
+
+        :param interrupted: checked between poll attempts; return an empty
+          list if it returns True
+
+        A Kafka error in a batch that also contains messages is raised on
+        the next call, after the messages were returned.
+        """
+        if (pending := self._error) is not None:
+            self._error = None
+            raise pending
+        if timeout is None:
+            poll_interval, poll_attempts = self._poll_interval, self._poll_attempts
+        else:
+            poll_interval, poll_attempts = timeout, 1
+
+        messages: list[confluent_kafka.Message] = []
+        timed_out = False
+        error: None | KafkaError = None
+        for _ in range(poll_attempts):
+            if (interrupted is not None and interrupted()) or self.exhausted:
+                break
+            self._apply_topics()
+            # wake up occasionally to catch SIGINT
+            wait = time.monotonic()
+            batch = self._consumer.consume(max_messages, poll_interval)
+            self._metrics.on_fetch_wait(time.monotonic() - wait)
+            for message in batch:
+                if self._skip(message):
+                    continue
+                if err := message.error():
+                    if err.code() == confluent_kafka.KafkaError.UNKNOWN_TOPIC_OR_PART:
+                        # ignore unknown topic messages
+                        continue
+                    elif err.code() in (
+                        confluent_kafka.KafkaError._TIMED_OUT,
+                        confluent_kafka.KafkaError._MAX_POLL_EXCEEDED,
+                    ):
+                        # bail on timeouts, keeping what we already have
+                        timed_out = True
+                        break
+                    # keep the rest of the batch, and raise once it was handed out
+                    if error is None:
+                        error = KafkaError(err)
+                    continue
+                messages.append(message)
+            if error is not None and not messages:
+                raise error
+            if messages or timed_out:
+                break
+        self._error = error
+        return messages
+
+    def mark(self, messages: list[confluent_kafka.Message]) -> None:
+        """
+        Mark messages for committal upon the next call to commit()
+        """
+        if messages:
+            # messages are ordered within each partition, so the last
+            # message seen for a partition carries the highest offset
+            with self._lock:
+                self._offsets.update(
+                    {
+                        (message.topic(), message.partition()): message.offset()
+                        for message in messages
+                    }
+                )
+            self._metrics.on_consume_batch(messages)
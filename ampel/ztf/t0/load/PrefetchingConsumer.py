@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/t0/load/PrefetchingConsumer.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+import queue
+import threading
+from collections.abc import Iterator
+
+import confluent_kafka
+
+from ampel.ztf.t0.load.AllConsumingConsumer import AllConsumingConsumer, KafkaMetrics
+
+
+class PrefetchingConsumer:
+    """
+    Poll an AllConsumingConsumer on a background thread, so that waiting
+    for the broker overlaps with processing of the previous alerts.
+
+    Fetched messages are buffered in a queue of bounded depth. Offsets keep
+    the semantics of AllConsumingConsumer: a message is marked for committal
+    only when the caller requests the next one, i.e. once it has been
+    processed, and never while it sits in the queue.
+    """
+
+    def __init__(
+        self, consumer: AllConsumingConsumer, depth: int = 100, batch_size: int = 100
+    ) -> None:
+        """
+        :param depth: maximum number of messages to fetch ahead
+        :param batch_size: maximum number of messages to request from librdkafka at once
+        """
+        self._consumer = consumer
+        self._metrics = KafkaMetrics.instance()
+        self._batch_size = max(1, min(batch_size, depth))
+        self._queue: queue.Queue[
+            None | confluent_kafka.Message | Exception
+        ] = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._done = False
+        self._pending: list[confluent_kafka.Message] = []
+        self._thread = threading.Thread(target=self._run, name="kafka-prefetch", daemon=True)
+
+    def __iter__(self) -> Iterator[confluent_kafka.Message]:
+        return self
+
+    def __next__(self) -> confluent_kafka.Message:
+        if (message := self.consume()) is None:
+            raise StopIteration
+        return message
+
+    def batches(self, max_messages: int = 500) -> Iterator[list[confluent_kafka.Message]]:
+        """
+        Yield lists of up to `max_messages` messages until the consumer times out.
+        """
+        while messages := self.consume_batch(max_messages):
+            yield messages
+
+    def consume(self) -> None | confluent_kafka.Message:
+        """
+        Return the next message, or None if the consumer timed out.
+        The previously returned message is marked for committal.
+        """
+        batch = self.consume_batch(1)
+        return batch[0] if batch else None
+
+    def consume_batch(self, max_messages: int = 500) -> list[confluent_kafka.Message]:
+        """
+        Block until at least one message is available, and return up to
+        `max_messages` messages. The previously returned messages are marked
+        for committal. An empty list is returned when the consumer timed out.
+        """
+        self._finish()
+        if self._done:
+            return []
+        if self._thread.ident is None:
+            self._thread.start()
+        messages = []
+        item = self._queue.get()
+        while True:
+            if item is None:
+                self._done = True
+                break
+            if isinstance(item, Exception):
+                self._done = True
+                raise item
+            messages.append(item)
+            if len(messages) >= max_messages:
+                break
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._metrics.on_prefetch(self._queue.qsize())
+        self._pending = messages
+        return messages
+
+    def close(self) -> None:
+        """
+        Stop the background thread, discarding messages that were fetched
+        but not consumed. They will be delivered again after a restart.
+        """
+        self._stop.set()
+        self._done = True
+        if self._thread.ident is not None:
+            self._thread.join()
+        self._metrics.on_prefetch(0)
+
+    def _finish(self) -> None:
+        if self._pending:
+            self._consumer.mark(self._pending)
+            self._pending = []
+        if self._consumer._auto_commit:
+            self._consumer.commit()
+
+    def _put(self, item: None | confluent_kafka.Message | Exception) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                self._metrics.on_prefetch(self._queue.qsize())
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                if not (
+                    messages := self._consumer.fetch_batch(
+                        self._batch_size, interrupted=self._stop.is_set
+                    )
+                ):
+                    break
+                for message in messages:
+                    if not self._put(message):
+                        return
+        except Exception as exc:
+            self._put(exc)
+            return
+        self._put(None)
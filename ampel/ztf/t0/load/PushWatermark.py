@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/t0/load/PushWatermark.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+import logging
+import weakref
+from typing import Any, ClassVar, Protocol
+
+from ampel.mongo.update.DBUpdatesBuffer import DBUpdatesBuffer
+
+log = logging.getLogger(__name__)
+
+
+class DeferredCommitter(Protocol):
+    def pending(self) -> Any:
+        ...
+
+    def commit(self, snapshot: Any) -> None:
+        ...
+
+
+class PushWatermark:
+    """
+    Store Kafka offsets only once the DBUpdatesBuffer push that contains the
+    corresponding alerts has succeeded.
+
+    Consumers that mark messages only after they were processed (see
+    UWAlertLoader.commit_after_push) register here. Units holding the
+    updates buffer of the current process (ZiMongoMuxer) install the hook.
+    Before each push, the offsets marked so far are recorded. They are
+    stored once the push went through without errors. After a failed
+    write, no further offsets are stored, so that the failed alerts are
+    delivered again on restart.
+
+    Anything else that has to wait for the push registers the same way,
+    e.g. :class:`AlertLatency`: pending() is called before each push, and
+    its return value passed to commit() after a successful one.
+
+    Without a unit that installs the hook, commit() is never called.
+    Registrants check :meth:`hooked` once consumption starts, and fall back
+    to committing on the next request if it returns False.
+    """
+
+    _consumers: ClassVar[weakref.WeakSet[Any]] = weakref.WeakSet()
+    _buffers: ClassVar[weakref.WeakSet[DBUpdatesBuffer]] = weakref.WeakSet()
+
+    @classmethod
+    def register(cls, consumer: DeferredCommitter) -> None:
+        cls._consumers.add(consumer)
+
+    @classmethod
+    def installed(cls) -> bool:
+        """
+        Whether the hook is installed on an updates buffer of this process,
+        i.e. whether registered objects will see commit() calls
+        """
+        return bool(cls._buffers)
+
+    @classmethod
+    def hooked(cls, owner: str) -> bool:
+        """
+        Like installed(), but warn that `owner` falls back to committing on
+        the next request if the hook is missing
+        """
+        if cls.installed():
+            return True
+        log.warning(
+            f"{owner}: no unit installed the push hook (e.g. ZiMongoMuxer); "
+            "committing on the next request instead of after the push"
+        )
+        return False
+
+    @classmethod
+    def install(cls, updates_buffer: DBUpdatesBuffer) -> None:
+        """
+        Hook into push_updates() and error_callback of the given buffer.
+        Does nothing if no consumer is registered or the hook is already installed.
+        """
+        if not cls._consumers or updates_buffer in cls._buffers:
+            return
+        cls._buffers.add(updates_buffer)
+
+        push = updates_buffer.push_updates
+        error_callback = updates_buffer.error_callback
+        failed = False
+
+        def on_error() -> None:
+            nonlocal failed
+            failed = True
+            if error_callback:
+                error_callback()
+
+        def push_updates(force: bool = False) -> None:
+            snapshots = [(consumer, consumer.pending()) for consumer in cls._consumers]
+            db_ops = updates_buffer.db_ops
+            push(force)
+            # push_updates() swaps in a fresh buffer unless it declined to push
+            if updates_buffer.db_ops is db_ops or failed:
+                return
+            for consumer, offsets in snapshots:
+                consumer.commit(offsets)
+
+        updates_buffer.error_callback = on_error
+        updates_buffer.push_updates = push_updates  # type: ignore[assignment, method-assign]
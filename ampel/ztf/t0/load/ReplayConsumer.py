@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/t0/load/ReplayConsumer.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+import re
+import tarfile
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+from urllib.parse import parse_qsl, unquote, urlparse
+
+import confluent_kafka
+
+
+class ReplayMessage:
+    """
+    Stand-in for confluent_kafka.Message
+    """
+
+    __slots__ = "_topic", "_partition", "_offset", "_timestamp", "_value"
+
+    def __init__(self, topic: str, partition: int, offset: int, timestamp: int, value: bytes) -> None:
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._timestamp = timestamp
+        self._value = value
+
+    def topic(self) -> str:
+        return self._topic
+
+    def partition(self) -> int:
+        return self._partition
+
+    def offset(self) -> int:
+        return self._offset
+
+    def timestamp(self) -> tuple[int, int]:
+        return confluent_kafka.TIMESTAMP_CREATE_TIME, self._timestamp
+
+    def value(self) -> bytes:
+        return self._value
+
+    def key(self) -> None:
+        return None
+
+    def headers(self) -> None:
+        return None
+
+    def error(self) -> None | confluent_kafka.KafkaError:
+        return None
+
+    def __len__(self) -> int:
+        return len(self._value)
+
+
+class ReplayConsumer:
+    """
+    Stand-in for confluent_kafka.Consumer that replays avro alerts from disk,
+    for benchmarks and tests without a broker. AllConsumingConsumer (and thus
+    UWAlertLoader and ZTFAlertStreamController) use it when the broker
+    address is a file:// URL, e.g.::
+
+      file:///data/ztf_20211001_programid1.tar.gz?partitions=16&rate=500
+
+    The path may be a tarball written by archive_topic or to_tarball, a
+    single .avro file, or a directory containing either. Members of a
+    tarball or subdirectory named like a topic (archive_topic layout) are
+    emitted on that topic, all others on `topic`. Creation timestamps are
+    taken from the member mtime, i.e. the time archive_topic received the
+    message.
+
+    Query parameters:
+
+    - partitions: number of simulated partitions per topic (default 1).
+      Messages are distributed round-robin.
+    - rate: emit at most this many messages per second (default unlimited)
+    - warp: reproduce the original spacing of the creation timestamps,
+      sped up by this factor (default off)
+    - topic: topic for files not in a topic directory (default ztf_replay_programid1)
+    - loop: replay the source this many times (default 1)
+
+    At the end of the replay, consume() and poll() wait out their timeout
+    and return nothing, like a broker without new messages. Each instance replays the full source; there is no
+    group coordination between processes, and no partition assignment, so
+    AllConsumingConsumer rejects start_time, end_time and
+    retire_topics_after for file:// brokers.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        partitions: int = 1,
+        rate: float = 0,
+        warp: float = 0,
+        topic: str = "ztf_replay_programid1",
+        loop: int = 1,
+        **consumer_config: Any,
+    ) -> None:
+        self.path = Path(path)
+        self.partitions = max(1, int(partitions))
+        self.rate = float(rate)
+        self.warp = float(warp)
+        self.topic = topic
+        self.loop = max(1, int(loop))
+        self.config = consumer_config
+        #: offsets passed to store_offsets(), by (topic, partition)
+        self.stored: dict[tuple[str, int], int] = {}
+        self._patterns: list[re.Pattern] = []
+        self._paused: set[tuple[str, int]] = set()
+        self._source: None | Iterator[ReplayMessage] = None
+        self._next: None | ReplayMessage = None
+        self._start = 0.0
+        self._first_ts: None | int = None
+        self._count = 0
+
+    @classmethod
+    def from_url(cls, url: str, **consumer_config: Any) -> "ReplayConsumer":
+        parsed = urlparse(url)
+        return cls(
+            unquote(parsed.netloc + parsed.path),
+            **dict(parse_qsl(parsed.query)),  # type: ignore[arg-type]
+            **consumer_config,
+        )
+
+    def subscribe(self, topics: list[str], **kwargs: Any) -> None:
+        # topics starting with ^ are regular expressions, as in librdkafka
+        self._patterns = [
+            re.compile(t) if t.startswith("^") else re.compile(re.escape(t) + "$")
+            for t in topics
+        ]
+
+    def consume(self, num_messages: int = 1, timeout: float = -1) -> list[ReplayMessage]:
+        if self._source is None:
+            self._source = self._messages()
+            self._start = time.monotonic()
+        deadline = float("inf") if timeout is None or timeout < 0 else time.monotonic() + timeout
+        batch: list[ReplayMessage] = []
+        while len(batch) < num_messages:
+            if self._next is None:
+                self._next = next(self._source, None)
+                if self._next is None:
+                    if not batch:
+                        # end of the replay: wait like a broker without new
+                        # messages. Without a timeout the real client blocks
+                        # indefinitely; return every second instead.
+                        wait = deadline - time.monotonic() if deadline < float("inf") else 1
+                        time.sleep(max(0, wait))
+                    break
+                if (self._next.topic(), self._next.partition()) in self._paused:
+                    self._next = None
+                    continue
+            if (wait := self._due(self._next) - time.monotonic()) > 0:
+                if batch:
+                    break
+                if time.monotonic() + wait > deadline:
+                    time.sleep(max(0, deadline - time.monotonic()))
+                    break
+                time.sleep(wait)
+            batch.append(self._next)
+            self._next = None
+            self._count += 1
+        return batch
+
+    def poll(self, timeout: float = -1) -> None | ReplayMessage:
+        batch = self.consume(1, timeout)
+        return batch[0] if batch else None
+
+    def pause(self, partitions: list[Any]) -> None:
+        self._paused.update((tp.topic, tp.partition) for tp in partitions)
+
+    def resume(self, partitions: list[Any]) -> None:
+        self._paused.difference_update((tp.topic, tp.partition) for tp in partitions)
+
+    def store_offsets(self, message: Any = None, offsets: Any = None) -> None:
+        for tp in offsets or []:
+            self.stored[(tp.topic, tp.partition)] = tp.offset
+
+    def close(self) -> None:
+        self._source = None
+
+    def _due(self, message: ReplayMessage) -> float:
+        """
+        Time at which the message may be emitted, on the monotonic clock
+        """
+        due = self._start
+        if self.rate > 0:
+            due += self._count / self.rate
+        if self.warp > 0:
+            if self._first_ts is None:
+                self._first_ts = message._timestamp
+            due = max(due, self._start + (message._timestamp - self._first_ts) / 1000 / self.warp)
+        return due
+
+    def _messages(self) -> Iterator[ReplayMessage]:
+        offsets: defaultdict[str, int] = defaultdict(int)
+        for _ in range(self.loop):
+            for topic, mtime, payload in self._payloads(self.path, self.topic):
+                if self._patterns and not any(p.match(topic) for p in self._patterns):
+                    continue
+                n = offsets[topic]
+                offsets[topic] += 1
+                yield ReplayMessage(
+                    topic, n % self.partitions, n // self.partitions, int(mtime * 1000), payload
+                )
+
+    @classmethod
+    def _payloads(cls, path: Path, topic: str) -> Iterator[tuple[str, float, bytes]]:
+        if path.is_dir():
+            for child in sorted(path.iterdir()):
+                if child.is_dir() or child.name.endswith((".tar", ".tar.gz", ".tgz", ".avro")):
+                    yield from cls._payloads(
+                        child, child.name if child.is_dir() and child.name.startswith("ztf_") else topic
+                    )
+        elif path.name.endswith(".avro"):
+            yield topic, path.stat().st_mtime, path.read_bytes()
+        else:
+            with tarfile.open(path) as archive:
+                for member in archive:
+                    if not (member.isfile() and member.name.endswith(".avro")):
+                        continue
+                    parent = Path(member.name).parent.name
+                    yield (
+                        parent if parent.startswith("ztf_") else topic,
+                        member.mtime,
+                        archive.extractfile(member).read(),  # type: ignore[union-attr]
+                    )
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/t0/load/SharedRingAlertLoader.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+import io
+import time
+from collections.abc import Iterator
+
+from ampel.abstract.AbsAlertLoader import AbsAlertLoader
+from ampel.ztf.t0.load.AlertRing import AlertRingReader
+from ampel.ztf.t0.load.PushWatermark import PushWatermark
+
+
+class _RingAcks:
+    """
+    Acknowledges the payloads of a ring reader once they were pushed, see :class:`PushWatermark`
+    """
+
+    def __init__(self) -> None:
+        self.reader: None | AlertRingReader = None
+
+    def pending(self) -> int:
+        return 0 if self.reader is None else self.reader.done
+
+    def commit(self, done: int) -> None:
+        if self.reader is not None:
+            self.reader.ack(done)
+
+
+class SharedRingAlertLoader(AbsAlertLoader[io.IOBase]):
+    """
+    Load avro payloads from a ring served by a single reader process (see
+    :class:`AlertRingWriter`), so that the number of worker processes is not
+    limited by the number of Kafka partitions. ZTFAlertStreamController sets
+    this loader up for its replicas when fanout is enabled.
+
+    Its slot is freed when the next payload is requested. The payload is
+    acknowledged, and its Kafka offset eventually stored by the reader,
+    once the DBUpdatesBuffer push containing the alert has succeeded (see
+    :class:`PushWatermark`), or with the request if commit_after_push is
+    disabled.
+    """
+
+    #: Name of the ring
+    ring: str
+    #: Time to wait for the reader to come up, in seconds
+    connect_timeout: float = 60
+    #: Acknowledge payloads only once they were written to the database.
+    #: Requires a muxer that installs the hook (ZiMongoMuxer); without one,
+    #: payloads are acknowledged with the request.
+    commit_after_push: bool = True
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._reader: None | AlertRingReader = None
+        self._acks = _RingAcks()
+        if self.commit_after_push:
+            PushWatermark.register(self._acks)
+
+    def _connect(self) -> AlertRingReader:
+        deferred = self.commit_after_push and PushWatermark.hooked(type(self).__name__)
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return AlertRingReader(self.ring, deferred_ack=deferred)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+
+    def __iter__(self) -> Iterator[io.IOBase]:  # type: ignore[override]
+        return self
+
+    def __next__(self) -> io.IOBase:
+        if self._reader is None:
+            self._reader = self._acks.reader = self._connect()
+        return io.BytesIO(next(self._reader))
@@ -10,20 +10,30 @@
 import io
 import itertools
 import logging
+import time
 import uuid
 from collections import defaultdict
-from typing import DefaultDict, Literal
+from datetime import datetime
+from functools import partial
+from typing import Any, DefaultDict, Literal
 from collections.abc import Iterator
 
+import confluent_kafka
 import fastavro
 
-from ampel.base.AmpelUnit import AmpelUnit
+from ampel.abstract.AbsAlertLoader import AbsAlertLoader
+from ampel.ztf.t0.load.AlertLatency import AlertLatency
+from ampel.ztf.t0.load.AlertRing import AlertRingWriter
 from ampel.ztf.t0.load.AllConsumingConsumer import AllConsumingConsumer
+from ampel.ztf.t0.load.PrefetchingConsumer import PrefetchingConsumer
+from ampel.ztf.t0.load.PushWatermark import PushWatermark
+from ampel.ztf.t0.load.avroutils import AlertDecoder
+from ampel.ztf.util.ZTFIdMapper import ZTFIdMapper
 
 log = logging.getLogger(__name__)
 
 
-class UWAlertLoader(AmpelUnit):
+class UWAlertLoader(AbsAlertLoader[io.IOBase | dict[str, Any]]):
     """
     Iterable class that loads avro alerts from the Kafka stream 
     provided by University of Washington (UW) 
@@ -34,39 +44,185 @@ class UWAlertLoader(AmpelUnit):
     stream: Literal["ztf_uw_private", "ztf_uw_public"] = "ztf_uw_public"
     #: Consumer group name
     group_name: str = str(uuid.uuid1())
+    #: Static group membership: a stable, unique id for this consumer. A member
+    #: that restarts within session.timeout.ms gets its partitions back without
+    #: a rebalance. ZTFAlertStreamController assigns these to its replicas.
+    group_instance_id: None | str = None
+    #: partition assignment strategy. "cooperative-sticky" moves only the
+    #: partitions that change owner when members join or leave, instead of
+    #: stopping the whole group. All members of a group must use compatible strategies.
+    assignment_strategy: None | Literal["range", "roundrobin", "cooperative-sticky"] = None
+    #: Replay from this time (ISO string, datetime or unix timestamp): partitions
+    #: without a committed offset are sought directly to the first message
+    #: created at or after it. Use with a fresh group_name for backfills.
+    start_time: None | datetime = None
+    #: Stop once every assigned partition has reached a message created after
+    #: this time (or its end, if the time has passed)
+    end_time: None | datetime = None
+    #: Drop nightly topics (ztf_YYYYMMDD_*) older than this many days from the
+    #: subscription once they are fully consumed. Topic patterns are then
+    #: resolved to an explicit list, and new topics are discovered within a
+    #: second until tonight's topic appears.
+    retire_topics_after: None | float = None
     #: time to wait for messages before giving up, in seconds
     timeout: int = 1
+    #: number of messages to fetch from librdkafka per call. Offsets of a
+    #: batch are stored once the following batch is requested.
+    batch_size: int = 1
+    #: number of messages to fetch ahead on a background thread, overlapping
+    #: broker round trips with alert processing. 0 disables prefetching.
+    #: Offsets are still only stored once the following message is requested.
+    prefetch: int = 0
+    #: Store offsets only once the DBUpdatesBuffer push containing the
+    #: corresponding alerts has succeeded, rather than when the next message
+    #: is requested. This allows large updates buffers without risking
+    #: alert loss on a crash. Requires a muxer that installs the hook
+    #: (ZiMongoMuxer), see :class:`PushWatermark`; without one, offsets are
+    #: stored when the next batch is requested.
+    commit_after_push: bool = False
+    #: If "avro", decode each message exactly once and yield the alert dict
+    #: instead of the raw payload. Use with deserialize=None in the supplier.
+    deserialize: None | Literal["avro"] = None
+    #: "reader": decode with fastavro.reader, parsing the embedded schema for every alert
+    #: "schemaless": parse each distinct schema once, see :class:`AlertDecoder`
+    decoder: Literal["reader", "schemaless"] = "reader"
+    #: Export per-stage latency histograms from message creation to DB push,
+    #: see :class:`AlertLatency`
+    track_latency: bool = False
+    #: Treatment of image stamps in decoded alerts (requires decoder="schemaless").
+    #: "skip" avoids reading them at all, "lazy" keeps memoryviews into the message.
+    cutouts: Literal["decode", "skip", "lazy"] = "decode"
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        if self.cutouts != "decode" and self.decoder != "schemaless":
+            raise ValueError(f"cutouts={self.cutouts!r} requires decoder='schemaless'")
+        self._it: None | Iterator[io.IOBase | dict[str, Any]] = None
+        self._decode = AlertDecoder(self.cutouts) if self.decoder == "schemaless" else self._read
+        # reads just the candidate jd of raw payloads, for the topic summary
+        self._peek = AlertDecoder("skip", {"candidate": ["jd"]})
+        self._latency = AlertLatency.enable() if self.track_latency else None
         topics = ["^ztf_.*_programid1$"]
 
         if self.stream == "ztf_uw_private":
             topics.append("^ztf_.*_programid2$")
         config = {"group.id": f"{self.group_name}-{self.stream}"}
+        if self.group_instance_id is not None:
+            config["group.instance.id"] = self.group_instance_id
+        if self.assignment_strategy is not None:
+            config["partition.assignment.strategy"] = self.assignment_strategy
 
-        self._consumer = AllConsumingConsumer(
-            self.bootstrap, timeout=self.timeout, topics=topics, **config
+        consumer = AllConsumingConsumer(
+            self.bootstrap,
+            timeout=self.timeout,
+            topics=topics,
+            auto_commit=not self.commit_after_push,
+            start_time=None if self.start_time is None else self.start_time.timestamp(),
+            end_time=None if self.end_time is None else self.end_time.timestamp(),
+            retire_topics_after=self.retire_topics_after,
+            **config,
         )
+        if self.commit_after_push:
+            PushWatermark.register(consumer)
+        self._consumer: AllConsumingConsumer | PrefetchingConsumer = consumer
+        if self.prefetch > 0:
+            self._consumer = PrefetchingConsumer(
+                self._consumer, depth=self.prefetch, batch_size=max(self.batch_size, 100)
+            )
 
-    def alerts(self, limit: None | int=None) -> Iterator[io.BytesIO]:
+    def alerts(self, limit: None | int=None) -> Iterator[io.IOBase | dict[str, Any]]:
         """
         Generate alerts until timeout is reached
-        :returns: dict instance of the alert content
+        :returns: file-like object with the avro payload, or the decoded
+          alert dict if deserialize is set
         :raises StopIteration: when next(fastavro.reader) has dried out
         """
         topic_stats: defaultdict[str, list[float]] = defaultdict(lambda: [float("inf"), -float("inf"), 0])
-        for message in itertools.islice(self._consumer, limit):
-            reader = fastavro.reader(io.BytesIO(message.value()))
-            alert = next(reader)  # raise StopIteration
+        for message in itertools.islice(self._messages(), limit):
+            if self._latency:
+                self._latency.on_consume(message)
+            if self.deserialize == "avro":
+                start = time.perf_counter()
+                alert = self._decode(message.value())
+                if self._latency:
+                    self._latency.observe("decode", time.perf_counter() - start)
+                jd = alert["candidate"]["jd"]
+            else:
+                jd = self._peek.decode_deferred(message.value())[0]["candidate"]["jd"]
             stats = topic_stats[message.topic()]
-            if alert["candidate"]["jd"] < stats[0]:
-                stats[0] = alert["candidate"]["jd"]
-            if alert["candidate"]["jd"] > stats[1]:
-                stats[1] = alert["candidate"]["jd"]
+            if jd < stats[0]:
+                stats[0] = jd
+            if jd > stats[1]:
+                stats[1] = jd
             stats[2] += 1
-            yield io.BytesIO(message.value())
+            if self.deserialize == "avro":
+                yield alert
+            else:
+                yield io.BytesIO(message.value())
+        if self._latency:
+            self._latency.on_consume(None)
         log.info("Got messages from topics: {}".format(dict(topic_stats)))
 
-    def __iter__(self) -> Iterator[io.IOBase]:
+    @staticmethod
+    def _read(payload: bytes) -> dict[str, Any]:
+        return next(fastavro.reader(io.BytesIO(payload)))  # raise StopIteration
+
+    def _messages(self) -> Iterator[confluent_kafka.Message]:
+        if self.commit_after_push and isinstance(self._consumer, AllConsumingConsumer):
+            hooked = PushWatermark.hooked(type(self).__name__)
+            # mark messages only once the next batch is requested, i.e. once they were processed
+            while messages := self._consumer.fetch_batch(self.batch_size):
+                yield from messages
+                self._consumer.mark(messages)
+                if not hooked:
+                    self._consumer.commit()
+        elif self.batch_size > 1:
+            for batch in self._consumer.batches(self.batch_size):
+                yield from batch
+        else:
+            yield from self._consumer
+
+    def serve(self, ring: str, slots: int = 256, slot_size: int = 1 << 20, affinity: bool = False) -> None:
+        """
+        Hand raw payloads to SharedRingAlertLoader workers until the consumer
+        times out. Offsets are stored once the workers are done with the
+        corresponding alerts, which requires commit_after_push=True and prefetch=0.
+
+        :param slots: number of payloads in shared memory at once
+        :param slot_size: size of each slot in bytes. Larger payloads are sent over the control socket.
+        :param affinity: hand all alerts of an object to the same worker, so
+          that workers do not ingest datapoints of the same stock concurrently
+        """
+        if not (self.commit_after_push and isinstance(self._consumer, AllConsumingConsumer)):
+            raise ValueError("serve() requires commit_after_push=True and prefetch=0")
+        AlertRingWriter(
+            self._consumer,
+            ring,
+            slots=slots,
+            slot_size=slot_size,
+            batch_size=max(self.batch_size, 100),
+            affinity=partial(self._stock_key, AlertDecoder("skip")) if affinity else None,
+        ).run()
+
+    @staticmethod
+    def _stock_key(decoder: AlertDecoder, payload: bytes) -> None | int:
+        """
+        Routing key for an alert: its stock id without the year, which
+        occupies the lowest 4 bits and would send all of this year's objects
+        to the same worker for power-of-two worker counts
+        """
+        try:
+            if (object_id := decoder.object_id(payload)) is None:
+                return None
+            return ZTFIdMapper.to_ampel_id(object_id) >> 4
+        except Exception:
+            # leave undecodable payloads to the worker to reject
+            return None
+
+    def __iter__(self) -> Iterator[io.IOBase | dict[str, Any]]: # type: ignore[override]
         return self.alerts()
+
+    def __next__(self) -> io.IOBase | dict[str, Any]:
+        if self._it is None:
+            self._it = iter(self)
+        return next(self._it)
@@ -46,11 +46,12 @@ class ZTFAlertArchiver(AbsOpsUnit):
             connect_args=self.archive_auth.get(),
         )
 
+        consumer_config: dict[str, Any] = {"group.id": self.group_name}
         self.consumer = AllConsumingConsumer(
             self.bootstrap,
             timeout=self.timeout,
             topics=self.topics,
-            **{"group.id": self.group_name},
+            **consumer_config,
         )
 
     def run(self, beacon: None | dict[str, Any] = None) -> None | dict[str, Any]:
@@ -9,14 +9,41 @@
 
 
 import io
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import cached_property
-from typing import Any, Optional, Iterator
+from typing import Any, Literal, Optional, Iterator
 
 import fastavro
 
 from ampel.abstract.AbsOpsUnit import AbsOpsUnit
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
 from ampel.ztf.base.ArchiveUnit import ArchiveUnit
 from ampel.ztf.t0.load.AllConsumingConsumer import AllConsumingConsumer
+from ampel.ztf.t0.load.avroutils import AlertDecoder, concatenate, read_header
+
+stat_alerts = AmpelMetricsRegistry.counter(
+    "archived_alerts",
+    "Alerts posted to the archive",
+    subsystem="ztf",
+    labelnames=("worker",),
+)
+stat_bytes = AmpelMetricsRegistry.counter(
+    "archived_chunks",
+    "Size of chunks posted to the archive",
+    unit="bytes",
+    subsystem="ztf",
+    labelnames=("worker",),
+)
+stat_upload = AmpelMetricsRegistry.histogram(
+    "archive_upload",
+    "Duration of chunk uploads",
+    unit="seconds",
+    subsystem="ztf",
+    labelnames=("worker",),
+)
 
 
 class ZTFAlertArchiverV3(AbsOpsUnit, ArchiveUnit):
@@ -34,59 +61,150 @@ class ZTFAlertArchiverV3(AbsOpsUnit, ArchiveUnit):
     timeout: int = 300
     #: Number of alerts to post at once
     chunk_size: int = 1000
+    #: Number of chunk uploads in flight while the next chunks are consumed.
+    #: Offsets are stored in chunk order, each once its upload and all
+    #: earlier ones have succeeded.
+    max_inflight: int = 1
+    #: Avro codec for chunks. "zstandard" requires the zstandard package
+    #: (ampel-ztf[zstandard]).
+    codec: Literal["null", "deflate", "zstandard"] = "null"
+    #: Build chunks by concatenating the encoded records of alerts with the
+    #: same schema, instead of decoding and writing them again. Chunks the
+    #: pass-through cannot handle (e.g. compressed alerts) are re-encoded.
+    passthrough: bool = True
+    #: Number of archiver processes, forked on run(). They share the consumer
+    #: group, so partitions are divided among them. Metrics are labeled by worker.
+    workers: int = 1
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        if self.codec == "zstandard":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError as exc:
+                raise ValueError("codec='zstandard' requires the zstandard package") from exc
 
     @cached_property
     def consumer(self) -> AllConsumingConsumer:
+        consumer_config: dict[str, Any] = {"group.id": self.group_name}
         return AllConsumingConsumer(
             self.bootstrap,
             timeout=self.timeout,
             topics=self.topics,
             auto_commit=False,
-            **{"group.id": self.group_name},
+            **consumer_config,
         )
 
-    def _chunks(self) -> Iterator[bytes]:
+    def _chunks(self) -> Iterator[tuple[bytes, int, dict[tuple[str, int], int]]]:
         """
         Yield avro-serialized chunks of alerts from consumer, i.e. strip the schema header
-        from all but the first alert.
+        from all but the first alert, along with the number of alerts and the
+        offsets to store once the chunk is archived.
         """
-        schema = None
-        alerts: list = []
-
-        # wrap in a generator so that offsets are not committed until
-        # the _next_ iteration of the loop. this ensures that the offsets
-        # are only committed once the chunk is actually archived.
-        def emit() -> Iterator[bytes]:
-            nonlocal schema
-            if not alerts:
+        payloads: list[bytes] = []
+        offsets: dict[tuple[str, int], int] = {}
+        fingerprint = None
+        decoder = AlertDecoder()
+
+        def emit() -> Iterator[tuple[bytes, int, dict[tuple[str, int], int]]]:
+            if not payloads:
                 return
-            chunk = io.BytesIO()
-            fastavro.writer(chunk, schema, alerts)
-            yield chunk.getvalue()
-            alerts.clear()
-            schema = None
-            self.consumer.commit()
-
-        for message in self.consumer:
-            reader = fastavro.reader(io.BytesIO(message.value()))
-            alert = next(reader)  # raise StopIteration
-            if schema is None:
-                schema = reader.writer_schema
-            alerts.append(alert)
-            if len(alerts) >= self.chunk_size:
+            if not (self.passthrough and (chunk := concatenate(payloads, self.codec))):
+                schema = None
+                alerts = []
+                for payload in payloads:
+                    writer_schema, alert = decoder.decode(payload)
+                    if schema is None:
+                        schema = writer_schema
+                    alerts.append(alert)
+                buf = io.BytesIO()
+                fastavro.writer(buf, schema, alerts, codec=self.codec)
+                chunk = buf.getvalue()
+            yield chunk, len(payloads), dict(offsets)
+            payloads.clear()
+            offsets.clear()
+
+        # never fetch past the end of the current chunk, as the offsets of
+        # every fetched message are marked in the consumer
+        while messages := self.consumer.consume_batch(self.chunk_size - len(payloads)):
+            for message in messages:
+                if self.passthrough:
+                    header = read_header(message.value())
+                    # records can only be concatenated within the same schema
+                    if payloads and (header and header.fingerprint) != fingerprint:
+                        yield from emit()
+                    fingerprint = header and header.fingerprint
+                payloads.append(message.value())
+                offsets[(message.topic(), message.partition())] = message.offset()
+            if len(payloads) >= self.chunk_size:
                 yield from emit()
         yield from emit()
 
-    def _post_chunk(self, payload: bytes):
+    def _post_chunk(self, payload: bytes, count: int):
+        start = time.perf_counter()
         response = self.session.post("alerts", data=payload)
         response.raise_for_status()
+        stat_upload.labels(self._worker).observe(time.perf_counter() - start)
+        stat_alerts.labels(self._worker).inc(count)
+        stat_bytes.labels(self._worker).inc(len(payload))
+
+    def _store(self, upload: Future, offsets: dict[tuple[str, int], int]) -> None:
+        # raises if the upload failed
+        upload.result()
+        self.consumer.commit(offsets)
 
     def run(self, beacon: Optional[dict[str, Any]] = None) -> Optional[dict[str, Any]]:
 
+        if self.workers > 1:
+            self._run_workers()
+        else:
+            self._archive("0")
+
+        return None
+
+    def _run_workers(self) -> None:
+        # fork before the consumer exists, so that each worker creates its
+        # own and joins the consumer group
+        ctx = multiprocessing.get_context("fork")
+        procs = [
+            ctx.Process(target=self._archive, args=(str(i),), name=f"archiver-{i}")
+            for i in range(self.workers)
+        ]
+        for proc in procs:
+            proc.start()
         try:
-            for chunk in self._chunks():
-                self._post_chunk(chunk)
+            for proc in procs:
+                proc.join()
         except KeyboardInterrupt:
-            ...
+            # the workers received the signal as well
+            for proc in procs:
+                proc.join()
+        if failed := [proc.name for proc in procs if proc.exitcode]:
+            raise RuntimeError(f"Archiver workers failed: {', '.join(failed)}")
 
-        return None
+    def _archive(self, worker: str) -> None:
+
+        self._worker = worker
+        # set up the session before it is shared by the upload threads
+        self.session
+        # uploads in chunk order, with the offsets to store once they succeed
+        inflight: deque[tuple[Future, dict[tuple[str, int], int]]] = deque()
+        with ThreadPoolExecutor(max_workers=self.max_inflight) as executor:
+            try:
+                for chunk, count, offsets in self._chunks():
+                    while len(inflight) >= self.max_inflight:
+                        self._store(*inflight.popleft())
+                    inflight.append((executor.submit(self._post_chunk, chunk, count), offsets))
+                    while inflight and inflight[0][0].done():
+                        self._store(*inflight.popleft())
+                while inflight:
+                    self._store(*inflight.popleft())
+            except KeyboardInterrupt:
+                # store offsets of the uploads that were already running
+                for upload, _ in inflight:
+                    upload.cancel()
+                while inflight and not inflight[0][0].cancelled():
+                    self._store(*inflight.popleft())
+            finally:
+                for upload, _ in inflight:
+                    upload.cancel()
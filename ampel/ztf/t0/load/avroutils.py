@@ -1,6 +1,8 @@
 
-from functools import lru_cache
+from functools import lru_cache, partial
 from pathlib import Path
+from collections.abc import Callable, Collection, Mapping, Sequence
+from typing import IO, Any, Literal, NamedTuple
 import json
 import fastavro
 import io
@@ -9,6 +11,7 @@ import grp
 import os
 import time
 import tarfile
+import zlib
 
 @lru_cache()
 def schema(version):
@@ -16,6 +19,431 @@ def schema(version):
     with open(base/f"schema_{version}.json") as f:
         return json.load(f)
 
+
+MAGIC = b"Obj\x01"
+SYNC_SIZE = 16
+
+
+def read_long(buf, pos: int) -> tuple[int, int]:
+    """
+    Decode a zigzag-encoded avro long from buf at pos
+    :returns: value and position of the following byte
+    """
+    b = buf[pos]
+    n = b & 0x7F
+    shift = 7
+    while b & 0x80:
+        pos += 1
+        b = buf[pos]
+        n |= (b & 0x7F) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1), pos + 1
+
+
+def write_long(n: int) -> bytes:
+    """
+    Encode n as a zigzag-encoded avro long
+    """
+    n = (n << 1) ^ (n >> 63)
+    out = bytearray()
+    while n & ~0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+class ContainerHeader(NamedTuple):
+    #: raw bytes of the metadata map, identical for all files with the same schema and codec
+    fingerprint: bytes
+    metadata: dict[str, bytes]
+    sync: bytes
+    #: position of the first data block
+    end: int
+
+
+def read_header(buf) -> None | ContainerHeader:
+    """
+    Parse the header of an avro object container file
+    :returns: None if buf does not start with a container header
+    """
+    try:
+        if buf[:4] != MAGIC:
+            return None
+        pos = 4
+        metadata: dict[str, bytes] = {}
+        while True:
+            count, pos = read_long(buf, pos)
+            if count == 0:
+                break
+            if count < 0:
+                # block is prefixed with its size in bytes
+                count = -count
+                _, pos = read_long(buf, pos)
+            for _ in range(count):
+                size, pos = read_long(buf, pos)
+                key = bytes(buf[pos:pos+size]).decode()
+                pos += size
+                size, pos = read_long(buf, pos)
+                metadata[key] = bytes(buf[pos:pos+size])
+                pos += size
+        if len(buf) < pos + SYNC_SIZE:
+            return None
+        return ContainerHeader(
+            bytes(buf[4:pos]), metadata, bytes(buf[pos:pos+SYNC_SIZE]), pos + SYNC_SIZE
+        )
+    except (IndexError, UnicodeDecodeError):
+        return None
+
+
+def concatenate(
+    payloads: Sequence[bytes],
+    codec: Literal["null", "deflate", "zstandard"] = "null",
+) -> None | bytes:
+    """
+    Combine single-block avro containers with identical headers into one
+    container by concatenating the encoded records, without decoding them.
+
+    :param codec: codec of the combined container
+    :returns: None if the payloads have different headers, more than one
+      block, or a codec other than null, in which case they have to be
+      decoded and written again
+    """
+    header = None
+    records = []
+    count = 0
+    for payload in payloads:
+        if (h := read_header(payload)) is None or (header is not None and h.fingerprint != header.fingerprint):
+            return None
+        header = h
+        try:
+            n, pos = read_long(payload, header.end)
+            size, pos = read_long(payload, pos)
+        except IndexError:
+            return None
+        if payload[pos+size:] != header.sync:
+            # truncated, or more blocks follow
+            return None
+        records.append(payload[pos:pos+size])
+        count += n
+    if header is None or header.metadata.get("avro.codec", b"null") != b"null":
+        return None
+
+    data = b"".join(records)
+    if codec == "deflate":
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    elif codec == "zstandard":
+        import zstandard
+        data = zstandard.ZstdCompressor().compress(data)
+    metadata = dict(header.metadata, **{"avro.codec": codec.encode()})
+    return b"".join(
+        [
+            MAGIC,
+            write_long(len(metadata)),
+            *(
+                write_long(len(k := key.encode())) + k + write_long(len(value)) + value
+                for key, value in metadata.items()
+            ),
+            write_long(0),
+            header.sync,
+            write_long(count),
+            write_long(len(data)),
+            data,
+            header.sync,
+        ]
+    )
+
+
+CUTOUT_FIELDS = ("cutoutScience", "cutoutTemplate", "cutoutDifference")
+
+
+def read_cutout(buf: memoryview, pos: int, null_index: int) -> tuple[None | dict[str, Any], int]:
+    """
+    Read a union of null and a cutout record (fileName: string, stampData: bytes)
+    without copying the stamp
+    :returns: cutout with stampData as a memoryview into buf, and position of the following byte
+    """
+    index, pos = read_long(buf, pos)
+    if index == null_index:
+        return None, pos
+    size, pos = read_long(buf, pos)
+    file_name = bytes(buf[pos:pos+size]).decode()
+    pos += size
+    size, pos = read_long(buf, pos)
+    return {"fileName": file_name, "stampData": buf[pos:pos+size]}, pos + size
+
+
+def project(schema: dict[str, Any], projection: Mapping[str, Collection[str]]) -> dict[str, Any]:
+    """
+    Restrict a record schema for use as reader schema. For each top-level
+    field named in projection, the record nested in its type (possibly within
+    a union or array) keeps only the listed fields.
+    """
+    def restrict(t, keep):
+        if isinstance(t, list):
+            return [restrict(branch, keep) for branch in t]
+        if isinstance(t, dict):
+            if t.get("type") == "record":
+                return dict(t, fields=[f for f in t["fields"] if f["name"] in keep])
+            if t.get("type") == "array":
+                return dict(t, items=restrict(t["items"], keep))
+        return t
+    return dict(
+        schema,
+        fields=[
+            dict(f, type=restrict(f["type"], projection[f["name"]])) if f["name"] in projection else f
+            for f in schema["fields"]
+        ]
+    )
+
+
+class CachedSchema(NamedTuple):
+    #: parsed writer schema
+    writer: dict[str, Any]
+    #: parsed reader schema for projected decoding, or None
+    reader: None | dict[str, Any]
+    #: parsed writer schema without the trailing cutout fields, or None if
+    #: the cutouts are not the last fields of the record
+    head: None | dict[str, Any]
+    #: parsed reader schema for projected decoding of head, or None
+    head_reader: None | dict[str, Any]
+    #: name and index of the null branch for each trailing cutout field,
+    #: empty if the cutouts do not have the expected layout
+    cutouts: tuple[tuple[str, int], ...]
+    #: writer and reader schema for the fields up to and including candidate,
+    #: and the remaining fields, or None if the record cannot be split there
+    split: None | tuple[dict[str, Any], None | dict[str, Any], "CachedSchema"] = None
+    #: writer schema for the fields up to and including objectId, or None
+    ident: None | dict[str, Any] = None
+
+    @classmethod
+    def from_json(cls,
+        schema: dict[str, Any],
+        projection: None | Mapping[str, Collection[str]] = None
+    ) -> "CachedSchema":
+        fields = schema["fields"]
+        writer = fastavro.parse_schema(schema)
+        reader = fastavro.parse_schema(project(schema, projection)) if projection else None
+        split = None
+        ident = None
+        names = [f["name"] for f in fields]
+        if "objectId" in names:
+            ident = fastavro.parse_schema(dict(schema, fields=fields[:names.index("objectId")+1]))
+        if "candidate" in names and (i := names.index("candidate")) < len(fields) - 1:
+            prefix = dict(schema, fields=fields[:i+1])
+            try:
+                split = (
+                    fastavro.parse_schema(prefix),
+                    fastavro.parse_schema(project(prefix, projection)) if projection else None,
+                    cls.from_json(dict(schema, fields=fields[i+1:]), projection)
+                )
+            except fastavro.schema.UnknownType:
+                # remaining fields refer to types defined in the prefix
+                pass
+        ntail = 0
+        while ntail < len(fields) and fields[-1-ntail]["name"] in CUTOUT_FIELDS:
+            ntail += 1
+        if ntail == 0:
+            return cls(writer, reader, None, None, (), split, ident)
+        head_schema = dict(schema, fields=fields[:-ntail])
+        head = fastavro.parse_schema(head_schema)
+        head_reader = fastavro.parse_schema(project(head_schema, projection)) if projection else None
+        cutouts: list[tuple[str, int]] = []
+        records: set[str] = set()
+        for field in fields[-ntail:]:
+            branches = field["type"]
+            if not (isinstance(branches, list) and len(branches) == 2 and "null" in branches):
+                break
+            record = branches[1 - branches.index("null")]
+            if isinstance(record, dict):
+                if [(f["name"], f["type"]) for f in record.get("fields", [])] != [("fileName", "string"), ("stampData", "bytes")]:
+                    break
+                records.add(record["name"])
+                if "namespace" in record:
+                    records.add(f"{record['namespace']}.{record['name']}")
+            elif record not in records:
+                break
+            cutouts.append((field["name"], branches.index("null")))
+        else:
+            return cls(writer, reader, head, head_reader, tuple(cutouts), split, ident)
+        return cls(writer, reader, head, head_reader, (), split, ident)
+
+
+class AlertDecoder:
+    """
+    Decode alerts shipped as single-record avro containers (one alert per
+    Kafka message or file).
+
+    fastavro.reader parses the writer schema embedded in every container.
+    This decoder instead parses the schema once per distinct header and
+    decodes the record with fastavro.schemaless_reader. Containers it does
+    not understand (unknown codec, more than one record, truncated header)
+    are handed to fastavro.reader.
+
+    :param cutouts: how to treat the image stamps (cutoutScience,
+      cutoutTemplate, cutoutDifference), which make up most of an IPAC alert:
+
+      - "decode": decode into bytes, like fastavro.reader
+      - "skip": omit from the returned alert. If the stamps are the last
+        fields of the record (as for all IPAC schemas), they are not read at all.
+      - "lazy": replace stampData with a memoryview into the original
+        payload. Call bytes() on it to materialize the stamp.
+
+    :param projection: names of the fields to keep in the records nested in
+      the given top-level fields, e.g. {"candidate": ["jd", "rb"]}. Other
+      fields are skipped by fastavro instead of being built into dicts.
+    """
+
+    #: number of distinct headers to keep. IPAC changes the schema a few times a year.
+    max_schemas = 32
+
+    def __init__(self,
+        cutouts: Literal["decode", "skip", "lazy"] = "decode",
+        projection: None | Mapping[str, Collection[str]] = None,
+    ) -> None:
+        self.cutouts = cutouts
+        self.projection = {k: set(v) for k, v in projection.items()} if projection else None
+        self._schemas: dict[bytes, CachedSchema] = {}
+
+    def __call__(self, payload: bytes | IO[bytes]) -> dict[str, Any]:
+        return self.decode(payload)[1]
+
+    def decode(self, payload: bytes | IO[bytes]) -> tuple[dict[str, Any], dict[str, Any]]:
+        """
+        :returns: writer schema and alert content
+        """
+        if not isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = payload.read()
+        if (located := self._locate(payload)) is None:
+            return self._fallback(payload)
+        return located[0].writer, self._read(*located)
+
+    def decode_deferred(self,
+        payload: bytes | IO[bytes]
+    ) -> tuple[dict[str, Any], None | Callable[[], dict[str, Any]]]:
+        """
+        Decode the fields up to and including candidate, deferring the rest
+        (prv_candidates and cutouts), which make up most of the payload.
+
+        :returns: alert with the leading fields, and a function that decodes
+          the remaining fields, or None if the whole alert was decoded already
+        """
+        if not isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = payload.read()
+        if (located := self._locate(payload)) is None:
+            return self._fallback(payload)[1], None
+        entry, buf, pos = located
+        if entry.split is None:
+            return self._read(entry, buf, pos), None
+        prefix, prefix_reader, tail = entry.split
+        fo = io.BytesIO(buf)
+        fo.seek(pos)
+        alert = fastavro.schemaless_reader(fo, prefix, prefix_reader)
+        return alert, partial(self._read, tail, buf, fo.tell())
+
+    def object_id(self, payload: bytes) -> None | str:
+        """
+        Decode only the fields up to objectId, which precede the candidate in
+        all IPAC schemas
+
+        :returns: objectId, or None if the payload has no objectId field
+        """
+        if (located := self._locate(payload)) is not None:
+            entry, buf, pos = located
+            if entry.ident is None:
+                return None
+            fo = io.BytesIO(buf)
+            fo.seek(pos)
+            return fastavro.schemaless_reader(fo, entry.ident)["objectId"]
+        return self._fallback(payload)[1].get("objectId")
+
+    def _locate(self, payload: bytes) -> None | tuple[CachedSchema, bytes, int]:
+        """
+        :returns: schema entry, record buffer and record position,
+          or None if the container must be handed to fastavro.reader
+        """
+        if (header := read_header(payload)) is None:
+            return None
+        if (entry := self._schemas.get(header.fingerprint)) is None:
+            if (
+                header.metadata.get("avro.codec", b"null") not in (b"null", b"deflate")
+                or "avro.schema" not in header.metadata
+            ):
+                return None
+            if len(self._schemas) >= self.max_schemas:
+                self._schemas.clear()
+            entry = self._schemas[header.fingerprint] = CachedSchema.from_json(
+                json.loads(header.metadata["avro.schema"]), self.projection
+            )
+        count, pos = read_long(payload, header.end)
+        if count != 1:
+            return None
+        size, pos = read_long(payload, pos)
+        if header.metadata.get("avro.codec", b"null") == b"deflate":
+            return entry, zlib.decompress(payload[pos:pos+size], -15), 0
+        return entry, payload, pos
+
+    def _read(self, entry: CachedSchema, buf: bytes, pos: int) -> dict[str, Any]:
+        # BytesIO shares the buffer of a bytes object, so seeking avoids a copy
+        fo = io.BytesIO(buf)
+        fo.seek(pos)
+
+        if self.cutouts == "decode" or entry.head is None or (self.cutouts == "lazy" and not entry.cutouts):
+            return self._strip(fastavro.schemaless_reader(fo, entry.writer, entry.reader), False)
+
+        alert = fastavro.schemaless_reader(fo, entry.head, entry.head_reader)
+        if self.cutouts == "lazy":
+            view = memoryview(buf)
+            pos = fo.tell()
+            for name, null_index in entry.cutouts:
+                alert[name], pos = read_cutout(view, pos, null_index)
+        return alert
+
+    def _strip(self, alert: dict[str, Any], project: bool = True) -> dict[str, Any]:
+        """
+        Apply cutout treatment (and projection) to a fully decoded alert
+        """
+        if project and self.projection:
+            for k, keep in self.projection.items():
+                if isinstance(v := alert.get(k), dict):
+                    alert[k] = {kk: vv for kk, vv in v.items() if kk in keep}
+                elif isinstance(v, list):
+                    alert[k] = [{kk: vv for kk, vv in el.items() if kk in keep} for el in v]
+        if self.cutouts == "skip":
+            for k in CUTOUT_FIELDS:
+                alert.pop(k, None)
+        elif self.cutouts == "lazy":
+            for k in CUTOUT_FIELDS:
+                if alert.get(k):
+                    alert[k]["stampData"] = memoryview(alert[k]["stampData"])
+        return alert
+
+    def _fallback(self, payload: bytes) -> tuple[dict[str, Any], dict[str, Any]]:
+        reader = fastavro.reader(io.BytesIO(payload))
+        return reader.writer_schema, self._strip(next(reader))
+
+
+# decoder of the current worker process, see init_decode_worker
+_worker_decoder: None | AlertDecoder = None
+
+def init_decode_worker(
+    decoder: Literal["reader", "schemaless"],
+    cutouts: Literal["decode", "skip", "lazy"] = "decode",
+    projection: None | Mapping[str, Collection[str]] = None,
+) -> None:
+    """
+    Initializer for pool processes running decode_in_worker. Each process
+    keeps its own schema cache.
+    """
+    global _worker_decoder
+    _worker_decoder = AlertDecoder(cutouts, projection) if decoder == "schemaless" else None
+
+def decode_in_worker(payload: bytes) -> dict[str, Any]:
+    if _worker_decoder is None:
+        return next(fastavro.reader(io.BytesIO(payload)))
+    return _worker_decoder(payload)
+
 def dump(alert, fileobj):
     fastavro.writer(fileobj, schema(alert['schemavsn']), [alert])
 
@@ -12,6 +12,7 @@
 def archive_topic():
 
 	from ampel.ztf.t0.load.AllConsumingConsumer import AllConsumingConsumer
+	from ampel.ztf.t0.load.avroutils import AlertDecoder
 	from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 	import itertools, tarfile, time, os, pwd, grp, uuid, socket, fastavro, io
 
@@ -27,17 +28,15 @@ def archive_topic():
 		opts.broker, topics=[opts.topic], timeout=20, **{'group.id':uuid.uuid1()}
 	)
 
+	# only the candid is needed, and stripped alerts are written without cutouts
+	decoder = AlertDecoder("skip")
+
 	def trim_alert(payload):
-		reader = fastavro.reader(io.BytesIO(payload))
-		schema = reader.writer_schema
-		alert = next(reader)
+		schema, alert = decoder.decode(payload)
 
 		candid = alert['candid']
 		# remove cutouts to save space
 		if opts.strip_cutouts:
-			for k in list(alert.keys()):
-				if k.startswith('cutout'):
-					del alert[k]
 			with io.BytesIO() as out:
 				fastavro.writer(out, schema, [alert])
 				payload = out.getvalue()
@@ -71,23 +70,143 @@ def archive_topic():
 				)
 
 
+def get_offsets(consumer, groups, pattern="^ztf_"):
+	"""
+	Snapshot of the watermarks of all partitions of the topics matching
+	pattern, and of the offsets committed by each consumer group
+
+	:param consumer: confluent_kafka.Consumer used to list topics and query watermarks
+	:param groups: group id -> function that returns the given partitions
+	  with the offsets committed by that group
+	:returns: dict with time, watermarks {(topic, partition): (low, high)}
+	  and committed {group: {(topic, partition): offset}}
+	"""
+
+	import re, time
+	from confluent_kafka import TopicPartition
+
+	partitions = [
+		TopicPartition(name, p)
+		for name, topic in sorted(consumer.list_topics(timeout=10).topics.items())
+		if re.match(pattern, name)
+		for p in sorted(topic.partitions)
+	]
+	return {
+		"time": time.time(),
+		"watermarks": {
+			(tp.topic, tp.partition): consumer.get_watermark_offsets(tp, timeout=10)
+			for tp in partitions
+		},
+		"committed": {
+			group: {
+				(tp.topic, tp.partition): tp.offset
+				for tp in committed(partitions)
+				if tp.offset >= 0
+			}
+			for group, committed in groups.items()
+		} if partitions else {},
+	}
+
+
+def get_lag(before, after=None):
+	"""
+	Per-partition lag of each consumer group. With two snapshots from
+	get_offsets, also the rates at which messages were produced (ingress)
+	and consumed (egress) in between, and the time to drain the lag at
+	those rates (None if the lag does not shrink). Partitions without a
+	committed offset are omitted.
+	"""
+
+	last = after or before
+	dt = after["time"] - before["time"] if after else 0
+	rows = []
+	for group, committed in sorted(last["committed"].items()):
+		for key, offset in sorted(committed.items()):
+			low, high = last["watermarks"][key]
+			# messages before low were removed by retention
+			row = {
+				"group": group, "topic": key[0], "partition": key[1],
+				"low": low, "high": high, "committed": offset, "lag": high - max(offset, low),
+			}
+			if dt > 0 and (prev := before["committed"].get(group, {}).get(key)) is not None:
+				row["ingress"] = (high - before["watermarks"][key][1]) / dt
+				row["egress"] = (offset - prev) / dt
+				net = row["egress"] - row["ingress"]
+				row["drain_time"] = 0. if row["lag"] == 0 else row["lag"] / net if net > 0 else None
+			rows.append(row)
+	return rows
+
+
 def list_kafka():
-	
+	"""
+	Show watermarks, committed offsets, lag and drain time of consumer groups
+	"""
+
 	from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-	from pykafka import KafkaClient
+	from confluent_kafka import Consumer
+	from confluent_kafka.admin import AdminClient
+	from functools import partial
+	import json, time
 
-	parser = ArgumentParser(description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter)
+	parser = ArgumentParser(description=list_kafka.__doc__, formatter_class=ArgumentDefaultsHelpFormatter)
 	parser.add_argument("--broker", type=str, default="epyc.astro.washington.edu:9092")
+	parser.add_argument("--topics", type=str, default="^ztf_", help="regular expression for topic names")
+	parser.add_argument("--group", type=str, action="append", help="consumer group (default: all)")
+	parser.add_argument(
+		"--interval", type=float, default=10,
+		help="seconds between the two snapshots used to measure rates. 0 skips the measurement."
+	)
+	parser.add_argument("--format", choices=("table", "json"), default="table")
 	opts = parser.parse_args()
-	client = KafkaClient(opts.broker)
 
-	for name in reversed(sorted(client.topics)):
-		print(name.decode())
-		continue
-		topic = client.topics[name]
+	config = {"bootstrap.servers": opts.broker, "enable.auto.commit": False}
+	admin = AdminClient({"bootstrap.servers": opts.broker})
+	# the group admin API of confluent-kafka >= 2.0 replaces list_groups()
+	# and reads committed offsets without joining each group
+	group_api = hasattr(admin, "list_consumer_group_offsets")
+	if opts.group:
+		group_ids = opts.group
+	elif group_api:
+		group_ids = sorted(g.group_id for g in admin.list_consumer_groups(request_timeout=10).result().valid)
+	else:
+		group_ids = sorted(g.id for g in admin.list_groups(timeout=10))
 
-		num = 0
-		for p in topic.partitions.values():
-			num += p.latest_available_offset() - p.earliest_available_offset()
-		print('{}: {} messages'.format(name, num))
-	# print(client.topics.keys())
+	consumers = [Consumer({**config, "group.id": "ampel-list-kafka"})]
+	if group_api:
+		from confluent_kafka import ConsumerGroupTopicPartitions
+		def committed(group):
+			return lambda partitions: admin.list_consumer_group_offsets(
+				[ConsumerGroupTopicPartitions(group, partitions)], request_timeout=10
+			)[group].result().topic_partitions
+		groups = {g: committed(g) for g in group_ids}
+	else:
+		# committed() only reports the offsets of the consumer's own group.
+		# Create one consumer per group for both snapshots.
+		consumers += [Consumer({**config, "group.id": g}) for g in group_ids]
+		groups = {
+			g: partial(c.committed, timeout=10) for g, c in zip(group_ids, consumers[1:])
+		}
+
+	try:
+		before = get_offsets(consumers[0], groups, opts.topics)
+		after = None
+		if opts.interval > 0:
+			time.sleep(opts.interval)
+			after = get_offsets(consumers[0], groups, opts.topics)
+		rows = get_lag(before, after)
+	finally:
+		for c in consumers:
+			c.close()
+
+	if opts.format == "json":
+		print(json.dumps(rows))
+		return
+
+	columns = ["group", "topic", "partition", "low", "high", "committed", "lag"]
+	if after:
+		columns += ["ingress", "egress", "drain_time"]
+	fmt = lambda v: "-" if v is None else f"{v:.1f}" if isinstance(v, float) else str(v)
+	table = [columns] + [[fmt(row.get(c)) for c in columns] for row in rows]
+	widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+	for line in table:
+		print("  ".join(v.rjust(w) for v, w in zip(line, widths)))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File:                Ampel-ZTF/ampel/ztf/util/CandidWindow.py
+# License:             BSD-3-Clause
+# Author:              agent <agent@local>
+# Date:                17.10.2026
+# Last Modified Date:  17.10.2026
+# Last Modified By:    agent <agent@local>
+
+import os
+import time
+from array import array
+from pathlib import Path
+
+
+class CandidWindow:
+	"""
+	Remembers the most recent `size` alert ids (candids).
+	Exact membership (no false positives, unlike a bloom filter), at about 80 bytes
+	per entry. The window can be persisted to a file of raw int64 values,
+	oldest first, which is rewritten at most every `save_interval` seconds.
+
+	With deferred=True, the window is only persisted from commit(), so that
+	it can be registered with :class:`PushWatermark` and never records
+	candids whose alerts were not yet written to the database.
+	"""
+
+	def __init__(self,
+		size: int,
+		path: None | str | Path = None,
+		save_interval: float = 10,
+		deferred: bool = False
+	) -> None:
+		self._ring = array('q', bytes(8 * max(1, size)))
+		self._members: set[int] = set()
+		self._pos = 0
+		self._path = None if path is None else Path(path)
+		self._save_interval = save_interval
+		self._saved = time.monotonic()
+		self._dirty = False
+		self.deferred = deferred
+		# number of candids added so far
+		self._added = 0
+		if self._path is not None and self._path.exists():
+			stored = array('q')
+			stored.frombytes(self._path.read_bytes())
+			for candid in stored[-len(self._ring):]:
+				self.add(candid)
+			self._dirty = False
+
+
+	def __contains__(self, candid: int) -> bool:
+		return candid in self._members
+
+
+	def __len__(self) -> int:
+		return len(self._members)
+
+
+	def add(self, candid: int) -> bool:
+		"""
+		:returns: False if candid was already in the window
+		"""
+		if candid in self._members:
+			return False
+		if (old := self._ring[self._pos]) and len(self._members) >= len(self._ring):
+			self._members.discard(old)
+		self._ring[self._pos] = candid
+		self._members.add(candid)
+		self._pos = (self._pos + 1) % len(self._ring)
+		self._dirty = True
+		self._added += 1
+		if (
+			not self.deferred and self._path is not None and
+			time.monotonic() - self._saved > self._save_interval
+		):
+			self.save()
+		return True
+
+
+	def pending(self) -> int:
+		return self._added
+
+
+	def commit(self, added: int) -> None:
+		"""
+		Persist the window as it was when pending() returned `added`
+		"""
+		if self._path is not None and time.monotonic() - self._saved > self._save_interval:
+			self.save(self._added - added)
+
+
+	def save(self, skip: int = 0) -> None:
+		"""
+		:param skip: number of most recently added candids to leave out
+		"""
+		if self._path is None or not self._dirty:
+			return
+		ring = self._ring[self._pos:] + self._ring[:self._pos]
+		tmp = self._path.with_name(self._path.name + '.tmp')
+		with open(tmp, 'wb') as f:
+			# skip unused slots
+			ring[len(ring) - len(self._members):len(ring) - min(skip, len(self._members))].tofile(f)
+		os.replace(tmp, self._path)
+		self._saved = time.monotonic()
+		self._dirty = skip > 0
@@ -4,9 +4,11 @@ from functools import partial
 from os import environ
 from os.path import dirname, join
 from pathlib import Path
+from types import SimpleNamespace
 from time import time
 from ampel.secret.AmpelVault import AmpelVault
 
+import confluent_kafka
 import mongomock
 import pymongo
 import pytest
@@ -119,3 +121,161 @@ def superseded_packets():
 def first_pass_config():
     with open(Path(__file__).parent / "test-data" / "testing-config.yaml") as f:
         return yaml.safe_load(f)
+
+
+class FakeKafkaError:
+    def __init__(self, code):
+        self._code = code
+        self.args = (f"error {code}",)
+
+    def code(self):
+        return self._code
+
+
+class FakeKafkaMessage:
+    """
+    Stand-in for confluent_kafka.Message
+    """
+
+    def __init__(self, topic, partition, offset, value=b"", error=None, timestamp=None):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._value = value
+        self._error = error
+        self._timestamp = 1000 * (1600000000 + offset) if timestamp is None else timestamp
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def error(self):
+        return self._error
+
+    def value(self):
+        return self._value
+
+    def timestamp(self):
+        return confluent_kafka.TIMESTAMP_CREATE_TIME, self._timestamp
+
+
+class FakeKafkaConsumer:
+    """
+    Stand-in for confluent_kafka.Consumer that emits a fixed list of messages
+    """
+
+    def __init__(self, messages, **config):
+        self.config = config
+        self.messages = list(messages)
+        self.stored = []
+        self.calls = 0
+
+    def subscribe(self, topics, **kwargs):
+        self.topics = topics
+        self.kwargs = kwargs
+        self.paused = set()
+        self.assignment = None
+        #: partitions passed to assign() or incremental_assign()
+        self.assigned = None
+
+    def consume(self, num_messages=1, timeout=-1):
+        self.calls += 1
+        if self.assignment is None and (on_assign := self.kwargs.get("on_assign")):
+            self.assignment = [
+                confluent_kafka.TopicPartition(*k)
+                for k in sorted({(m.topic(), m.partition()) for m in self.messages})
+            ]
+            # like the real client, pass a copy: changes to the list only
+            # take effect through an explicit (incremental_)assign()
+            on_assign(self, [confluent_kafka.TopicPartition(tp.topic, tp.partition) for tp in self.assignment])
+            # emulate seeking to the explicitly assigned offsets
+            start = {(tp.topic, tp.partition): tp.offset for tp in self.assigned or []}
+            self.messages = [
+                m for m in self.messages
+                if m.error() or m.offset() >= start.get((m.topic(), m.partition()), -1)
+            ]
+        self.messages = [
+            m for m in self.messages if (m.topic(), m.partition()) not in self.paused
+        ]
+        batch, self.messages = self.messages[:num_messages], self.messages[num_messages:]
+        return batch
+
+    def assign(self, partitions):
+        self.assigned = list(partitions)
+
+    def incremental_assign(self, partitions):
+        self.assigned = (self.assigned or []) + list(partitions)
+
+    def poll(self, timeout=None):
+        batch = self.consume(1, timeout)
+        return batch[0] if batch else None
+
+    def committed(self, partitions, timeout=None):
+        return [confluent_kafka.TopicPartition(tp.topic, tp.partition, -1001) for tp in partitions]
+
+    def offsets_for_times(self, partitions, timeout=None):
+        return [
+            confluent_kafka.TopicPartition(
+                tp.topic,
+                tp.partition,
+                min(
+                    (m.offset() for m in self.messages
+                     if (m.topic(), m.partition()) == (tp.topic, tp.partition) and m.timestamp()[1] >= tp.offset),
+                    default=-1,
+                ),
+            )
+            for tp in partitions
+        ]
+
+    def list_topics(self, topic=None, timeout=-1):
+        partitions = {}
+        for m in self.messages:
+            partitions.setdefault(m.topic(), {})[m.partition()] = None
+        return SimpleNamespace(
+            topics={t: SimpleNamespace(partitions=p) for t, p in partitions.items()}
+        )
+
+    def get_watermark_offsets(self, partition, timeout=None, cached=False):
+        offsets = [
+            m.offset() for m in self.messages
+            if (m.topic(), m.partition()) == (partition.topic, partition.partition) and not m.error()
+        ]
+        return (min(offsets), max(offsets) + 1) if offsets else (0, 0)
+
+    def pause(self, partitions):
+        self.paused.update((tp.topic, tp.partition) for tp in partitions)
+
+    def store_offsets(self, offsets):
+        self.stored.append({(tp.topic, tp.partition): tp.offset for tp in offsets})
+
+
+@pytest.fixture
+def fake_kafka(monkeypatch):
+    """
+    Patch confluent_kafka.Consumer. Call the returned function with the
+    messages the next consumer should emit.
+    """
+
+    def set_messages(messages):
+        monkeypatch.setattr(
+            "confluent_kafka.Consumer",
+            lambda **config: FakeKafkaConsumer(messages, **config),
+        )
+
+    return set_messages
+
+
+@pytest.fixture
+def avro_messages(avro_packets):
+    """
+    Payloads from avro_packets, wrapped as Kafka messages
+    """
+    return [
+        FakeKafkaMessage("ztf_20191105_programid1", 0, i, f.read())
+        for i, f in enumerate(avro_packets())
+    ]
@@ -0,0 +1,130 @@
+import threading
+import time
+import uuid
+
+from ampel.ztf.t0.load.AlertRing import AlertRingReader, AlertRingWriter
+from ampel.ztf.t0.load.PushWatermark import PushWatermark
+from ampel.ztf.t0.load.SharedRingAlertLoader import SharedRingAlertLoader
+from ampel.ztf.t0.load.UWAlertLoader import UWAlertLoader
+
+from .fixtures import FakeKafkaMessage
+
+
+def test_fanout(fake_kafka, avro_messages, monkeypatch):
+    # as if a muxer had installed the push hook in the workers
+    monkeypatch.setattr(PushWatermark, "hooked", classmethod(lambda cls, owner: True))
+    messages = [
+        FakeKafkaMessage(m.topic(), i % 2, i // 2, m.value())
+        for i, m in enumerate(avro_messages * 3)
+    ]
+    fake_kafka(messages)
+    ring = uuid.uuid4().hex
+    loader = UWAlertLoader(commit_after_push=True)
+    # one payload exceeds the slot size and is sent inline
+    reader_thread = threading.Thread(
+        target=loader.serve,
+        args=(ring,),
+        kwargs={"slots": 2, "slot_size": max(len(m.value()) for m in messages) - 1},
+    )
+
+    received: list[list[bytes]] = [[], [], []]
+
+    def work(i):
+        loader = SharedRingAlertLoader(ring=ring, connect_timeout=2)
+        try:
+            for payload in loader:
+                received[i].append(payload.read())
+        except FileNotFoundError:
+            # connected only after the reader was done
+            assert not received[i]
+        # acknowledge after the final push
+        loader._acks.commit(loader._acks.pending())
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(len(received))]
+    for w in workers:
+        w.start()
+    reader_thread.start()
+    for w in [reader_thread, *workers]:
+        w.join(timeout=30)
+        assert not w.is_alive()
+
+    assert sorted(p for r in received for p in r) == sorted(m.value() for m in messages)
+    stored = {}
+    for offsets in loader._consumer._consumer.stored:
+        stored.update(offsets)
+    assert stored == {("ztf_20191105_programid1", 0): 6, ("ztf_20191105_programid1", 1): 6}
+
+
+def test_deferred_ack(fake_kafka):
+    topic = "ztf_20191105_programid1"
+    fake_kafka([FakeKafkaMessage(topic, 0, i, str(i).encode()) for i in range(4)])
+    ring = uuid.uuid4().hex
+    consumer = UWAlertLoader(commit_after_push=True)._consumer
+    writer = AlertRingWriter(consumer, ring, slots=1, slot_size=16)
+    thread = threading.Thread(target=writer.run)
+    thread.start()
+
+    def wait_stored(offset):
+        for _ in range(100):
+            if consumer._consumer.stored and consumer._consumer.stored[-1] == {(topic, 0): offset}:
+                return True
+            time.sleep(0.05)
+        return False
+
+    first = AlertRingReader(ring, deferred_ack=True)
+    # slots are freed on request, before the acknowledgement
+    assert [next(first) for _ in range(3)] == [b"0", b"1", b"2"]
+    assert first.done == 2
+    assert consumer._consumer.stored == []
+    first.ack(1)
+    assert wait_stored(1)
+    # the worker dies before acknowledging "1"
+    first.close()
+
+    second = AlertRingReader(ring)
+    assert list(second) == [b"1", b"2", b"3"]
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert consumer._consumer.stored[-1] == {(topic, 0): 4}
+
+
+def test_affinity(fake_kafka):
+    messages = [
+        FakeKafkaMessage("ztf_20191105_programid1", i % 2, i // 2, str(i).encode())
+        for i in range(60)
+    ]
+    fake_kafka(messages)
+    ring = uuid.uuid4().hex
+    connected = threading.Event()
+
+    def key(payload):
+        # route only once all workers are connected
+        connected.wait(10)
+        return int(payload) % 7
+
+    writer = AlertRingWriter(
+        UWAlertLoader(commit_after_push=True)._consumer, ring, slots=4, slot_size=16, affinity=key
+    )
+    received: list[list[int]] = [[], [], []]
+
+    def work(i):
+        for payload in AlertRingReader(ring):
+            received[i].append(int(payload))
+
+    threads = [threading.Thread(target=writer.run)] + [
+        threading.Thread(target=work, args=(i,)) for i in range(len(received))
+    ]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)
+    connected.set()
+    for t in threads:
+        t.join(timeout=30)
+        assert not t.is_alive()
+
+    assert sorted(p for r in received for p in r) == list(range(len(messages)))
+    for k in range(7):
+        # all alerts with the same key went to one worker, in order
+        assert len([r for r in received if any(p % 7 == k for p in r)]) == 1
+    for r in received:
+        assert r == sorted(r)
@@ -0,0 +1,218 @@
+import confluent_kafka
+import pytest
+
+from ampel.ztf.t0.load.AllConsumingConsumer import (
+    AllConsumingConsumer,
+    KafkaError,
+    KafkaErrorCode,
+)
+
+from ampel.ztf.t0.load.PrefetchingConsumer import PrefetchingConsumer
+
+from .fixtures import FakeKafkaError, FakeKafkaMessage
+
+
+@pytest.fixture
+def make_consumer(fake_kafka):
+    def make(messages, **kwargs):
+        fake_kafka(messages)
+        return AllConsumingConsumer("nonesuch:9092", **kwargs)
+
+    return make
+
+
+def test_consume_batch(make_consumer):
+    messages = [FakeKafkaMessage("ztf_20200101_programid1", i % 2, i // 2) for i in range(10)]
+    consumer = make_consumer(messages, timeout=1)
+
+    batch = consumer.consume_batch(4)
+    assert batch == messages[:4]
+    assert consumer._consumer.calls == 1
+    # nothing is stored until the next batch is requested
+    assert consumer._consumer.stored == []
+
+    assert consumer.consume_batch(100) == messages[4:]
+    assert consumer._consumer.stored == [
+        {("ztf_20200101_programid1", 0): 2, ("ztf_20200101_programid1", 1): 2}
+    ]
+
+    assert consumer.consume_batch(100) == []
+    assert consumer._consumer.stored[-1] == {
+        ("ztf_20200101_programid1", 0): 5, ("ztf_20200101_programid1", 1): 5
+    }
+
+
+def test_consume_batch_errors(make_consumer):
+    unknown = FakeKafkaMessage(
+        "ztf_20200101_programid1", 0, -1, error=FakeKafkaError(confluent_kafka.KafkaError.UNKNOWN_TOPIC_OR_PART)
+    )
+    timed_out = FakeKafkaMessage(
+        "ztf_20200101_programid1", 0, -1, error=FakeKafkaError(confluent_kafka.KafkaError._TIMED_OUT)
+    )
+    good = [FakeKafkaMessage("ztf_20200101_programid1", 0, i) for i in range(3)]
+
+    consumer = make_consumer([good[0], unknown, good[1], timed_out, good[2]], timeout=1)
+    assert consumer.consume_batch(10) == good[:2]
+
+    consumer = make_consumer(
+        [good[0], FakeKafkaMessage("ztf_20200101_programid1", 0, -1, error=FakeKafkaError(confluent_kafka.KafkaError._ALL_BROKERS_DOWN)), good[1]],
+        timeout=1,
+    )
+    # messages around the error are returned first, and marked
+    assert consumer.consume_batch(10) == good[:2]
+    with pytest.raises(KafkaError) as exc:
+        consumer.consume_batch(10)
+    assert exc.value.code == KafkaErrorCode._ALL_BROKERS_DOWN
+    assert consumer._consumer.stored == [{("ztf_20200101_programid1", 0): 2}]
+
+
+def test_batches(make_consumer):
+    messages = [FakeKafkaMessage("ztf_20200101_programid1", 0, i) for i in range(7)]
+    consumer = make_consumer(messages, timeout=1)
+    assert [len(batch) for batch in consumer.batches(3)] == [3, 3, 1]
+
+
+def test_prefetch(make_consumer):
+    messages = [FakeKafkaMessage("ztf_20200101_programid1", 0, i) for i in range(10)]
+    consumer = make_consumer(messages, timeout=1)
+    prefetcher = PrefetchingConsumer(consumer, depth=4, batch_size=3)
+
+    assert prefetcher.consume() is messages[0]
+    # a message is only stored after the next one has been requested
+    assert consumer._consumer.stored == []
+    assert prefetcher.consume_batch(3) == messages[1:4]
+    assert consumer._consumer.stored == [{("ztf_20200101_programid1", 0): 1}]
+    assert list(prefetcher) == messages[4:]
+    assert consumer._consumer.stored[-1] == {("ztf_20200101_programid1", 0): 10}
+    assert prefetcher.consume() is None
+
+
+def test_prefetch_error(make_consumer):
+    good = FakeKafkaMessage("ztf_20200101_programid1", 0, 0)
+    bad = FakeKafkaMessage(
+        "ztf_20200101_programid1", 0, -1, error=FakeKafkaError(confluent_kafka.KafkaError._ALL_BROKERS_DOWN)
+    )
+    prefetcher = PrefetchingConsumer(make_consumer([good, bad], timeout=1), batch_size=1)
+    assert prefetcher.consume() is good
+    with pytest.raises(KafkaError):
+        prefetcher.consume()
+    assert prefetcher.consume() is None
+    prefetcher.close()
+
+
+def test_on_revoke(make_consumer):
+    messages = [FakeKafkaMessage("ztf_20200101_programid1", i, 0) for i in range(2)]
+    consumer = make_consumer(messages, timeout=1, auto_commit=False)
+    assert consumer._consumer.kwargs["on_revoke"] == consumer._on_revoke
+    consumer.consume_batch(2)
+    committed = []
+    consumer._consumer.commit = lambda asynchronous=True: committed.append(asynchronous)
+    consumer._on_revoke(consumer._consumer, [confluent_kafka.TopicPartition("ztf_20200101_programid1", 0)])
+    assert committed == [False]
+    # marks for revoked partitions are dropped
+    assert consumer.pending() == {("ztf_20200101_programid1", 1): 0}
+
+
+@pytest.mark.parametrize("strategy", ["range", "cooperative-sticky"])
+def test_time_range(make_consumer, strategy):
+    topic = "ztf_20200101_programid1"
+    messages = [FakeKafkaMessage(topic, 0, i) for i in range(10)]
+    messages += [FakeKafkaMessage(topic, 1, i) for i in range(4)]
+    messages.append(FakeKafkaMessage(topic, 1, 4, error=FakeKafkaError(confluent_kafka.KafkaError._PARTITION_EOF)))
+    consumer = make_consumer(
+        messages,
+        start_time=1600000002,
+        end_time=1600000005,
+        **{"partition.assignment.strategy": strategy},
+    )
+    assert consumer._consumer.config["enable.partition.eof"] is True
+
+    received = [(m.partition(), m.offset()) for m in consumer]
+    assert received == [(0, i) for i in range(2, 6)] + [(1, 2), (1, 3)]
+    # start offsets are applied through an explicit assignment
+    assert [(tp.partition, tp.offset) for tp in consumer._consumer.assigned] == [(0, 2), (1, 2)]
+    assert consumer.exhausted
+    assert consumer._consumer.paused == {(topic, 0), (topic, 1)}
+
+
+def test_retire_topics(make_consumer):
+    old, drained, recent = "ztf_20200101_programid1", "ztf_20200102_programid1", "ztf_21000101_programid1"
+    messages = [
+        FakeKafkaMessage(drained, 0, 0),
+        FakeKafkaMessage(drained, 0, 1, error=FakeKafkaError(confluent_kafka.KafkaError._PARTITION_EOF)),
+        FakeKafkaMessage(old, 0, 0),
+        FakeKafkaMessage(recent, 0, 0),
+        FakeKafkaMessage("other_20200101", 0, 0),
+    ]
+    consumer = make_consumer(messages, timeout=1, topics=["^ztf_.*"], retire_topics_after=2)
+    # refresh by hand below
+    consumer._stop_refresh.set()
+    assert consumer._consumer.config["enable.partition.eof"] is True
+    # topic patterns are resolved to an explicit list
+    assert consumer._consumer.topics == [old, drained, recent]
+    assert consumer.retired_topics == set()
+
+    assert [m.topic() for m in consumer.consume_batch(2)] == [drained]
+    consumer._next_retirement = 0
+    consumer._consumer.messages = list(messages)
+    assert consumer._refresh_topics() == 1
+    assert consumer.retired_topics == {drained}
+    # the new list is picked up by the consuming thread
+    assert consumer._consumer.topics == [old, drained, recent]
+    consumer.consume_batch(1)
+    assert consumer._consumer.topics == [old, recent]
+
+    with pytest.raises(ValueError):
+        AllConsumingConsumer("file:///nonesuch", retire_topics_after=2)
+
+
+def test_stats_callback():
+    import json
+    from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+    from ampel.ztf.t0.load.AllConsumingConsumer import KafkaMetrics
+
+    def stats(ts, rxmsgs, desired=True):
+        partition = lambda p, lag: {
+            "partition": p, "desired": desired, "consumer_lag": lag,
+            "fetchq_cnt": 1, "fetchq_size": 10, "msgs_inflight": 0,
+            "rxmsgs": rxmsgs, "rxbytes": 100 * rxmsgs,
+        }
+        return json.dumps({
+            "name": "test-client",
+            "ts": ts,
+            "topics": {
+                "ztf_test_stats": {
+                    "topic": "ztf_test_stats",
+                    "partitions": {"-1": partition(-1, -1), "0": partition(0, 5), "1": partition(1, -1)},
+                },
+            },
+            "brokers": {
+                "b1": {"nodeid": 1, "nodename": "b1:9092", "rtt": {"cnt": 3, "p50": 2000, "p99": 5000}},
+                "bootstrap": {"nodeid": -1, "nodename": "b0:9092", "rtt": {"cnt": 1, "p50": 1, "p99": 1}},
+            },
+        })
+
+    value = lambda name, **labels: AmpelMetricsRegistry.registry().get_sample_value(name, labels)
+    metrics = KafkaMetrics.instance()
+    metrics._next_stats = 0
+    metrics.on_stats_callback(stats(0, 10))
+    assert value("ampel_kafka_consumer_lag", topic="ztf_test_stats") == 5
+    assert value("ampel_kafka_fetchq_cnt", topic="ztf_test_stats") == 2
+    assert value("ampel_kafka_broker_rtt_seconds", broker="b1:9092", quantile="0.99") == 0.005
+    assert value("ampel_kafka_broker_rtt_seconds", broker="b0:9092", quantile="0.99") is None
+
+    # rates are derived from consecutive statistics
+    metrics._next_stats = 0
+    metrics.on_stats_callback(stats(2_000_000, 30))
+    assert value("ampel_kafka_received_messages_per_second", topic="ztf_test_stats") == 20
+    assert value("ampel_kafka_received_bytes_per_second", topic="ztf_test_stats") == 2000
+
+    # only assigned partitions are reported
+    metrics._next_stats = 0
+    metrics.on_stats_callback(stats(4_000_000, 30), assigned=set())
+    assert value("ampel_kafka_consumer_lag", topic="ztf_test_stats") == 0
+
+    # statistics are skipped while within the overhead budget
+    metrics._next_stats = float("inf")
+    metrics.on_stats_callback(stats(6_000_000, 30))
+    assert value("ampel_kafka_consumer_lag", topic="ztf_test_stats") == 0
@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import pytest
+
+from ampel.ztf.t0.load.AllConsumingConsumer import AllConsumingConsumer
+from ampel.ztf.t0.load.ReplayConsumer import ReplayConsumer
+from ampel.ztf.t0.load.UWAlertLoader import UWAlertLoader
+
+ALERTS = Path(__file__).parent.parent / "alerts"
+
+
+class FakeClock:
+    """
+    Stand-in for the time module that records sleeps instead of waiting
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_replay_tarball(monkeypatch):
+    monkeypatch.setattr("ampel.ztf.t0.load.ReplayConsumer.time", clock := FakeClock())
+    consumer = ReplayConsumer(ALERTS / "recent_alerts.tar.gz", partitions=4)
+    consumer.subscribe(["^ztf_.*_programid1$"])
+    messages = consumer.consume(100, 1)
+    assert len(messages) == 22
+    # the end of the replay looks like a broker timeout
+    assert consumer.consume(100, 1) == []
+    assert clock.sleeps == [1]
+    assert [m.partition() for m in messages[:5]] == [0, 1, 2, 3, 0]
+    assert [m.offset() for m in messages[:5]] == [0, 0, 0, 0, 1]
+    assert all(m.topic() == "ztf_replay_programid1" for m in messages)
+
+    consumer = ReplayConsumer(ALERTS / "recent_alerts.tar.gz")
+    consumer.subscribe(["^ztf_.*_programid2$"])
+    assert consumer.consume(100, 1) == []
+
+
+def test_replay_rate(monkeypatch):
+    monkeypatch.setattr("ampel.ztf.t0.load.ReplayConsumer.time", clock := FakeClock())
+    consumer = ReplayConsumer(ALERTS / "recent_alerts.tar.gz", rate=100)
+    # the first message is due immediately, each further one 10 ms later
+    batches = [len(b) for b in iter(lambda: consumer.consume(100, 10), [])]
+    assert batches == [1] * 22
+    # ... and the empty batch at the end waits out the timeout
+    assert clock.sleeps == pytest.approx([0.01] * 21 + [10])
+    # a timeout shorter than the wait for the next message returns nothing
+    consumer = ReplayConsumer(ALERTS / "recent_alerts.tar.gz", rate=100)
+    assert len(consumer.consume(100, 1)) == 1
+    assert consumer.consume(100, 0.004) == []
+    assert clock.sleeps[-1] == pytest.approx(0.004)
+
+
+def test_replay_loader(mock_context, monkeypatch):
+    monkeypatch.setattr("ampel.ztf.t0.load.ReplayConsumer.time", FakeClock())
+    loader = UWAlertLoader(
+        bootstrap=f"file://{ALERTS / 'recent_alerts.tar.gz'}?partitions=2&loop=2",
+        deserialize="avro",
+        decoder="schemaless",
+        cutouts="skip",
+    )
+    alerts = list(loader)
+    assert len(alerts) == 44
+    assert isinstance(loader._consumer, AllConsumingConsumer)
+    assert loader._consumer._consumer.stored == {
+        ("ztf_replay_programid1", 0): 22,
+        ("ztf_replay_programid1", 1): 22,
+    }
+
+
+@pytest.mark.parametrize("option", ["start_time", "end_time", "retire_topics_after"])
+def test_replay_rejects_assignment_options(option):
+    with pytest.raises(ValueError):
+        AllConsumingConsumer(f"file://{ALERTS / 'recent_alerts.tar.gz'}", **{option: 1})
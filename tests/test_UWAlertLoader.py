@@ -0,0 +1,316 @@
+import io
+
+import pytest
+
+from ampel.model.UnitModel import UnitModel
+from ampel.ztf.alert.ZiAlertSupplier import ZiAlertSupplier
+from ampel.ztf.t0.load.UWAlertLoader import UWAlertLoader
+
+from .fixtures import FakeKafkaMessage
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_raw_payloads(fake_kafka, avro_messages, batch_size, prefetch):
+    fake_kafka(avro_messages)
+    loader = UWAlertLoader(batch_size=batch_size, prefetch=prefetch)
+    payloads = list(loader)
+    assert all(isinstance(p, io.IOBase) for p in payloads)
+    assert [p.read() for p in payloads] == [m.value() for m in avro_messages]
+
+
+def test_single_decode(fake_kafka, avro_messages, mock_context, mocker):
+    fake_kafka(avro_messages)
+    reader = mocker.spy(__import__("fastavro"), "reader")
+    supplier = ZiAlertSupplier(
+        deserialize=None,
+        loader=UnitModel(unit="UWAlertLoader", config={"deserialize": "avro"}),
+    )
+    alerts = list(supplier)
+    assert [a.id for a in alerts] == [
+        673285273115015035,
+        879461413115015009,
+        882463993115015007,
+        885458643115015010,
+    ]
+    assert reader.call_count == len(avro_messages)
+
+
+@pytest.mark.parametrize("decoder", ["reader", "schemaless"])
+def test_supplier_decoder(fake_kafka, avro_messages, mock_context, decoder):
+    fake_kafka(avro_messages)
+    supplier = ZiAlertSupplier(
+        deserialize="avro",
+        decoder=decoder,
+        loader=UnitModel(unit="UWAlertLoader", config={"decoder": decoder}),
+    )
+    assert [len(a.datapoints) for a in supplier] == [7, 1, 7, 9]
+
+
+def test_supplier_projection(fake_kafka, avro_messages, mock_context):
+    from ampel.ztf.ingest.ZiDataPointShaper import ZiDataPointShaper
+    from ampel.ztf.t0.DecentFilter import DecentFilter
+
+    projection = ZiAlertSupplier.get_projection(DecentFilter, ZiDataPointShaper)
+    assert "rb" in projection["candidate_fields"]
+    assert "rb" not in projection["prv_candidate_fields"]
+    assert ZiAlertSupplier.get_projection(DecentFilter, object)["candidate_fields"] is None
+
+    fake_kafka(avro_messages)
+    supplier = ZiAlertSupplier(
+        deserialize="avro",
+        decoder="schemaless",
+        loader=UnitModel(unit="UWAlertLoader"),
+        **projection,
+    )
+    alerts = list(supplier)
+    assert [len(a.datapoints) for a in alerts] == [7, 1, 7, 9]
+    assert set(alerts[0].datapoints[0]) <= {*projection["candidate_fields"]}
+    with pytest.raises(ValueError):
+        ZiAlertSupplier(
+            deserialize="avro", loader=UnitModel(unit="UWAlertLoader"), candidate_fields=["rb"]
+        )
+
+
+def test_supplier_defer_history(fake_kafka, avro_messages, mock_context):
+    from ampel.ztf.alert.ZiLazyDatapoints import ZiLazyDatapoints
+
+    fake_kafka(avro_messages)
+    alerts = list(
+        ZiAlertSupplier(
+            deserialize="avro",
+            decoder="schemaless",
+            loader=UnitModel(unit="UWAlertLoader"),
+            defer_history=True,
+        )
+    )
+    fake_kafka(avro_messages)
+    reference = list(ZiAlertSupplier(deserialize="avro", loader=UnitModel(unit="UWAlertLoader")))
+
+    for alert, ref in zip(alerts, reference):
+        assert isinstance(alert.datapoints, ZiLazyDatapoints)
+        assert alert.datapoints[0] == ref.datapoints[0]
+        assert not alert.datapoints.loaded
+        assert alert.datapoints == ref.datapoints
+        assert alert.datapoints.loaded
+    assert [len(a.datapoints) for a in alerts] == [7, 1, 7, 9]
+
+
+@pytest.mark.parametrize("pool", ["thread", "process"])
+def test_supplier_decode_pool(fake_kafka, avro_messages, mock_context, pool):
+    fake_kafka(avro_messages)
+    supplier = ZiAlertSupplier(
+        deserialize="avro",
+        decoder="schemaless",
+        loader=UnitModel(unit="UWAlertLoader"),
+        decode_workers=2,
+        decode_pool=pool,
+        decode_inflight=3,
+    )
+    fake_kafka(avro_messages)
+    reference = ZiAlertSupplier(deserialize="avro", loader=UnitModel(unit="UWAlertLoader"))
+    assert [(a.id, a.datapoints) for a in supplier] == [(a.id, a.datapoints) for a in reference]
+
+
+def test_supplier_decode_pool_commit_after_push(fake_kafka, avro_messages, mock_context):
+    fake_kafka(avro_messages)
+    with pytest.raises(ValueError):
+        ZiAlertSupplier(
+            deserialize="avro",
+            loader=UnitModel(unit="UWAlertLoader", config={"commit_after_push": True}),
+            decode_workers=2,
+            decode_pool="thread",
+        )
+
+
+@pytest.mark.parametrize("mode", ["drop", "tag"])
+def test_supplier_duplicates(fake_kafka, avro_messages, mock_context, mode, tmp_path):
+    messages = [*avro_messages[:2], avro_messages[0], *avro_messages[2:], avro_messages[1]]
+    fake_kafka(messages)
+    config = {"duplicates": mode, "duplicates_file": str(tmp_path / "candids")}
+    alerts = list(ZiAlertSupplier(loader=UnitModel(unit="UWAlertLoader"), **config))
+    if mode == "drop":
+        assert len(alerts) == len(avro_messages)
+    else:
+        assert len(alerts) == len(messages)
+        assert [a.tag for a in alerts if a.tag] == [["DUPLICATE"]] * 2
+    # seen candids survive a restart
+    fake_kafka(avro_messages)
+    alerts = list(ZiAlertSupplier(loader=UnitModel(unit="UWAlertLoader"), **config))
+    assert len(alerts) == (0 if mode == "drop" else len(avro_messages))
+
+
+def test_supplier_coalesce(fake_kafka, avro_messages, superseded_packets, mock_context):
+    other = [
+        FakeKafkaMessage("ztf_20191105_programid1", 1, i, f.read())
+        for i, f in enumerate(superseded_packets())
+    ]
+    agn = avro_messages
+    fake_kafka([agn[3], other[2], agn[1], other[0], agn[2], agn[0]])
+    alerts = list(ZiAlertSupplier(loader=UnitModel(unit="UWAlertLoader"), coalesce=4))
+    assert len(alerts) == 6
+    # grouped by object in order of first appearance, then by jd, within each micro-batch
+    assert [a.id for a in alerts if a.stock == alerts[0].stock] == [
+        879461413115015009,
+        885458643115015010,
+        673285273115015035,
+        882463993115015007,
+    ]
+    assert len({a.stock for a in alerts[2:4]}) == 1
+
+    with pytest.raises(ValueError):
+        ZiAlertSupplier(loader=UnitModel(unit="UWAlertLoader", config={"commit_after_push": True}), coalesce=4)
+
+
+@pytest.mark.parametrize("size,order", [(100, [0, 1, 2, 3]), (2, [1, 3, 0, 2])])
+def test_supplier_reorder(fake_kafka, avro_messages, mock_context, size, order):
+    fake_kafka([avro_messages[i] for i in (3, 1, 2, 0)])
+    alerts = list(
+        ZiAlertSupplier(
+            loader=UnitModel(unit="UWAlertLoader"), reorder_window=60, reorder_size=size
+        )
+    )
+    fake_kafka(avro_messages)
+    reference = [a.id for a in ZiAlertSupplier(loader=UnitModel(unit="UWAlertLoader"))]
+    assert [a.id for a in alerts] == [reference[i] for i in order]
+
+    with pytest.raises(ValueError):
+        ZiAlertSupplier(
+            loader=UnitModel(unit="UWAlertLoader", config={"commit_after_push": True}), reorder_window=60
+        )
+
+
+def test_candid_window():
+    from ampel.ztf.util.CandidWindow import CandidWindow
+
+    window = CandidWindow(2)
+    assert window.add(1) and window.add(2)
+    assert not window.add(1)
+    assert window.add(3)
+    assert 1 not in window and 2 in window and 3 in window
+    assert len(window) == 2
+
+
+def test_candid_window_deferred(tmp_path):
+    from array import array
+
+    from ampel.ztf.util.CandidWindow import CandidWindow
+
+    path = tmp_path / "candids"
+    window = CandidWindow(10, path, save_interval=0, deferred=True)
+    window.add(1)
+    window.add(2)
+    # only persisted on commit
+    assert not path.exists()
+    pushed = window.pending()
+    window.add(3)
+    window.commit(pushed)
+    assert array("q", path.read_bytes()).tolist() == [1, 2]
+    window.commit(window.pending())
+    assert array("q", path.read_bytes()).tolist() == [1, 2, 3]
+
+
+class FakeUpdatesBuffer:
+    def __init__(self):
+        self.db_ops = {"t0": []}
+        self.error_callback = None
+        self.fail = False
+
+    def push_updates(self, force=False):
+        self.db_ops = {"t0": []}
+        if self.fail and self.error_callback:
+            self.error_callback()
+
+
+def test_commit_after_push(fake_kafka, avro_messages, monkeypatch):
+    import weakref
+
+    from ampel.ztf.t0.load.PushWatermark import PushWatermark
+
+    monkeypatch.setattr(PushWatermark, "_buffers", weakref.WeakSet())
+    fake_kafka(avro_messages)
+    loader = UWAlertLoader(commit_after_push=True)
+    stored = loader._consumer._consumer.stored
+    buffer = FakeUpdatesBuffer()
+    PushWatermark.install(buffer)
+
+    it = iter(loader)
+    next(it)
+    # nothing processed yet
+    buffer.push_updates()
+    assert stored == []
+    next(it)
+    buffer.push_updates()
+    assert stored == [{("ztf_20191105_programid1", 0): 1}]
+    # no push, no store
+    next(it)
+    assert len(stored) == 1
+    # failed pushes stop committing
+    buffer.fail = True
+    buffer.push_updates()
+    next(it)
+    buffer.push_updates()
+    assert len(stored) == 1
+
+
+def test_commit_after_push_without_hook(fake_kafka, avro_messages, monkeypatch, caplog):
+    import weakref
+
+    from ampel.ztf.t0.load.PushWatermark import PushWatermark
+
+    monkeypatch.setattr(PushWatermark, "_buffers", weakref.WeakSet())
+    fake_kafka(avro_messages)
+    loader = UWAlertLoader(commit_after_push=True)
+    stored = loader._consumer._consumer.stored
+    it = iter(loader)
+    next(it)
+    assert "no unit installed the push hook" in caplog.text
+    assert stored == []
+    # falls back to storing offsets on the next request
+    next(it)
+    assert stored == [{("ztf_20191105_programid1", 0): 1}]
+
+
+def test_track_latency(fake_kafka, avro_messages, mock_context, monkeypatch):
+    import weakref
+
+    from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
+    from ampel.ztf.t0.load.AlertLatency import AlertLatency
+    from ampel.ztf.t0.load.PushWatermark import PushWatermark
+
+    monkeypatch.setattr(AlertLatency, "enabled", False)
+    monkeypatch.setattr(AlertLatency, "_instance", None)
+    monkeypatch.setattr(PushWatermark, "_consumers", weakref.WeakSet())
+    monkeypatch.setattr(PushWatermark, "_buffers", weakref.WeakSet())
+    count = lambda stage, suffix="count", **labels: AmpelMetricsRegistry.registry().get_sample_value(
+        f"ampel_ztf_alert_latency_seconds_{suffix}", {"stage": stage, **labels}
+    ) or 0
+    before = {stage: count(stage) for stage in ("queue", "decode", "process", "flush", "total")}
+    within_a_day = count("total", "bucket", le="86400.0")
+
+    fake_kafka(avro_messages)
+    supplier = ZiAlertSupplier(
+        loader=UnitModel(unit="UWAlertLoader", config={"track_latency": True})
+    )
+    next(supplier)
+    next(supplier)
+    # without a push hook, processed alerts are not kept for the total stage
+    assert AlertLatency.instance()._done == []
+    buffer = FakeUpdatesBuffer()
+    PushWatermark.install(buffer)
+    next(supplier)
+    buffer.push_updates()
+    assert count("queue") - before["queue"] == 3
+    assert count("decode") - before["decode"] == 3
+    assert count("process") - before["process"] == 2
+    assert count("flush") - before["flush"] == 1
+    # only the second alert was processed after the hook was installed
+    assert count("total") - before["total"] == 1
+    # messages are years old
+    assert count("total", "bucket", le="86400.0") == within_a_day
+
+
+def test_time_range(fake_kafka, avro_messages):
+    fake_kafka(avro_messages)
+    loader = UWAlertLoader(start_time=1600000001, end_time="2020-09-13T12:26:42Z")
+    assert [p.read() for p in loader] == [m.value() for m in avro_messages[1:3]]
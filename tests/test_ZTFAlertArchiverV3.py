@@ -0,0 +1,162 @@
+import io
+import sys
+import threading
+
+import fastavro
+import pytest
+import requests
+
+from ampel.log.AmpelLogger import AmpelLogger
+from ampel.ztf.t0.load.ZTFAlertArchiverV3 import ZTFAlertArchiverV3
+
+from .fixtures import FakeKafkaMessage
+
+
+@pytest.fixture
+def make_archiver(mock_context, fake_kafka):
+    def make(messages, **kwargs):
+        fake_kafka(messages)
+        return ZTFAlertArchiverV3(
+            context=mock_context, logger=AmpelLogger.get_logger(), group_name="test", **kwargs
+        )
+
+    return make
+
+
+def test_zstandard_required(make_archiver, monkeypatch):
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+    with pytest.raises(ValueError):
+        make_archiver([], codec="zstandard")
+
+
+def test_chunks_split_on_header(make_archiver, avro_packets):
+    topic = "ztf_20191105_programid1"
+    payloads = [f.read() for f in avro_packets()]
+    # the first alert has schema 3.1, the others 3.2; recompress the last
+    # one to change its header without changing the schema
+    reader = fastavro.reader(io.BytesIO(payloads[3]))
+    buf = io.BytesIO()
+    fastavro.writer(buf, reader.writer_schema, list(reader), codec="deflate")
+    payloads[3] = buf.getvalue()
+    messages = [FakeKafkaMessage(topic, i % 2, i // 2, payload) for i, payload in enumerate(payloads)]
+
+    archiver = make_archiver(messages, chunk_size=10)
+    chunks = list(archiver._chunks())
+    # chunks are split where the header changes, and carry only their own offsets
+    assert [(count, offsets) for _, count, offsets in chunks] == [
+        (1, {(topic, 0): 0}),
+        (2, {(topic, 1): 0, (topic, 0): 1}),
+        (1, {(topic, 1): 1}),
+    ]
+    candids = [next(fastavro.reader(io.BytesIO(p)))["candid"] for p in payloads]
+    assert [
+        [alert["candid"] for alert in fastavro.reader(io.BytesIO(chunk))] for chunk, _, _ in chunks
+    ] == [candids[:1], candids[1:3], candids[3:]]
+
+
+
+class FakeResponse:
+    def __init__(self, ok: bool):
+        self.ok = ok
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError("upload failed")
+
+
+class FakeSession:
+    """
+    Stand-in for the archive session that records the order in which chunk
+    uploads finish. The upload of chunk i blocks until gates[i] is set, and
+    fails if i is in `fail`.
+    """
+
+    def __init__(self, candids):
+        self.candids = candids
+        self.started = [threading.Event() for _ in candids]
+        self.uploaded = [threading.Event() for _ in candids]
+        self.gates: dict[int, threading.Event] = {}
+        self.fail: set[int] = set()
+        self.finished: list[int] = []
+
+    def post(self, path, data):
+        idx = self.candids.index(next(fastavro.reader(io.BytesIO(data)))["candid"])
+        self.started[idx].set()
+        if idx in self.gates:
+            assert self.gates[idx].wait(10)
+        self.finished.append(idx)
+        self.uploaded[idx].set()
+        return FakeResponse(idx not in self.fail)
+
+
+@pytest.fixture
+def make_uploader(make_archiver, avro_packets):
+    """
+    Archiver that uploads one alert per chunk to a FakeSession
+    """
+    topic = "ztf_20191105_programid1"
+
+    def make(max_inflight):
+        payloads = [f.read() for f in avro_packets()]
+        archiver = make_archiver(
+            [FakeKafkaMessage(topic, 0, i, payload) for i, payload in enumerate(payloads)],
+            chunk_size=1,
+            max_inflight=max_inflight,
+        )
+        archiver.__dict__["session"] = FakeSession(
+            [next(fastavro.reader(io.BytesIO(p)))["candid"] for p in payloads]
+        )
+        return archiver
+
+    return make
+
+
+def stored_chunks(archiver) -> list[int]:
+    # stored offsets point to the next message to read
+    return [offsets[("ztf_20191105_programid1", 0)] - 1 for offsets in archiver.consumer._consumer.stored]
+
+
+def test_archive_stores_in_order(make_uploader):
+    archiver = make_uploader(max_inflight=3)
+    session = archiver.session
+    # chunks 0 and 1 finish after chunk 2
+    session.gates = {0: session.uploaded[2], 1: session.uploaded[2]}
+    archiver._archive("0")
+    assert session.finished[0] == 2
+    assert stored_chunks(archiver) == [0, 1, 2, 3]
+
+
+def test_archive_failed_upload(make_uploader):
+    archiver = make_uploader(max_inflight=3)
+    session = archiver.session
+    # chunk 1 fails after chunk 2 has been uploaded
+    session.gates = {1: session.uploaded[2]}
+    session.fail = {1}
+    with pytest.raises(requests.HTTPError):
+        archiver._archive("0")
+    assert 2 in session.finished
+    assert stored_chunks(archiver) == [0]
+
+
+def test_archive_interrupted(make_uploader, monkeypatch):
+    archiver = make_uploader(max_inflight=2)
+    session = archiver.session
+    chunks = ZTFAlertArchiverV3._chunks
+    interrupted = threading.Event()
+
+    def interrupt(self):
+        for i, chunk in enumerate(chunks(self)):
+            if i == 2:
+                # chunk 1 is running, chunk 2 never submitted
+                assert session.started[1].wait(10)
+                interrupted.set()
+                raise KeyboardInterrupt
+            yield chunk
+
+    monkeypatch.setattr(ZTFAlertArchiverV3, "_chunks", interrupt)
+    # chunk 1 is still uploading when the interrupt arrives, and its offsets
+    # are stored once it finishes
+    session.gates = {1: interrupted}
+    archiver._archive("0")
+    assert session.finished == [0, 1]
+    assert stored_chunks(archiver) == [0, 1]
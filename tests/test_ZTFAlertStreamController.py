@@ -13,7 +13,8 @@ from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
 from ampel.model.ProcessModel import ProcessModel
 from ampel.template.ZTFLegacyChannelTemplate import ZTFLegacyChannelTemplate
 from ampel.util import concurrent
-from ampel.ztf.t0.ZTFAlertStreamController import ZTFAlertStreamController
+from ampel.ztf.t0.PreforkLauncher import PreforkLauncher
+from ampel.ztf.t0.ZTFAlertStreamController import AutoscalePolicy, ZTFAlertStreamController
 from ampel.ztf.t0.load.ZTFArchiveAlertLoader import ZTFArchiveAlertLoader
 
 
@@ -34,11 +35,12 @@ def t0_process(kwargs, first_pass_config):
     )
 
 
-def make_controller(config, processes, klass=ZTFAlertStreamController):
+def make_controller(config, processes, klass=ZTFAlertStreamController, **kwargs):
     return klass(
         config=config,
         priority="standard",
         processes=processes,
+        **kwargs,
     )
 
 
@@ -100,20 +102,106 @@ def test_merge_processes(config, first_pass_config):
         make_controller(config, processes)
 
 
+def test_static_membership(config, first_pass_config):
+    processes = [
+        t0_process(
+            {
+                "channel": "foo",
+                "version": 0,
+                "auto_complete": False,
+                "template": "ztf_uw_public",
+                "t0_filter": {"unit": "NoFilter"},
+            },
+            first_pass_config,
+        )
+    ]
+    loader = lambda p: p["processor"]["config"]["supplier"]["config"]["loader"]["config"]
+    assert "group_instance_id" not in loader(make_controller(config, processes).get_process(0))
+
+    controller = make_controller(config, processes, static_membership=True)
+    ids = [loader(controller.get_process(slot))["group_instance_id"] for slot in range(3)]
+    assert len(set(ids)) == 3
+    assert ids[1].endswith(f"{controller._process.name}-1")
+    # stable across calls
+    assert loader(controller.get_process(1))["group_instance_id"] == ids[1]
+
+
+def test_duplicates_file(config, first_pass_config):
+    processes = [
+        t0_process(
+            {
+                "channel": "foo",
+                "version": 0,
+                "auto_complete": False,
+                "template": "ztf_uw_public",
+                "t0_filter": {"unit": "NoFilter"},
+            },
+            first_pass_config,
+        )
+    ]
+    processes[0].processor.config["supplier"]["config"]["duplicates_file"] = "/tmp/candids"
+    controller = make_controller(config, processes)
+    supplier = lambda p: p["processor"]["config"]["supplier"]["config"]
+    # each replica has its own file
+    assert [supplier(controller.get_process(slot))["duplicates_file"] for slot in range(2)] == [
+        "/tmp/candids.0",
+        "/tmp/candids.1",
+    ]
+
+
+def test_fanout(config, first_pass_config):
+    processes = [
+        t0_process(
+            {
+                "channel": "foo",
+                "version": 0,
+                "auto_complete": False,
+                "template": "ztf_uw_public",
+                "t0_filter": {"unit": "NoFilter"},
+            },
+            first_pass_config,
+        )
+    ]
+    controller = make_controller(config, processes, fanout=True)
+    loader = lambda p: p["processor"]["config"]["supplier"]["config"]["loader"]
+    assert loader(controller.get_process(0)) == {
+        "unit": "SharedRingAlertLoader",
+        "config": {"ring": controller._ring},
+    }
+    # the reader consumes with the original loader
+    assert loader(controller._process.dict())["unit"] == "UWAlertLoader"
+
+
 class PotemkinZTFAlertStreamController(ZTFAlertStreamController):
+    @staticmethod
+    @concurrent.process
+    def run_ring_reader(config, secrets, loader, ring, slots, slot_size, affinity=False) -> bool:
+        time.sleep(1)
+        return True
+
     @staticmethod
     @concurrent.process
     def run_mp_process(
         config,
         secrets,
         p,
-        log_profile: str = "default",
+        launched=None,
     ) -> bool:
         print(f"{os.getpid()} is sleepy...")
         time.sleep(1)
         print(f"{os.getpid()} is done!")
         return True
 
+    @staticmethod
+    def setup_warm_process(config) -> int:
+        return os.getpid()
+
+    @staticmethod
+    def run_warm_process(template_pid, secrets, p, launched=None) -> int:
+        assert os.getppid() == template_pid
+        time.sleep(1)
+        return True
+
 
 @pytest.fixture
 def potemkin_controller(config, first_pass_config):
@@ -180,6 +268,161 @@ async def test_scale(potemkin_controller):
     await r
 
 
+@pytest.mark.asyncio
+async def test_scale_fanout(potemkin_controller):
+
+    potemkin_controller.fanout = True
+    process_count = lambda: AmpelMetricsRegistry.registry().get_sample_value(
+        "ampel_processes", {"tier": "0", "process": potemkin_controller._process.name}
+    )
+    try:
+        r = asyncio.create_task(potemkin_controller.run())
+        await asyncio.sleep(0.5)
+        assert process_count() == 1
+        potemkin_controller.scale(multiplier=2)
+        await asyncio.sleep(2)
+        assert process_count() == 2
+        # the reader is not counted as a replica
+        potemkin_controller.scale(multiplier=1)
+        await asyncio.sleep(1)
+        assert process_count() == 1
+    finally:
+        potemkin_controller.stop()
+    await r
+
+
+def test_startup_timer():
+    from ampel.ztf.t0.ZTFAlertStreamController import _StartupTimer
+
+    class Supplier:
+        def __init__(self):
+            self.alerts = iter([1, 2, 3])
+
+        def __iter__(self):
+            return self.alerts
+
+    count = lambda: AmpelMetricsRegistry.registry().get_sample_value(
+        "ampel_ztf_replica_startup_seconds_count", {"mode": "test"}
+    ) or 0
+    supplier = _StartupTimer(Supplier(), time.time(), "test")
+    # other attributes are passed through
+    assert next(supplier.alerts) == 1
+    alerts = iter(supplier)
+    assert count() == 0
+    # observed when the first alert is supplied, and only then
+    assert next(alerts) == 2
+    assert count() == 1
+    assert list(alerts) == [3]
+    assert count() == 1
+
+
+def test_autoscale_policy():
+    policy = AutoscalePolicy(min_multiplier=1, max_multiplier=8, target_drain_time=100)
+    # 10 alerts/s per replica
+    assert policy.desired(2, lag=10000, rate=20) == 8
+    assert policy.desired(2, lag=3000, rate=20) == 3
+    # hysteresis: 1 replica would need 100 s, more than half the target
+    assert policy.desired(2, lag=1000, rate=20) == 2
+    assert policy.desired(2, lag=400, rate=20) == 1
+    assert policy.desired(1, lag=0, rate=0) == 1
+    # not yet processing
+    assert policy.desired(1, lag=10, rate=0) == 2
+
+
+@pytest.mark.asyncio
+async def test_autoscale(potemkin_controller, monkeypatch):
+
+    process_count = lambda: AmpelMetricsRegistry.registry().get_sample_value(
+        "ampel_processes", {"tier": "0", "process": potemkin_controller._process.name}
+    )
+    readings = iter([(0, 0), (1000, 0), (1000, 10), (0, 20)])
+    monkeypatch.setattr(
+        potemkin_controller, "read_lag_and_processed", lambda: next(readings, (0, 20))
+    )
+    potemkin_controller.autoscale = AutoscalePolicy(
+        max_multiplier=3, interval=0.5, cooldown=0, target_drain_time=10
+    )
+    try:
+        r = asyncio.create_task(potemkin_controller.run())
+        await asyncio.sleep(0.25)
+        assert process_count() == 1
+        # backlog without progress
+        await asyncio.sleep(0.5)
+        assert potemkin_controller.multiplier == 2
+        # 20 alerts/s, 1000 alerts to go
+        await asyncio.sleep(0.5)
+        assert potemkin_controller.multiplier == 3
+        # drained
+        await asyncio.sleep(0.5)
+        assert potemkin_controller.multiplier == 2
+    finally:
+        potemkin_controller.stop()
+    await r
+
+
+def prefork_setup(value):
+    return {"value": value, "pid": os.getpid()}
+
+
+def prefork_work(state, arg):
+    if arg == "raise":
+        raise KeyError(arg)
+    elif arg == "sleep":
+        time.sleep(60)
+    return state["value"], state["pid"], os.getppid(), arg
+
+
+@pytest.mark.asyncio
+async def test_prefork_launcher():
+    launcher = PreforkLauncher(
+        "prefork-test", preload=["json"], setup=prefork_setup, setup_args=(42,)
+    )
+    try:
+        value, template, parent, arg = await launcher.launch(prefork_work, "a")
+        # state is set up once, in the template that forked the worker
+        assert (value, arg) == (42, "a")
+        assert parent == template != os.getpid()
+        assert (await launcher.launch(prefork_work, "b"))[1] == template
+
+        with pytest.raises(KeyError):
+            await launcher.launch(prefork_work, "raise")
+
+        t = launcher.launch(prefork_work, "sleep")
+        await asyncio.sleep(0.5)
+        t.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(t, 5)
+
+        # a template that died is replaced
+        assert launcher._template
+        launcher._template.kill()
+        launcher._template.join()
+        assert (await launcher.launch(prefork_work, "c"))[1] != template
+    finally:
+        launcher.close()
+
+
+@pytest.mark.asyncio
+async def test_warm_start(potemkin_controller):
+
+    process_count = lambda: AmpelMetricsRegistry.registry().get_sample_value(
+        "ampel_processes", {"tier": "0", "process": potemkin_controller._process.name}
+    )
+    potemkin_controller.warm_start = True
+    potemkin_controller.preload = ["json"]
+    try:
+        r = asyncio.create_task(potemkin_controller.run())
+        await asyncio.sleep(0.5)
+        assert process_count() == 1
+        potemkin_controller.scale(multiplier=2)
+        await asyncio.sleep(0.5)
+        assert process_count() == 2
+    finally:
+        potemkin_controller.stop()
+    assert all(await r)
+    assert potemkin_controller._prefork is None
+
+
 @pytest.mark.asyncio
 async def test_stop(potemkin_controller):
 
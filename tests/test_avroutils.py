@@ -0,0 +1,103 @@
+import io
+import tarfile
+from pathlib import Path
+
+import fastavro
+import pytest
+
+from ampel.ztf.t0.load.avroutils import CUTOUT_FIELDS, AlertDecoder, concatenate, read_header
+
+
+@pytest.fixture
+def payloads(avro_packets):
+    return [f.read() for f in avro_packets()]
+
+
+def test_decode(payloads):
+    decoder = AlertDecoder()
+    for payload in payloads:
+        reader = fastavro.reader(io.BytesIO(payload))
+        schema, alert = decoder.decode(payload)
+        assert alert == next(reader)
+        assert schema["name"] == reader.writer_schema["name"]
+    # one parsed schema per distinct header
+    assert len(decoder._schemas) == len({read_header(p).fingerprint for p in payloads})
+    assert decoder(io.BytesIO(payloads[0])) == decoder(payloads[0])
+
+
+@pytest.mark.parametrize("codec", ["null", "deflate", "bzip2"])
+def test_decode_codecs(payloads, codec):
+    schema, alert = AlertDecoder().decode(payloads[0])
+    buf = io.BytesIO()
+    fastavro.writer(buf, schema, [alert], codec=codec)
+    decoder = AlertDecoder()
+    assert decoder(buf.getvalue()) == alert
+    # unsupported codecs are left to fastavro.reader
+    assert len(decoder._schemas) == (0 if codec == "bzip2" else 1)
+
+
+def test_decode_fallback(payloads):
+    schema, alert = AlertDecoder().decode(payloads[0])
+    buf = io.BytesIO()
+    fastavro.writer(buf, schema, [alert, alert])
+    assert AlertDecoder()(buf.getvalue()) == alert
+    assert read_header(b"not avro") is None
+    assert read_header(payloads[0][:20]) is None
+
+
+@pytest.fixture
+def cutout_payloads():
+    with tarfile.open(Path(__file__).parent.parent / "alerts" / "recent_alerts.tar.gz") as tar:
+        return [tar.extractfile(m).read() for m in tar if m.isfile()]
+
+
+def test_decode_cutouts(cutout_payloads):
+    skip, lazy = AlertDecoder("skip"), AlertDecoder("lazy")
+    for payload in cutout_payloads:
+        alert = next(fastavro.reader(io.BytesIO(payload)))
+        assert skip(payload) == {k: v for k, v in alert.items() if k not in CUTOUT_FIELDS}
+        lazy_alert = lazy(payload)
+        for k in CUTOUT_FIELDS:
+            assert isinstance(lazy_alert[k]["stampData"], memoryview)
+            assert lazy_alert[k]["fileName"] == alert[k]["fileName"]
+            assert bytes(lazy_alert[k]["stampData"]) == alert[k]["stampData"]
+
+
+@pytest.mark.parametrize("cutouts", ["decode", "skip"])
+def test_decode_projection(cutout_payloads, cutouts):
+    projection = {"candidate": ["candid", "jd", "rb"], "prv_candidates": ["jd", "candid"]}
+    decoder = AlertDecoder(cutouts, projection)
+    for payload in cutout_payloads:
+        alert = next(fastavro.reader(io.BytesIO(payload)))
+        projected = decoder(payload)
+        assert projected["candidate"] == {k: alert["candidate"][k] for k in projection["candidate"]}
+        assert projected["prv_candidates"] == [
+            {k: el[k] for k in projection["prv_candidates"]} for el in alert["prv_candidates"] or []
+        ] or alert["prv_candidates"] is None
+        assert projected["objectId"] == alert["objectId"]
+        # fully decoded alerts are projected the same way
+        assert decoder._strip(dict(alert)) == projected
+
+
+@pytest.mark.parametrize("cutouts", ["decode", "skip", "lazy"])
+def test_decode_deferred(cutout_payloads, cutouts):
+    decoder = AlertDecoder(cutouts)
+    for payload in cutout_payloads:
+        alert, rest = decoder.decode_deferred(payload)
+        assert list(alert) == ["objectId", "candid", "candidate"]
+        alert.update(rest())
+        assert alert == decoder(payload)
+
+
+@pytest.mark.parametrize("codec", ["null", "deflate"])
+def test_concatenate(cutout_payloads, codec):
+    reader = fastavro.reader(io.BytesIO(concatenate(cutout_payloads, codec)))
+    assert reader.codec == codec
+    assert list(reader) == [next(fastavro.reader(io.BytesIO(p))) for p in cutout_payloads]
+
+    # compressed or mismatched containers have to be re-encoded
+    schema, alert = AlertDecoder().decode(cutout_payloads[0])
+    buf = io.BytesIO()
+    fastavro.writer(buf, schema, [alert], codec="deflate")
+    assert concatenate([cutout_payloads[0], buf.getvalue()]) is None
+    assert concatenate([buf.getvalue()]) is None
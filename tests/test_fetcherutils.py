@@ -0,0 +1,44 @@
+import pytest
+
+from ampel.ztf.t0.load.fetcherutils import get_lag, get_offsets
+
+from .fixtures import FakeKafkaConsumer, FakeKafkaMessage
+
+
+class CommittedConsumer(FakeKafkaConsumer):
+    def __init__(self, committed):
+        super().__init__([])
+        self.offsets = committed
+
+    def committed(self, partitions, timeout=None):
+        return [
+            type(tp)(tp.topic, tp.partition, self.offsets.get((tp.topic, tp.partition), -1001))
+            for tp in partitions
+        ]
+
+
+def test_lag():
+    topic = "ztf_20191105_programid1"
+    messages = [FakeKafkaMessage(topic, p, i) for p in range(2) for i in range(10)]
+    messages.append(FakeKafkaMessage("other", 0, 0))
+    consumer = FakeKafkaConsumer(messages)
+    before = get_offsets(
+        consumer, {"g": CommittedConsumer({(topic, 0): 4, (topic, 1): 10}).committed}
+    )
+    assert set(before["watermarks"]) == {(topic, 0), (topic, 1)}
+    assert get_lag(before) == [
+        {"group": "g", "topic": topic, "partition": 0, "low": 0, "high": 10, "committed": 4, "lag": 6},
+        {"group": "g", "topic": topic, "partition": 1, "low": 0, "high": 10, "committed": 10, "lag": 0},
+    ]
+
+    consumer.messages += [FakeKafkaMessage(topic, 0, 10)]
+    after = get_offsets(
+        consumer, {"g": CommittedConsumer({(topic, 0): 8, (topic, 1): 10}).committed}
+    )
+    after["time"] = before["time"] + 2
+    rows = get_lag(before, after)
+    assert rows[0]["lag"] == 3
+    assert rows[0]["ingress"] == pytest.approx(0.5)
+    assert rows[0]["egress"] == pytest.approx(2)
+    assert rows[0]["drain_time"] == pytest.approx(2)
+    assert rows[1]["drain_time"] == 0
@@ -7,6 +7,7 @@ from ampel.dev.UnitTestAlertSupplier import UnitTestAlertSupplier
 from ampel.ingest.ChainedIngestionHandler import ChainedIngestionHandler
 from ampel.ingest.T0Compiler import T0Compiler
 from ampel.log.AmpelLogger import DEBUG, AmpelLogger
+from ampel.metrics.AmpelMetricsRegistry import AmpelMetricsRegistry
 from ampel.model.ingest.IngestDirective import IngestDirective
 from ampel.model.UnitModel import UnitModel
 from ampel.mongo.update.DBUpdatesBuffer import DBUpdatesBuffer
@@ -414,6 +415,9 @@ def test_superseded_candidates_concurrent(mock_context, superseded_alerts, order
 
     assert len(alerts) == 3
 
+    conflicts = lambda: AmpelMetricsRegistry.registry().get_sample_value("ampel_ztf_muxer_conflicts_total") or 0
+    conflicts_before = conflicts()
+
     def _ingest(indexes: list[int]):
         for i in indexes:
             next(iter(ingesters[i]._mux_cache.values())).index = i
@@ -443,6 +447,8 @@ def test_superseded_candidates_concurrent(mock_context, superseded_alerts, order
             _ingest(indexes)
 
     ingest(ordering)
+    # the first ingester saw the datapoints of the others only after querying
+    assert conflicts() > conflicts_before
 
     t0 = mock_context.db.get_collection("t0")
 
@@ -468,3 +474,36 @@ def test_superseded_candidates_concurrent(mock_context, superseded_alerts, order
     assert (
         "SUPERSEDED" not in t0.find_one({"id": candids[2]})["tag"]
     ), f"candid {candids[2]} not superseded"
+
+
+def test_reuse_stock_state(mock_context, superseded_alerts, mocker):
+    def ingest(reuse: bool):
+        directive = {
+            "channel": "EXAMPLE_TNS_MSIP",
+            "ingest": {
+                "mux": {
+                    "unit": "ZiMongoMuxer",
+                    "config": {"reuse_stock_state": reuse},
+                    "combine": [{"unit": "ZiT1Combiner"}],
+                },
+            },
+        }
+        handler = get_handler(mock_context, [IngestDirective(**directive)])
+        for alert in reversed(list(superseded_alerts())):
+            handler.ingest(alert.datapoints, filter_results=[(0, True)], stock_id=alert.stock)
+        handler.updates_buffer.push_updates()
+        docs = {
+            doc["id"]: (sorted(doc["tag"]), len(doc.get("meta", [])))
+            for doc in mock_context.db.get_collection("t0").find({})
+        }
+        mock_context.db.get_collection("t0").delete_many({})
+        mock_context.db.get_collection("t1").delete_many({})
+        return docs
+
+    from ampel.ztf.ingest.ZiMongoMuxer import ZiMongoMuxer
+
+    get_dps = mocker.spy(ZiMongoMuxer, "_get_dps")
+    reference = ingest(False)
+    assert get_dps.call_count == 3
+    assert ingest(True) == reference
+    assert get_dps.call_count == 4